@@ -3,13 +3,24 @@ from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader, C
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 # from langchain.embeddings import OpenAIEmbeddings
-from langchain_openai import OpenAIEmbeddings
+from embedders import DEFAULT_EMBEDDER, EMBEDDERS, check_embedder, get_embeddings
+from embedding_cache import cached, model_key
+from dedup import DEDUP_MODES, DEFAULT_DEDUP, deduplicate
 from langchain_community.vectorstores import Chroma
 import openai 
+import argparse
 from dotenv import load_dotenv
 import os
 import shutil
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pymongo import MongoClient
+from vector_index import build_index, load_index, update_index
+from answer_cache import invalidate_answers
+from instrumentation import count, profile, report, stage
+from ingestion import (DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT, chunk_hash, clear_sources, hash_file,
+                       incremental_ingest, ingest, register_sources)
 # from langchain.embeddings import OpenAIEmbeddings
 
 # Load environment variables. Assumes that project contains .env file with API keys
@@ -24,17 +35,40 @@ DATA_PATH = "corpus/pdf"
 
 
 def main():
-    generate_data_store()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of chunks embedded and inserted per batch.")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT, help="Maximum number of batches processed concurrently.")
+    parser.add_argument("--incremental", action="store_true", help="Only re-embed PDFs that changed since the last run instead of rebuilding.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes parsing and splitting PDFs (1 to run serially).")
+    parser.add_argument("--embedder", type=str, default=DEFAULT_EMBEDDER, choices=EMBEDDERS, help="Embedding backend (see embedders.py).")
+    parser.add_argument("--dedup", type=str, default=DEFAULT_DEDUP, choices=DEDUP_MODES, help="Drop duplicate chunks before embedding (see dedup.py).")
+    args = parser.parse_args()
+    with profile(), stage("generate_data_store"):
+        generate_data_store(batch_size=args.batch_size, max_in_flight=args.max_in_flight, incremental=args.incremental, workers=args.workers,
+                            embedder=args.embedder, dedup=args.dedup)
+    report()
 
 
-def generate_data_store():
-    documents = load_documents()
-    chunks = split_text(documents)
-    save_to_mongodb(chunks)
-    # save_to_chroma(chunks)
+def generate_data_store(batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, incremental=False, workers=1, embedder=None,
+                        dedup=None, collection=None):
+    if incremental:
+        update_mongodb(batch_size=batch_size, max_in_flight=max_in_flight, embedder=embedder, dedup=dedup, collection=collection)
+        return
 
+    stream_to_mongodb(list_pdf_files(), workers=workers, batch_size=batch_size, max_in_flight=max_in_flight, embedder=embedder, dedup=dedup,
+                      collection=collection)
+    # save_to_chroma(load_and_split(workers=workers), embedder=embedder, dedup=dedup)
 
-def load_documents():
+
+def list_pdf_files():
+    return sorted(
+        os.path.join(DATA_PATH, filename)
+        for filename in os.listdir(DATA_PATH)
+        if filename.endswith(".pdf")
+    )
+
+
+def load_documents(file_paths=None):
     # Directory containing PDF and CSV files
     data_directory = "corpus"
 
@@ -43,14 +77,14 @@ def load_documents():
 
     # Process PDF files
     print("Loading PDF documents...")
-    pdf_directory = os.path.join(data_directory, "pdf")
-    for filename in os.listdir(pdf_directory):
-        if filename.endswith(".pdf"):
-            file_path = os.path.join(pdf_directory, filename)
-            loader = PyPDFLoader(file_path)  # Load PDF with metadata (filename, page number)
-            documents.extend(loader.load())
+    if file_paths is None:
+        file_paths = list_pdf_files()
+    for file_path in file_paths:
+        loader = PyPDFLoader(file_path)  # Load PDF with metadata (filename, page number)
+        documents.extend(loader.load())
 
     # Process CSV files
+    # The DDInter CSVs are served by the structured index in ddinter_index.py rather than embedded
     # print("Loading CSV documents...")
     # csv_directory = os.path.join(data_directory, "csv")
     # for filename in os.listdir(csv_directory):
@@ -61,12 +95,16 @@ def load_documents():
     return documents
 
 
-def split_text(documents: list[Document]):
-    text_splitter = RecursiveCharacterTextSplitter(
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(
     chunk_size=1000,
     chunk_overlap=500,
     length_function=len,
     )
+
+
+def split_text(documents: list[Document]):
+    text_splitter = get_text_splitter()
     chunks = text_splitter.split_documents(documents)
     print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
 
@@ -74,55 +112,222 @@ def split_text(documents: list[Document]):
     return chunks
 
 
-def save_to_chroma(chunks: list[Document]):
+def load_and_split_pdf(file_path):
+    """
+    Parse and split a single PDF. Runs in a worker process, so it must stay a module-level function.
+    """
+    documents = PyPDFLoader(file_path).load()
+    return len(documents), get_text_splitter().split_documents(documents)
+
+
+def load_and_split(file_paths=None, workers=1):
+    """
+    Load and split PDFs across a pool of worker processes.
+    Chunks are returned in file order, so the output is identical to split_text(load_documents(file_paths)).
+    """
+    if file_paths is None:
+        file_paths = list_pdf_files()
+    if workers <= 1 or len(file_paths) <= 1:
+        return split_text(load_documents(file_paths))
+
+    print(f"Loading and splitting {len(file_paths)} PDF documents with {workers} workers...")
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_paths))) as executor:
+        # Start the largest files first so that one big PDF does not finish last on its own
+        futures = {
+            file_path: executor.submit(load_and_split_pdf, file_path)
+            for file_path in sorted(file_paths, key=os.path.getsize, reverse=True)
+        }
+        num_documents = 0
+        chunks = []
+        for file_path in file_paths:
+            file_documents, file_chunks = futures[file_path].result()
+            num_documents += file_documents
+            chunks.extend(file_chunks)
+
+    print(f"Split {num_documents} documents into {len(chunks)} chunks.")
+    return chunks
+
+
+def iter_pdf_pages(file_paths, workers=1):
+    """
+    Yield the pages of each PDF in file order, parsing up to `workers` files ahead in worker processes.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            yield from PyPDFLoader(file_path).lazy_load()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(file_paths)
+        pending = deque(executor.submit(load_pdf, file_path) for file_path in islice(remaining, workers))
+        while pending:
+            pages = pending.popleft().result()
+            for file_path in islice(remaining, 1):
+                pending.append(executor.submit(load_pdf, file_path))
+            yield from pages
+
+
+def load_pdf(file_path):
+    """
+    Parse a single PDF into one Document per page. Runs in a worker process.
+    """
+    return PyPDFLoader(file_path).load()
+
+
+def chunk_to_document(chunk: Document):
+    """
+    MongoDB document (without its embedding) for a chunk.
+    """
+    document = {"content": chunk.page_content, "metadata": chunk.metadata, "source_id": chunk.metadata["source"]}
+    document["chunk_hash"] = chunk_hash(document)
+    return document
+
+
+def save_to_chroma(chunks: list[Document], incremental=False, embedder=None, dedup=None):
+    chunks = deduplicate(chunks, dedup)
+    if incremental and os.path.exists(CHROMA_PATH):
+        update_chroma(chunks, embedder=embedder)
+        return
+
     # Clear out the database first.
     if os.path.exists(CHROMA_PATH):
         shutil.rmtree(CHROMA_PATH)
 
-    # Create a new DB from the documents.
+    # Create a new DB from the documents, recording which model embedded them.
+    embeddings = cached(get_embeddings(embedder))
     db = Chroma.from_documents(
-        chunks, OpenAIEmbeddings(), persist_directory=CHROMA_PATH
+        chunks, embeddings, persist_directory=CHROMA_PATH, collection_metadata={"embedder": model_key(embeddings)}
     )
     db.persist()
     print(f"Saved {len(chunks)} chunks to {CHROMA_PATH}.")
+    invalidate_answers()
+
+
+def update_chroma(chunks: list[Document], embedder=None):
+    """
+    Sync the persisted Chroma DB with chunks (already deduplicated), using each chunk's content hash as its id.
+    Only chunks that are not stored yet are embedded; chunks that no longer exist are deleted.
+    """
+    embeddings = cached(get_embeddings(embedder))
+    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embeddings)
+    check_embedder((db._collection.metadata or {}).get("embedder"), embeddings, what="Chroma DB")
+
+    ids = [chunk_hash({"content": chunk.page_content, "metadata": chunk.metadata}) for chunk in chunks]
+    existing = set(db.get(include=[])["ids"])
+    new_chunks = {}
+    for chunk_id, chunk in zip(ids, chunks):
+        if chunk_id not in existing:
+            new_chunks.setdefault(chunk_id, chunk)
+    stale = list(existing - set(ids))
+
+    if stale:
+        db.delete(ids=stale)
+    if new_chunks:
+        db.add_documents(list(new_chunks.values()), ids=list(new_chunks))
+    db.persist()
+    print(f"Added {len(new_chunks)} chunks to {CHROMA_PATH} and deleted {len(stale)}.")
+    if new_chunks or stale:
+        invalidate_answers()
 
 # MongoDB connection details
 MONGO_URI = "mongodb://localhost:27017"
 DB_NAME = "DrugWise"
 COLLECTION_NAME = "document_embeddings"
 
-def save_to_mongodb(chunks: list[Document]):
-    # Connect to MongoDB
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
+def save_to_mongodb(chunks: list[Document], batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, embedder=None, dedup=None,
+                    collection=None):
+    sources = set()
+
+    def prepare(_inputs):
+        for chunk in chunks:
+            sources.add(chunk.metadata["source"])
+            yield chunk_to_document(chunk)
+
+    store_in_mongodb([("prepare", prepare, 1)], sources, batch_size=batch_size, max_in_flight=max_in_flight, embedder=embedder, dedup=dedup,
+                     collection=collection)
+
+
+def stream_to_mongodb(file_paths, workers=1, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, embedder=None, dedup=None,
+                      collection=None):
+    """
+    Load, split, embed and store the PDFs as a streaming pipeline, so chunks are embedded while later files are still parsed.
+    """
+    text_splitter = get_text_splitter()
+
+    def split(pages):
+        for page in pages:
+            count("pages_loaded")
+            count("page_characters", len(page.page_content))
+            for chunk in text_splitter.split_documents([page]):
+                yield chunk_to_document(chunk)
+
+    stages = [
+        ("load", lambda _inputs: iter_pdf_pages(file_paths, workers), 1),
+        ("split", split, 1),
+    ]
+    store_in_mongodb(stages, file_paths, batch_size=batch_size, max_in_flight=max_in_flight, embedder=embedder, dedup=dedup, collection=collection)
+
+
+def store_in_mongodb(stages, sources, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, embedder=None, dedup=None,
+                     collection=None):
+    """
+    Replace the collection with the chunks produced by the given pipeline stages.
+    Pass collection to use an existing connection instead of opening one to MONGO_URI.
+    """
+    if collection is None:
+        # Connect to MongoDB
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+        collection = db[COLLECTION_NAME]
 
     # Clear the collection if it already exists
     collection.delete_many({})
+    clear_sources(collection)
 
-    # Initialize OpenAI embeddings
-    embeddings = OpenAIEmbeddings()
+    # Initialize the embeddings
+    embeddings = cached(get_embeddings(embedder))
 
-    # Process and store each chunk
-    for i, chunk in enumerate(chunks, start=1):  # Use enumerate to track the index
-        # Generate embedding for the chunk
-        embedding = embeddings.embed_query(chunk.page_content)
+    # Drop duplicate chunks, then embed and insert the rest in batches as they are produced
+    stored = ingest(stages, collection, embeddings, batch_size=batch_size, max_in_flight=max_in_flight, dedup=dedup)
+    print(f"Embedding cache: {embeddings.stats()}")
 
-        # Prepare the document to insert into MongoDB
-        document = {
-            "content": chunk.page_content,
-            "metadata": chunk.metadata,
-            "embedding": embedding
-        }
+    # Record the file hashes so that the next --incremental run only picks up changes
+    register_sources(collection, "pdf", {source: hash_file(source) for source in sources})
+
+    print(f"Saved {stored} chunks to MongoDB collection '{COLLECTION_NAME}'.")
 
-        # Insert into MongoDB
-        collection.insert_one(document)
+    # Rebuild the vector index used by the query script, and drop the answers generated from the old documents
+    build_index(collection)
+    invalidate_answers()
 
-        # Print status every 1000 chunks
-        if i % 1000 == 0:
-            print(f"{i} chunks have been inserted into MongoDB.")
 
-    print(f"Saved {len(chunks)} chunks to MongoDB collection '{COLLECTION_NAME}'.")
+def update_mongodb(batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, embedder=None, dedup=None, collection=None):
+    """
+    Re-embed only the PDFs whose content hash changed since they were last ingested.
+    """
+    if collection is None:
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+        collection = db[COLLECTION_NAME]
+
+    embeddings = cached(get_embeddings(embedder))
+
+    def load_source(file_path):
+        chunks = split_text(load_documents([file_path]))
+        return [{"content": chunk.page_content, "metadata": chunk.metadata} for chunk in chunks]
+
+    sources = {file_path: hash_file(file_path) for file_path in list_pdf_files()}
+    embedded = incremental_ingest(
+        sources, "pdf", collection, embeddings, load_source,
+        legacy_filter={"metadata.source": {"$exists": True}},
+        batch_size=batch_size, max_in_flight=max_in_flight, dedup=dedup,
+    )
+    print(f"Embedding cache: {embeddings.stats()}")
+
+    # Add the new chunks to the vector index used by the query script, and drop the answers generated from the old documents
+    if embedded or collection.count_documents({}) != len(load_index() or []):
+        update_index(collection)
+        invalidate_answers()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,17 @@
+import argparse
+import asyncio
+import aiohttp
 import pandas as pd
-import requests
 from bs4 import BeautifulSoup
 from pymongo import MongoClient
-from langchain_openai import OpenAIEmbeddings
+from vector_index import build_index, load_index, update_index
+from answer_cache import invalidate_answers
+from instrumentation import count, profile, report, stage
+from ingestion import (DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT, chunk_hash, clear_sources, embed_and_insert,
+                       hash_text, incremental_ingest, register_sources)
+from embedders import DEFAULT_EMBEDDER, EMBEDDERS, get_embeddings
+from embedding_cache import cached
+from dedup import DEDUP_MODES, DEFAULT_DEDUP
 import openai
 from dotenv import load_dotenv
 import os
@@ -16,95 +25,202 @@ MONGO_URI = "mongodb://localhost:27017"
 DB_NAME = "DrugWise"
 COLLECTION_NAME = "document_embeddings"
 
-def fetch_article_content(url):
+# Maximum number of article pages fetched at the same time
+DEFAULT_FETCH_CONCURRENCY = 10
+
+def extract_abstract(html, url):
     """
-    Fetch the content of an article from the given URL.
+    Extract the abstract from the HTML of an article page.
     """
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an error for bad status codes
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Extract the main content of the article (this may vary depending on the website structure)
-        # For PubMed articles, the abstract is usually in a specific tag
-        abstract = soup.find('div', {'class': 'abstract-content'})
-        if abstract:
-            return abstract.get_text(strip=True)
-        else:
-            print(f"Could not find abstract for URL: {url}")
-            return None
-    except Exception as e:
-        print(f"Error fetching URL {url}: {e}")
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Extract the main content of the article (this may vary depending on the website structure)
+    # For PubMed articles, the abstract is usually in a specific tag
+    abstract = soup.find('div', {'class': 'abstract-content'})
+    if abstract:
+        return abstract.get_text(strip=True)
+    else:
+        print(f"Could not find abstract for URL: {url}")
         return None
 
-def save_to_mongodb(data):
+async def fetch_article_contents(urls, concurrency=DEFAULT_FETCH_CONCURRENCY):
     """
-    Save the data (content, metadata, embeddings) to MongoDB.
+    Fetch the abstracts of many articles concurrently over one pooled session, at most `concurrency` at a time.
+    :return: Dict: url -> abstract, or None for the articles that could not be fetched.
     """
-    # Connect to MongoDB
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
-
-    # Insert the data into MongoDB
-    collection.insert_one(data)
-
-def process_csv_and_store_embeddings(csv_file):
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+
+        async def fetch_one(url):
+            async with semaphore:
+                try:
+                    with stage("fetch_article"):
+                        async with session.get(url) as response:
+                            response.raise_for_status()  # Raise an error for bad status codes
+                            html = await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+                    # UnicodeDecodeError: a page whose declared charset does not match its content
+                    count("fetch_errors", error=type(e).__name__)
+                    print(f"Error fetching URL {url}: {e}")
+                    return url, None
+            count("fetch_bytes", len(html.encode("utf-8")))
+            try:
+                with stage("extract_abstract"):
+                    return url, extract_abstract(html, url)
+            except Exception as e:
+                # Malformed HTML only loses this article, not the whole ingestion
+                count("fetch_errors", error=type(e).__name__)
+                print(f"Error parsing URL {url}: {e}")
+                return url, None
+
+        return dict(await asyncio.gather(*(fetch_one(url) for url in urls)))
+
+def csv_abstract(row):
     """
-    Process the CSV file, fetch article content, generate embeddings, and store in MongoDB.
+    The abstract scraped into the CSV, or None if the scraper could not find one.
     """
-    # Read the CSV file
-    df = pd.read_csv(csv_file)
-
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
+    abstract = row.get('abstract')
+    if not isinstance(abstract, str) or not abstract.strip() or abstract == 'NO_ABSTRACT':
+        return None
+    return abstract
 
-    # Clear the collection if needed (optional)
-    collection.delete_many({})
+def article_content(row, abstract):
+    """
+    Text to embed for an article: its title, when the CSV has one, followed by the abstract.
+    """
+    title = row.get('title')
+    if isinstance(title, str) and title.strip() and title != 'NO_TITLE':
+        return f"{title}\n\n{abstract}"
+    return abstract
 
-    # Initialize OpenAI embeddings
-    embeddings = OpenAIEmbeddings()
+def fetch_missing_abstracts(rows, concurrency=DEFAULT_FETCH_CONCURRENCY):
+    """
+    Fetch the abstracts of the rows whose abstract is missing from the CSV.
+    :return: Dict: url -> fetched abstract (None if it could not be fetched).
+    """
+    missing = [row['url'] for row in rows if csv_abstract(row) is None]
+    print(f"Using {len(rows) - len(missing)} abstracts from the CSV, fetching {len(missing)} articles.")
+    count("abstracts_from_csv", len(rows) - len(missing))
+    count("articles_fetched", len(missing))
+    if not missing:
+        return {}
+    with stage("fetch_articles"):
+        return asyncio.run(fetch_article_contents(missing, concurrency))
+
+def article_hash(row):
+    """
+    Content hash of an article's row in the scraped CSV.
+    """
+    return hash_text({column: value for column, value in row.items() if not str(column).startswith("Unnamed")})
 
-    bad_url_counter = 0
+def iter_article_documents(df, fetched=None, concurrency=DEFAULT_FETCH_CONCURRENCY):
+    """
+    Yield the documents to embed for every article in the DataFrame, fetching only the abstracts missing from the CSV.
+    If fetched is given, the url -> row hash of every article with content is recorded in it.
+    """
+    rows = [row for _, row in df.iterrows()]
+    fetched_abstracts = fetch_missing_abstracts(rows, concurrency)
 
     # Iterate through the 'url' column
-    for index, row in df.iterrows():
+    for row in rows:
         url = row['url']
-        # print(f"Processing URL: {url}")
 
-        # Fetch the article content
-        content = fetch_article_content(url)
+        abstract = csv_abstract(row) or fetched_abstracts.get(url)
+        content = article_content(row, abstract) if abstract else None
         if not content:
-            bad_url_counter += 1
             print(f"Could not fetch {url}")
-            continue  # Skip if content could not be fetched
-
-        # Generate embeddings for the content
-        embedding = embeddings.embed_query(content)
+        else:
+            document = {
+                "url": url,
+                "content": content,
+                "source_id": url,
+            }
+            document["chunk_hash"] = chunk_hash(document)
+            if fetched is not None:
+                fetched[url] = article_hash(row)
+            yield document
+
+def process_csv_and_store_embeddings(csv_file, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, incremental=False,
+                                     concurrency=DEFAULT_FETCH_CONCURRENCY, embedder=None, dedup=None, collection=None):
+    """
+    Process the CSV file, fetch missing article content, generate embeddings, and store in MongoDB.
+    With incremental=True only articles whose CSV row changed since the last run are fetched and embedded.
+    Pass collection to use an existing connection instead of opening one to MONGO_URI.
+    """
+    # Read the CSV file
+    df = pd.read_csv(csv_file)
 
-        # Prepare the document to insert into MongoDB
-        document = {
-            "url": url,
-            "content": content,
-            "embedding": embedding
-        }
+    if collection is None:
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+        collection = db[COLLECTION_NAME]
+
+    # Initialize the embeddings
+    embeddings = cached(get_embeddings(embedder))
+
+    if incremental:
+        rows = {row['url']: row for _, row in df.iterrows()}
+        fetched_abstracts = {}
+
+        def prepare(changed):
+            fetched_abstracts.update(fetch_missing_abstracts([rows[url] for url in changed], concurrency))
+
+        def load_source(url):
+            abstract = csv_abstract(rows[url]) or fetched_abstracts.get(url)
+            if not abstract:
+                print(f"Could not fetch {url}")
+                return None
+            return [{"url": url, "content": article_content(rows[url], abstract)}]
+
+        embedded = incremental_ingest(
+            {url: article_hash(row) for url, row in rows.items()}, "pubmed", collection, embeddings, load_source,
+            legacy_filter={"url": {"$exists": True}}, prepare=prepare,
+            batch_size=batch_size, max_in_flight=max_in_flight, dedup=dedup,
+        )
+        print("All changed articles processed and stored in MongoDB.")
+        print(f"Embedding cache: {embeddings.stats()}")
+
+        # Add the new chunks to the vector index used by the query script, and drop the answers generated from the old documents
+        if embedded or collection.count_documents({}) != len(load_index() or []):
+            update_index(collection)
+            invalidate_answers()
+        return
 
-        # Save to MongoDB
-        save_to_mongodb(document)
+    # Clear the collection if needed (optional)
+    collection.delete_many({})
+    clear_sources(collection)
 
-        # Print status every 100 articles
-        if (index + 1) % 100 == 0:
-            print(f"{index + 1} articles processed.")
-            print(f"{index-bad_url_counter+1} articles saved to mongodb.")
+    # Embed and insert the articles in batches as they are fetched
+    fetched = {}
+    embed_and_insert(iter_article_documents(df, fetched, concurrency), collection, embeddings, batch_size=batch_size, max_in_flight=max_in_flight, name="fetch",
+                     dedup=dedup)
 
-        
+    # Record the row hashes so that the next --incremental run only picks up changes
+    register_sources(collection, "pubmed", fetched)
 
     print("All articles processed and stored in MongoDB.")
+    print(f"Embedding cache: {embeddings.stats()}")
+
+    # Rebuild the vector index used by the query script, and drop the answers generated from the old documents
+    build_index(collection)
+    invalidate_answers()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of articles embedded and inserted per batch.")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT, help="Maximum number of batches processed concurrently.")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch and embed articles that changed since the last run instead of rebuilding.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_FETCH_CONCURRENCY, help="Maximum number of articles without a scraped abstract fetched at once.")
+    parser.add_argument("--embedder", type=str, default=DEFAULT_EMBEDDER, choices=EMBEDDERS, help="Embedding backend (see embedders.py).")
+    parser.add_argument("--dedup", type=str, default=DEFAULT_DEDUP, choices=DEDUP_MODES, help="Drop duplicate articles before embedding (see dedup.py).")
+    args = parser.parse_args()
+
     # Path to the CSV file
     csv_file = "articles.csv"  # Replace with the path to your CSV file
 
     # Process the CSV and store embeddings in MongoDB
-    process_csv_and_store_embeddings(csv_file)
\ No newline at end of file
+    with profile(), stage("process_csv_and_store_embeddings"):
+        process_csv_and_store_embeddings(csv_file, batch_size=args.batch_size, max_in_flight=args.max_in_flight, incremental=args.incremental,
+                                         concurrency=args.concurrency, embedder=args.embedder, dedup=args.dedup)
+    report()
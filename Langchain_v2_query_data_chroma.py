@@ -1,18 +1,22 @@
 import argparse
+import asyncio
 # from dataclasses import dataclass
-from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-import os
 from dotenv import load_dotenv
-import openai
+from embedders import DEFAULT_EMBEDDER, EMBEDDERS, check_embedder, get_embeddings
+from instrumentation import count, profile, report, stage
+from batch_query import DEFAULT_CONCURRENCY, DEFAULT_OUTPUT, answer_batch, read_questions, write_replies
+from streaming import print_token
 
+# Chroma and langchain take seconds to import, so they are imported by the functions that use them,
+# after the arguments have been parsed (see check_import_time.py).
+
+# Load environment variables (OPENAI_API_KEY is read from them by langchain_openai)
 load_dotenv()
 
 CHROMA_PATH = "chroma"
 
-openai.api_key = os.environ['OPENAI_API_KEY']
+# Minimum relevance of the best match for the LLM to be called
+MIN_SCORE = 0.7
 
 PROMPT_TEMPLATE = """
 Answer the question based only on the following context:
@@ -28,31 +32,208 @@ Answer the question based on the above context: {question}
 def main():
     # Create CLI.
     parser = argparse.ArgumentParser()
-    parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("query_text", type=str, nargs="?", help="The query text.")
+    parser.add_argument("--ddinter-only", action="store_true", help="Only report the DDInter interactions between drugs named in the query.")
+    parser.add_argument("--embedder", type=str, default=DEFAULT_EMBEDDER, choices=EMBEDDERS, help="Embedding backend; must match the one used for ingestion.")
+    parser.add_argument("--batch", type=str, default=None, help="Answer every question in this file (- for stdin) instead of query_text.")
+    parser.add_argument("--output", type=str, default=DEFAULT_OUTPUT, help="JSONL file the batch answers are written to (- for stdout).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Maximum number of concurrent LLM calls in batch mode.")
+    parser.add_argument("--stream", action="store_true", help="Print the response as it is generated, and the time to its first token.")
     args = parser.parse_args()
-    query_text = args.query_text
-
-    # Prepare the DB.
-    embedding_function = OpenAIEmbeddings()
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+    if (args.query_text is None) == (args.batch is None):
+        parser.error("Pass either query_text or --batch.")
+
+    if args.batch:
+        with profile(), stage("batch_query", backend="chroma"):
+            answer_questions(read_questions(args.batch), output=args.output, concurrency=args.concurrency,
+                             ddinter_only=args.ddinter_only, embedder=args.embedder)
+    else:
+        with profile(), stage("query", backend="chroma"):
+            answer_query(args.query_text, args.ddinter_only, embedder=args.embedder, stream=args.stream)
+    report()
+
+
+def answer_query(query_text, ddinter_only=False, embedder=None, stream=False):
+    """
+    Run the RAG pipeline for one query and print the answer and its sources.
+    With stream=True the answer is printed as it is generated.
+    """
+    asyncio.run(answer_query_async(query_text, ddinter_only, embedder, on_token=print_token if stream else None, verbose=True))
+
+
+async def answer_query_async(query_text, ddinter_only=False, embedder=None, on_token=None, verbose=False,
+                             embedding_function=None, answers=None, ddinter=None, db=None, top_k=5):
+    """
+    Coroutine running the RAG pipeline for one query, for use from asyncio code.
+    The query is embedded while the Chroma DB is opened, and the response is streamed.
+    :param on_token: callable: called with each piece of the response as it is generated (see streaming.py).
+    :param verbose: bool: print the progress like the command line does.
+    :param embedding_function: Embeddings: cached embedder to reuse across queries (default: a new cached(get_embeddings(embedder))).
+    :param answers: AnswerCache: answer cache to reuse across queries (default: a new AnswerCache()).
+    :param ddinter: DDInterIndex: DDInter index to reuse across queries (default: loaded for this query).
+    :param db: Chroma: Chroma DB (see open_chroma) to reuse across queries (default: opened for this query).
+    :param top_k: int: number of documents to retrieve.
+    :return: dict: the query, the known DDInter interactions, the retrieved sources, the response (None when nothing
+             relevant was retrieved), whether it came from the answer cache and the seconds to its first token.
+    """
+    from langchain_openai import ChatOpenAI
+    from answer_cache import AnswerCache, context_key
+    from ddinter_index import load_ddinter_index
+    from embedding_cache import cached
+    from streaming import cached_or_streamed
+
+    def find_known_interactions(ddinter):
+        if ddinter is None:
+            ddinter = load_ddinter_index()
+        return ddinter.describe_pairs(query_text) if ddinter is not None else []
+
+    # Look up drug pairs named in the query in the DDInter index before searching
+    with stage("ddinter_lookup"):
+        known_interactions = await asyncio.to_thread(find_known_interactions, ddinter)
+    reply = {"query": query_text, "known_interactions": known_interactions, "sources": [], "response": None, "cached": False,
+             "time_to_first_token": None}
+    if verbose:
+        for line in known_interactions:
+            print(line)
+    if ddinter_only:
+        if verbose and not known_interactions:
+            print("No pair of DDInter drugs found in the query.")
+        return reply
+
+    # Embed the query while the DB is opened.
+    if embedding_function is None:
+        embedding_function = cached(get_embeddings(embedder))
+
+    def embed():
+        with stage("embed_query"):
+            return embedding_function.embed_query(query_text)
+
+    if db is None:
+        query_embedding, db = await asyncio.gather(asyncio.to_thread(embed), asyncio.to_thread(open_chroma, embedding_function))
+    else:
+        query_embedding = await asyncio.to_thread(embed)
 
     # Search the DB.
-    results = db.similarity_search_with_relevance_scores(query_text, k=5)
-    if len(results) == 0 or results[0][1] < 0.7:
-        print(f"\n\nUnable to find matching results.")
-        return
-
-    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
-    print(prompt)
-
-    model = ChatOpenAI()
-    response_text = model.predict(prompt)
-
-    sources = [doc.metadata.get("source", None) for doc, _score in results]
-    formatted_response = f"Response: {response_text}\nSources: {sources}"
-    print(formatted_response)
+    with stage("retrieve"):
+        (results,) = await asyncio.to_thread(search_batch, db, [query_embedding], top_k)
+    reply["sources"] = [{"url": doc.metadata.get("source", None), "score": float(score)} for doc, score in results]
+    if len(results) == 0 or results[0][1] < MIN_SCORE:
+        if verbose:
+            print(f"\n\nUnable to find matching results.")
+        return reply
+
+    with stage("build_prompt"):
+        prompt, reply["sources"] = build_prompt_with_sources(query_text, results, known_interactions)
+    count("prompt_characters", len(prompt))
+    if verbose:
+        print(prompt)
+
+    # Reuse the answer of a similar question asked with the same context, or stream a new one
+    if answers is None:
+        answers = AnswerCache()
+    context = context_key("chroma", context_ids(results), known_interactions)
+    if verbose and on_token is not None:
+        print("Response: ", end="", flush=True)
+    reply["response"], reply["cached"], reply["time_to_first_token"] = await cached_or_streamed(
+        answers, ChatOpenAI(stream_usage=True), prompt, query_text, query_embedding, context, on_token
+    )
+
+    if verbose:
+        sources = [source["url"] for source in reply["sources"]]
+        print(f"\nSources: {sources}" if on_token is not None else f"Response: {reply['response']}\nSources: {sources}")
+        if reply["time_to_first_token"] is not None:
+            print(f"Time to first token: {reply['time_to_first_token']:.2f}s")
+        print(f"Answer cache: {answers.stats()}")
+    return reply
+
+
+def answer_questions(questions, output=DEFAULT_OUTPUT, concurrency=DEFAULT_CONCURRENCY, ddinter_only=False, embedder=None):
+    """
+    Batch mode: run the RAG pipeline for every question (see batch_query.py) and write the answers as JSON lines.
+    """
+    from langchain_openai import ChatOpenAI
+    from embedding_cache import cached
+
+    embedding_function = cached(get_embeddings(embedder))
+    db = open_chroma(embedding_function)
+
+    def retrieve_batch(_questions, query_embeddings):
+        return [
+            (results, [{"url": doc.metadata.get("source", None), "score": float(score)} for doc, score in results], context_ids(results))
+            for results in search_batch(db, query_embeddings, k=5)
+        ]
+
+    replies = answer_batch(questions, "chroma", embedding_function, retrieve_batch, build_prompt_with_sources, ChatOpenAI(), MIN_SCORE,
+                           concurrency=concurrency, ddinter_only=ddinter_only)
+    write_replies(replies, output)
+
+
+def open_chroma(embedding_function):
+    """
+    Open the persisted Chroma DB, rejecting it if it was built with another embedding model.
+    """
+    from langchain_community.vectorstores import Chroma
+
+    with stage("open_chroma"):
+        db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+    check_embedder(chroma_embedder(db), embedding_function, what="Chroma DB")
+    return db
+
+
+def search_batch(db, query_embeddings, k=5):
+    """
+    similarity_search_with_relevance_scores for several embedded queries, with a single Chroma query.
+    """
+    from langchain_core.documents import Document
+
+    results = db._collection.query(query_embeddings=query_embeddings, n_results=k, include=["documents", "metadatas", "distances"])
+    relevance = db._select_relevance_score_fn()
+    return [
+        [
+            (Document(page_content=text, metadata=metadata or {}), relevance(distance))
+            for text, metadata, distance in zip(texts, metadatas, distances)
+        ]
+        for texts, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])
+    ]
+
+
+def chroma_embedder(db):
+    """
+    Model recorded when the Chroma DB was created (see Langchain_v2_create_database.save_to_chroma), or None.
+    """
+    return (db._collection.metadata or {}).get("embedder")
+
+
+def context_ids(results):
+    """
+    Identify the retrieved chunks by source and content, since Chroma results do not always carry their ids.
+    """
+    return [(doc.metadata.get("source", None), doc.page_content) for doc, _score in results]
+
+
+def build_prompt(query_text, results, known_interactions=()):
+    """
+    Format the RAG prompt from the retrieved (doc, score) results and any known DDInter interactions.
+    Overlapping chunks of the same page are merged and the context is cut to the token budget (see context_packing.py).
+    """
+    return build_prompt_with_sources(query_text, results, known_interactions)[0]
+
+
+def build_prompt_with_sources(query_text, results, known_interactions=()):
+    """
+    build_prompt, also returning the sources ({"url", "score"} dicts) of the results whose text is in the prompt,
+    leaving out those the context packing dropped.
+    """
+    from context_packing import pack_context
+
+    groups = [(doc.metadata.get("source"), doc.metadata.get("page")) for doc, _score in results]
+    passages = pack_context([(doc.page_content, group, score) for (doc, score), group in zip(results, groups)])
+    context_text = "\n\n---\n\n".join([text for text, _group in passages])
+    if known_interactions:
+        context_text = f"{' '.join(known_interactions)}\n\n---\n\n{context_text}"
+    packed = {group for _text, group in passages}
+    sources = [{"url": group[0], "score": float(score)} for group, (_doc, score) in zip(groups, results) if group in packed]
+    return PROMPT_TEMPLATE.format(context=context_text, question=query_text), sources
 
 
 if __name__ == "__main__":
@@ -1,12 +1,15 @@
 import argparse
-from pymongo import MongoClient
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-import os
+import asyncio
 from dotenv import load_dotenv
-import numpy as np
-import openai
+from embedders import DEFAULT_EMBEDDER, EMBEDDERS, check_embedder, get_embeddings
+from instrumentation import count, profile, report, stage
+from batch_query import DEFAULT_CONCURRENCY, DEFAULT_OUTPUT, answer_batch, read_questions, write_replies
+from streaming import print_token
 
+# langchain, pymongo and numpy take seconds to import, so they are imported by the functions that use them,
+# after the arguments have been parsed (see check_import_time.py).
+
+# Load environment variables (OPENAI_API_KEY is read from them by langchain_openai)
 load_dotenv()
 
 # MongoDB connection details
@@ -14,7 +17,10 @@ MONGO_URI = "mongodb://localhost:27017"
 DB_NAME = "DrugWise"
 COLLECTION_NAME = "document_embeddings"
 
-openai.api_key = os.environ['OPENAI_API_KEY']
+DDINTER_URL = "https://ddinter.scbdd.com"
+
+# Minimum similarity of the best match for the LLM to be called
+MIN_SCORE = 0.5
 
 PROMPT_TEMPLATE = """
 You are an expert assistant specializing in drug-drug interactions (DDIs). Your role is to provide accurate, concise, and clinically relevant answers to user queries based on the provided context. You must only use the information retrieved from the context to answer the question and avoid adding any external knowledge or assumptions. Your answers should be clear, actionable, and focused on addressing the user's query.
@@ -32,64 +38,302 @@ Answer the question based on the above context returning the respective full url
 def main():        
     # Create CLI.
     parser = argparse.ArgumentParser()
-    parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("query_text", type=str, nargs="?", help="The query text.")
+    parser.add_argument("--ddinter-only", action="store_true", help="Only report the DDInter interactions between drugs named in the query.")
+    parser.add_argument("--embedder", type=str, default=DEFAULT_EMBEDDER, choices=EMBEDDERS, help="Embedding backend; must match the one used for ingestion.")
+    parser.add_argument("--batch", type=str, default=None, help="Answer every question in this file (- for stdin) instead of query_text.")
+    parser.add_argument("--output", type=str, default=DEFAULT_OUTPUT, help="JSONL file the batch answers are written to (- for stdout).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Maximum number of concurrent LLM calls in batch mode.")
+    parser.add_argument("--stream", action="store_true", help="Print the response as it is generated, and the time to its first token.")
     args = parser.parse_args()
-    query_text = args.query_text
+    if (args.query_text is None) == (args.batch is None):
+        parser.error("Pass either query_text or --batch.")
+
+    if args.batch:
+        with profile(), stage("batch_query", backend="mongodb"):
+            answer_questions(read_questions(args.batch), output=args.output, concurrency=args.concurrency,
+                             ddinter_only=args.ddinter_only, embedder=args.embedder)
+    else:
+        with profile(), stage("query", backend="mongodb"):
+            answer_query(args.query_text, args.ddinter_only, embedder=args.embedder, stream=args.stream)
+    report()
+
+
+def answer_query(query_text, ddinter_only=False, embedder=None, stream=False):
+    """
+    Run the RAG pipeline for one query and print the retrieved documents and the answer.
+    With stream=True the answer is printed as it is generated.
+    """
+    asyncio.run(answer_query_async(query_text, ddinter_only, embedder, on_token=print_token if stream else None, verbose=True))
+
+
+async def answer_query_async(query_text, ddinter_only=False, embedder=None, on_token=None, verbose=False,
+                             embedding_function=None, answers=None, ddinter=None, collection=None, mongo_uri=None, top_k=5):
+    """
+    Coroutine running the RAG pipeline for one query, for use from asyncio code.
+    The query is embedded while MongoDB is connected and the vector index loaded, and the response is streamed.
+    :param on_token: callable: called with each piece of the response as it is generated (see streaming.py).
+    :param verbose: bool: print the progress like the command line does.
+    :param embedding_function: Embeddings: cached embedder to reuse across queries (default: a new cached(get_embeddings(embedder))).
+    :param answers: AnswerCache: answer cache to reuse across queries (default: a new AnswerCache()).
+    :param ddinter: DDInterIndex: DDInter index to reuse across queries (default: loaded for this query).
+    :param collection: Collection: MongoDB collection to reuse across queries (default: a connection to MONGO_URI,
+                       opened for this query and closed once it is answered).
+    :param mongo_uri: string: URI the collection was opened with, letting a search without vector index scan it
+                      with worker processes (see scan_collection).
+    :param top_k: int: number of documents to retrieve.
+    :return: dict: the query, the known DDInter interactions, the retrieved sources, the response (None when nothing
+             relevant was retrieved), whether it came from the answer cache and the seconds to its first token.
+    """
+    from pymongo import MongoClient
+    from embedding_cache import cached
+
+    # Look up drug pairs named in the query in the DDInter index before searching
+    with stage("ddinter_lookup"):
+        known_interactions = await asyncio.to_thread(find_known_interactions, query_text, ddinter)
+    reply = {"query": query_text, "known_interactions": known_interactions, "sources": [], "response": None, "cached": False,
+             "time_to_first_token": None}
+    if verbose:
+        for line in known_interactions:
+            print(line)
+    if ddinter_only:
+        if verbose and not known_interactions:
+            print("No pair of DDInter drugs found in the query.")
+        return reply
 
     # Prepare the embedding function
-    embedding_function = OpenAIEmbeddings()
+    if embedding_function is None:
+        embedding_function = cached(get_embeddings(embedder))
+
+    if collection is not None:
+        return await retrieve_and_answer(reply, collection, embedding_function, answers, on_token, verbose, mongo_uri=mongo_uri,
+                                         top_k=top_k)
+    client = MongoClient(MONGO_URI)
+    try:
+        return await retrieve_and_answer(reply, client[DB_NAME][COLLECTION_NAME], embedding_function, answers, on_token, verbose,
+                                         ping=True, mongo_uri=MONGO_URI, top_k=top_k)
+    finally:
+        client.close()
+
+
+async def retrieve_and_answer(reply, collection, embedding_function, answers=None, on_token=None, verbose=False, ping=False,
+                              mongo_uri=None, top_k=5):
+    """
+    The rest of answer_query_async once the collection is known: retrieval, prompt and response, filled into reply.
+    :param ping: bool: check the connection (while the query is embedded) before searching.
+    :param mongo_uri: string: URI the collection was opened with (see scan_collection).
+    """
+    from langchain_openai import ChatOpenAI
+    from answer_cache import AnswerCache, context_key
+    from streaming import cached_or_streamed
+    from vector_index import load_index
+
+    query_text = reply["query"]
+    known_interactions = reply["known_interactions"]
+
+    def embed():
+        with stage("embed_query"):
+            return embedding_function.embed_query(query_text)
 
-    # Generate embedding for the query
-    query_embedding = embedding_function.embed_query(query_text)
+    def connect():
+        with stage("connect"):
+            if ping:
+                collection.database.client.admin.command("ping")
+            load_index()
+
+    # Generate the embedding for the query while connecting to MongoDB and loading the vector index
+    query_embedding, _ = await asyncio.gather(asyncio.to_thread(embed), asyncio.to_thread(connect))
+    if verbose:
+        print(f"Embedding cache: {embedding_function.stats()}")
 
     # Search the MongoDB database
-    results = query_mongodb(query_embedding, top_k=5)
-    if len(results) == 0 or results[0][1] < 0.5:
-        print(f"\n\nUnable to find matching results.")
-        return
+    with stage("retrieve"):
+        results = await asyncio.to_thread(query_mongodb, query_embedding, top_k, collection, embedding_function, mongo_uri)
+    reply["sources"] = [{"url": document_url(doc), "score": float(score)} for doc, score in results]
+    if len(results) == 0 or results[0][1] < MIN_SCORE:
+        if verbose:
+            print(f"\n\nUnable to find matching results.")
+        return reply
+
+    if verbose:
+        for i, (doc, score) in enumerate(results):
+            print(f"{i+1}. Document ID: {document_url(doc)}, Similarity Score: {score:.4f}")
+
+    # Prepare the prompt
+    with stage("build_prompt"):
+        prompt, reply["sources"] = build_prompt_with_sources(query_text, results, known_interactions)
+    count("prompt_characters", len(prompt))
+    if verbose:
+        print(prompt)
+
+    # Stream the response from ChatOpenAI, unless a similar question was answered from the same context
+    if answers is None:
+        answers = AnswerCache()
+    context = context_key("mongodb", [str(doc["_id"]) for doc, _score in results], known_interactions)
+    if verbose and on_token is not None:
+        print("Response: ", end="", flush=True)
+    reply["response"], reply["cached"], reply["time_to_first_token"] = await cached_or_streamed(
+        answers, ChatOpenAI(stream_usage=True), prompt, query_text, query_embedding, context, on_token
+    )
+
+    if verbose:
+        print("" if on_token is not None else f"Response: {reply['response']}")
+        if reply["time_to_first_token"] is not None:
+            print(f"Time to first token: {reply['time_to_first_token']:.2f}s")
+        print(f"Answer cache: {answers.stats()}")
+    return reply
+
+
+def answer_questions(questions, output=DEFAULT_OUTPUT, concurrency=DEFAULT_CONCURRENCY, ddinter_only=False, embedder=None):
+    """
+    Batch mode: run the RAG pipeline for every question (see batch_query.py) and write the answers as JSON lines.
+    """
+    from langchain_openai import ChatOpenAI
+    from pymongo import MongoClient
+    from embedding_cache import cached
+
+    client = MongoClient(MONGO_URI)
+    collection = client[DB_NAME][COLLECTION_NAME]
+    embedding_function = cached(get_embeddings(embedder))
 
-    for i, (doc, score) in enumerate(results):
-        print(f"{i+1}. Document ID: {doc['url']}, Similarity Score: {score:.4f}")
+    def retrieve_batch(_questions, query_embeddings):
+        return [
+            (results, [{"url": document_url(doc), "score": float(score)} for doc, score in results], [str(doc["_id"]) for doc, _score in results])
+            for results in query_mongodb_batch(query_embeddings, top_k=5, collection=collection, embedding_function=embedding_function,
+                                               mongo_uri=MONGO_URI)
+        ]
 
-    # Prepare the context for the prompt
+    replies = answer_batch(questions, "mongodb", embedding_function, retrieve_batch, build_prompt_with_sources, ChatOpenAI(), MIN_SCORE,
+                           concurrency=concurrency, ddinter_only=ddinter_only)
+    write_replies(replies, output)
+
+
+def document_url(doc):
+    """
+    URL of a scraped article, or the source file of a PDF chunk.
+    """
+    return doc.get("url") or doc.get("metadata", {}).get("source")
+
+
+def build_prompt(query_text, results, known_interactions=()):
+    """
+    Format the RAG prompt from the retrieved (doc, score) results and any known DDInter interactions.
+    Overlapping chunks of the same page are merged and the context is cut to the token budget (see context_packing.py).
+    """
+    return build_prompt_with_sources(query_text, results, known_interactions)[0]
+
+
+def build_prompt_with_sources(query_text, results, known_interactions=()):
+    """
+    build_prompt, also returning the sources ({"url", "score"} dicts) of the results whose text is in the prompt,
+    leaving out those the context packing dropped.
+    """
+    from context_packing import pack_context
+
+    groups = [(document_url(doc), doc.get("metadata", {}).get("page")) for doc, _score in results]
+    passages = pack_context([(doc["content"], group, score) for (doc, score), group in zip(results, groups)])
     context_text = "\n\n---\n\n".join(
-    [f"{doc['content']} (Full URL: {doc['url']})" for doc, _score in results]
+    [f"{text} (Full URL: {url})" for text, (url, _page) in passages]
     )
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
-    print(prompt)
+    if known_interactions:
+        context_text = f"{' '.join(known_interactions)} (Full URL: {DDINTER_URL})\n\n---\n\n{context_text}"
+    packed = {group for _text, group in passages}
+    sources = [{"url": group[0], "score": float(score)} for group, (_doc, score) in zip(groups, results) if group in packed]
+    return PROMPT_TEMPLATE.format(context=context_text, question=query_text), sources
 
-    # Generate response using ChatOpenAI
-    model = ChatOpenAI()
-    response_text = model.invoke(prompt)
 
-    print(f"Response: {response_text.content}")
+def find_known_interactions(query_text, ddinter=None):
+    """
+    DDInter interaction levels of every pair of drugs named in the query, one sentence per pair.
+    Pass ddinter to reuse a loaded DDInter index instead of loading it.
+    """
+    if ddinter is None:
+        from ddinter_index import load_ddinter_index
+        ddinter = load_ddinter_index()
+    if ddinter is None:
+        return []
+    return ddinter.describe_pairs(query_text)
 
 
-def query_mongodb(query_embedding, top_k=5):
+def query_mongodb(query_embedding, top_k=5, collection=None, embedding_function=None, mongo_uri=None):
     """
     Query MongoDB for the most similar documents based on the query embedding.
+    Uses the prebuilt vector index when there is one, else streams the collection (see scan_collection); either
+    way only the top_k documents are fetched in full.
+    Pass collection to reuse an existing connection instead of opening a new one, and the embedding_function
+    that embedded the query to reject documents embedded with another model, along with the mongo_uri it was
+    opened with to let a scan use worker processes.
     """
-    # Connect to MongoDB
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
-
-    # Fetch all documents from MongoDB
-    documents = list(collection.find({}))
-
-    # Compute cosine similarity between query embedding and document embeddings
-    similarities = []
-    for doc in documents:
-        doc_embedding = np.array(doc["embedding"])
-        similarity = np.dot(query_embedding, doc_embedding) / (
-            np.linalg.norm(query_embedding) * np.linalg.norm(doc_embedding)
-        )
-        similarities.append((doc, similarity))
-
-    # Sort by similarity and return top_k results
-    similarities = sorted(similarities, key=lambda x: x[1], reverse=True)
-    return similarities[:top_k]
+    from vector_index import load_index
+
+    if collection is None:
+        # Connect to MongoDB
+        from pymongo import MongoClient
+        client = MongoClient(MONGO_URI)
+        db = client[DB_NAME]
+        collection = db[COLLECTION_NAME]
+        mongo_uri = MONGO_URI
+
+    index = load_index()
+    if index is None:
+        print("No vector index found, scanning the whole collection. Run `python vector_index.py` to build one.")
+        hits = scan_collection(collection, [query_embedding], top_k, embedding_function, mongo_uri)[0]
+    else:
+        if embedding_function is not None:
+            check_embedder(index.embedder, embedding_function)
+        # Score every indexed embedding at once
+        hits = index.search(query_embedding, top_k)
+
+    # Fetch only the winners
+    with stage("mongo_fetch"):
+        # The prompt only needs the text and source, so leave the embeddings on the server
+        documents = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": [_id for _id, _score in hits]}}, {"embedding": 0})}
+    return [(documents[_id], score) for _id, score in hits if _id in documents]
+
+
+def query_mongodb_batch(query_embeddings, top_k=5, collection=None, embedding_function=None, mongo_uri=None):
+    """
+    query_mongodb for several query embeddings: one batched index search, then one MongoDB fetch for all the winners.
+    :return: list: the (doc, score) results of each query.
+    """
+    from vector_index import load_index
+
+    if collection is None:
+        from pymongo import MongoClient
+        client = MongoClient(MONGO_URI)
+        collection = client[DB_NAME][COLLECTION_NAME]
+        mongo_uri = MONGO_URI
+
+    index = load_index()
+    if index is None:
+        print("No vector index found, scanning the whole collection. Run `python vector_index.py` to build one.")
+        hits = scan_collection(collection, query_embeddings, top_k, embedding_function, mongo_uri)
+    else:
+        if embedding_function is not None:
+            check_embedder(index.embedder, embedding_function)
+        hits = index.search_batch(query_embeddings, top_k)
+
+    with stage("mongo_fetch"):
+        ids = list({_id for query_hits in hits for _id, _score in query_hits})
+        documents = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": ids}}, {"embedding": 0})}
+    return [[(documents[_id], score) for _id, score in query_hits if _id in documents] for query_hits in hits]
+
+
+def scan_collection(collection, query_embeddings, top_k=5, embedding_function=None, mongo_uri=None):
+    """
+    Exact search when no vector index was built: streams the collection in batches instead of loading it,
+    keeping only the top_k of each query, across worker processes for large collections (see mongo_scan.py).
+    :param mongo_uri: string: URI the collection was opened with, which the worker processes connect to; when it
+                      is not known the collection is scanned in this process.
+    :return: list: the best top_k (_id, score) pairs of each query embedding.
+    """
+    from mongo_scan import scan_top_k
+
+    hits, embedders = scan_top_k(collection, query_embeddings, top_k, mongo_uri=mongo_uri, namespace=collection.full_name)
+    if embedding_function is not None:
+        for embedder in embedders:
+            check_embedder(embedder, embedding_function, what="collection")
+    return hits
 
 
 if __name__ == "__main__":
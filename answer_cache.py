@@ -0,0 +1,157 @@
+"""
+Semantic cache of LLM answers shared by the query scripts and the query service.
+
+An answer is reused when a new query's embedding has a cosine similarity of at least `threshold` with a
+cached query AND the same context was retrieved for it (same documents, same DDInter facts), so a
+rephrased question only hits when the LLM would have been given the same material. Entries are stored
+in a SQLite file in WAL mode, expire after `ttl` seconds, and the least recently used ones are evicted
+past `max_entries`. The ingestion scripts clear the cache whenever the document store is re-ingested.
+
+Environment variables:
+    ANSWER_CACHE_PATH:        location of the SQLite file (default .answer_cache.sqlite3)
+    ANSWER_CACHE_THRESHOLD:   minimum cosine similarity between two queries (default 0.95)
+    ANSWER_CACHE_TTL:         seconds an answer stays valid (default 7 days)
+    ANSWER_CACHE_MAX_ENTRIES: maximum number of cached answers (default 10000)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from instrumentation import count
+
+CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", ".answer_cache.sqlite3")
+DEFAULT_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+DEFAULT_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 7 * 24 * 3600))
+DEFAULT_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 10000))
+
+
+def context_key(*parts):
+    """
+    Key identifying the context given to the LLM, e.g. (backend, retrieved document ids, DDInter facts).
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Disk-backed cache of LLM responses, looked up by query similarity within the same retrieved context.
+    """
+
+    def __init__(self, path=CACHE_PATH, threshold=DEFAULT_THRESHOLD, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY, context TEXT NOT NULL, query TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "response TEXT NOT NULL, latency REAL NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS answers_context ON answers (context)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self._connection.commit()
+
+    def lookup(self, query_embedding, context):
+        """
+        Cached response for a query similar to this one with the same context key, or None.
+        """
+        now = time.time()
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, embedding, response, latency FROM answers WHERE context = ? AND created > ?",
+                (context, now - self.ttl),
+            ).fetchall()
+            best = None
+            for row_id, embedding, response, latency in rows:
+                cached = np.frombuffer(embedding, dtype=np.float32)
+                denominator = norm * np.linalg.norm(cached)
+                similarity = float(np.dot(query, cached) / denominator) if denominator > 0 else 0.0
+                if similarity >= self.threshold and (best is None or similarity > best[0]):
+                    best = (similarity, row_id, response, latency)
+
+            if best is None:
+                self.misses += 1
+                count("answer_cache_misses")
+                return None
+            _similarity, row_id, response, latency = best
+            self._connection.execute("UPDATE answers SET last_used = ? WHERE id = ?", (now, row_id))
+            self._connection.commit()
+            self.hits += 1
+            self.saved_seconds += latency
+            count("answer_cache_hits")
+            count("answer_cache_saved_seconds", latency)
+            return response
+
+    def store(self, query_text, query_embedding, context, response, latency):
+        """
+        Remember the response generated for a query, and how many seconds generating it took.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO answers (context, query, embedding, response, latency, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (context, query_text, np.asarray(query_embedding, dtype=np.float32).tobytes(), response, latency, now, now),
+            )
+            self._connection.execute("DELETE FROM answers WHERE created <= ?", (now - self.ttl,))
+            (entries,) = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()
+            if entries > self.max_entries:
+                # Evict down to 90% of the limit so that eviction does not run on every insert
+                self._connection.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)",
+                    (entries - int(self.max_entries * 0.9),),
+                )
+            self._connection.commit()
+
+    def get_or_generate(self, query_text, query_embedding, context, generate):
+        """
+        Cached response for the query, or the result of generate(), which is then cached.
+        """
+        response = self.lookup(query_embedding, context)
+        if response is None:
+            start = time.perf_counter()
+            response = generate()
+            self.store(query_text, query_embedding, context, response, time.perf_counter() - start)
+        return response
+
+    def clear(self):
+        """
+        Drop every cached answer.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM answers")
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Hit/miss counters of this process and the LLM time the hits saved.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+def invalidate_answers(path=CACHE_PATH):
+    """
+    Clear the answer cache after the document store was re-ingested.
+    """
+    if os.path.exists(path):
+        AnswerCache(path).clear()
+        print("Cleared the answer cache.")
@@ -0,0 +1,138 @@
+"""
+Batch mode of the query scripts: answer a whole file of questions in one process.
+
+All questions are embedded with one embed_documents call and retrieved together (one matrix-matrix product
+over the vector index, or one batched Chroma query). The LLM calls for the questions that are not in the answer
+cache are then dispatched concurrently, at most `concurrency` at a time, so the total wall time is close to
+that of the slowest LLM call rather than the sum of all of them.
+
+One JSON line per question is written in input order:
+    {"query": ..., "known_interactions": [...], "sources": [{"url": ..., "score": ...}], "response": ..., "cached": false}
+response is null when nothing relevant was retrieved, and an "error" key is added when the LLM call failed.
+
+Environment variables:
+    BATCH_QUERY_CONCURRENCY: default maximum number of concurrent LLM calls (default 8)
+
+Usage:
+    python Langchain_v2_query_data_mongodb.py --batch evaluation_prompts.txt --output answers.jsonl
+    cat questions.txt | python Langchain_v2_query_data_chroma.py --batch - --concurrency 4
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+from instrumentation import count, count_llm_usage, stage
+
+DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_QUERY_CONCURRENCY", 8))
+DEFAULT_OUTPUT = "answers.jsonl"
+
+
+def read_questions(path):
+    """
+    Questions in path ("-" for stdin), one per line. In files like evaluation_prompts.txt, where the
+    questions are quoted between unquoted section headings, only the quoted lines are used.
+    """
+    if path == "-":
+        lines = [line.strip() for line in sys.stdin]
+    else:
+        with open(path) as file:
+            lines = [line.strip() for line in file]
+    quoted = [line.strip('"') for line in lines if line.startswith('"')]
+    return quoted or [line for line in lines if line]
+
+
+async def generate_all(model, prompts, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Call the chat model on every prompt, at most concurrency at a time.
+    :return: list: (response text, seconds) per prompt, or the exception raised by its call.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate_one(prompt):
+        async with semaphore:
+            start = time.perf_counter()
+            with stage("llm"):
+                response = await model.ainvoke(prompt)
+            count_llm_usage(response)
+            return response.content, time.perf_counter() - start
+
+    return await asyncio.gather(*(generate_one(prompt) for prompt in prompts), return_exceptions=True)
+
+
+def answer_batch(questions, backend, embedding_function, retrieve_batch, build_prompt, model, min_score,
+                 concurrency=DEFAULT_CONCURRENCY, ddinter_only=False):
+    """
+    Run the RAG pipeline of one backend for every question.
+    :param retrieve_batch: callable: (questions, query embeddings) -> list of (results, sources, context ids) per question,
+                           where results are (doc, score) pairs, best first.
+    :param build_prompt: callable: (question, results, known interactions) -> (prompt, sources of the results whose
+                         text is in the prompt), which replace the retrieved sources in the reply.
+    :param min_score: float: questions whose best result scores lower are not sent to the LLM.
+    :return: list: one reply dict per question, in order.
+    """
+    from answer_cache import AnswerCache, context_key
+    from ddinter_index import load_ddinter_index
+
+    with stage("ddinter_lookup"):
+        ddinter = load_ddinter_index()
+        known = [ddinter.describe_pairs(question) if ddinter is not None else [] for question in questions]
+    replies = [
+        {"query": question, "known_interactions": known_interactions, "sources": [], "response": None, "cached": False}
+        for question, known_interactions in zip(questions, known)
+    ]
+    if ddinter_only or not questions:
+        return replies
+
+    with stage("embed_queries"):
+        query_embeddings = embedding_function.embed_documents(questions)
+    with stage("retrieve"):
+        retrieved = retrieve_batch(questions, query_embeddings)
+
+    # Serve what we can from the answer cache and build the prompts of the rest
+    answers = AnswerCache()
+    pending = []
+    for i, (results, sources, ids) in enumerate(retrieved):
+        replies[i]["sources"] = sources
+        if len(results) == 0 or results[0][1] < min_score:
+            continue
+        with stage("build_prompt"):
+            prompt, replies[i]["sources"] = build_prompt(questions[i], results, known[i])
+        context = context_key(backend, ids, known[i])
+        response = answers.lookup(query_embeddings[i], context)
+        if response is not None:
+            replies[i].update(response=response, cached=True)
+            continue
+        count("prompt_characters", len(prompt))
+        pending.append((i, context, prompt))
+
+    print(f"{len(questions)} questions: {len(pending)} sent to the LLM, {sum(reply['cached'] for reply in replies)} from the answer cache.")
+    start = time.perf_counter()
+    with stage("generate_all"):
+        generated = asyncio.run(generate_all(model, [prompt for _i, _context, prompt in pending], concurrency))
+    if pending:
+        print(f"Generated {len(pending)} answers in {time.perf_counter() - start:.1f}s.")
+
+    for (i, context, _prompt), result in zip(pending, generated):
+        if isinstance(result, Exception):
+            replies[i]["error"] = f"{type(result).__name__}: {result}"
+            count("llm_errors")
+            continue
+        replies[i]["response"], latency = result
+        answers.store(questions[i], query_embeddings[i], context, replies[i]["response"], latency)
+    print(f"Answer cache: {answers.stats()}")
+    return replies
+
+
+def write_replies(replies, output=DEFAULT_OUTPUT):
+    """
+    Write one JSON line per reply to output ("-" for stdout).
+    """
+    lines = "".join(json.dumps(reply, default=str) + "\n" for reply in replies)
+    if output == "-":
+        sys.stdout.write(lines)
+        return
+    with open(output, "w") as file:
+        file.write(lines)
+    print(f"Wrote {len(replies)} answers to {output}.")
@@ -0,0 +1,505 @@
+"""
+Offline benchmark of the ingestion and query pipelines.
+
+Runs the real pipeline code with deterministic local stand-ins for the external services:
+    FakeEmbeddings: hashed bag-of-words vectors instead of OpenAIEmbeddings
+    FakeChat:       canned answers instead of ChatOpenAI
+    FakeEncoding:   one token per word instead of the tiktoken encoding, whose vocabulary is downloaded on first use
+    mongomock:      in-process MongoDB (or a real server with --mongo-uri). mongomock has no indexes, so its
+                    lookups and upserts scan the collection; use --mongo-uri for numbers that match production.
+Article pages missing from the CSV are served locally instead of being fetched from PubMed.
+
+Corpora:
+    synthetic-<n>: n generated chunks (save_to_mongodb), n generated articles (process_csv_and_store_embeddings)
+                   and, when chromadb is installed, the same chunks in Chroma
+    pdf:           the PDFs in corpus/pdf through generate_data_store
+    pubmed:        articles.csv through process_csv_and_store_embeddings
+Every corpus is then queried (query_mongodb, and the Chroma query path) with the questions in
+evaluation_prompts.txt. Each stage reports throughput, p50/p95/p99 latency and peak RSS, and the results are
+written as JSON, together with the instrumentation timers and counters, that can be compared against a
+saved baseline.
+
+Usage:
+    python benchmark.py                                       # 1k/10k/100k synthetic chunks plus the real corpora
+    python benchmark.py --sizes 1000 --no-real --output bench.json
+    python benchmark.py --baseline bench.json                 # compare with a previous run
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+PROMPTS_PATH = os.path.join(REPO_PATH, "evaluation_prompts.txt")
+PDF_PATH = os.path.join(REPO_PATH, "corpus", "pdf")
+ARTICLES_PATH = os.path.join(REPO_PATH, "articles.csv")
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_DIM = 128
+DEFAULT_REPEAT = 4
+DEFAULT_TOLERANCE = 0.10
+SEED = 1234
+
+sys.path.insert(0, REPO_PATH)
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+
+from instrumentation import snapshot
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic embeddings: L2-normalised hashed bag of words, so texts sharing words are similar.
+    """
+
+    def __init__(self, dim=DEFAULT_DIM):
+        self.dim = dim
+        self.model = f"fake-{dim}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            code = zlib.crc32(word.encode("utf-8"))
+            vector[code % self.dim] += 1.0 if code & 1 << 31 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChat:
+    """
+    Deterministic stand-in for ChatOpenAI.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _answer(self, prompt):
+        return f"Offline answer based on {len(str(prompt))} characters of context."
+
+    def invoke(self, prompt):
+        return FakeMessage(self._answer(prompt))
+
+    async def ainvoke(self, prompt):
+        return FakeMessage(self._answer(prompt))
+
+    def predict(self, prompt):
+        return self._answer(prompt)
+
+
+class FakeEncoding:
+    """
+    Stand-in for the tiktoken encoding: one token per word, with its trailing whitespace.
+    """
+
+    def encode(self, text, **kwargs):
+        return re.findall(r"\S+\s*|\s+", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def mongo_substitute():
+    """
+    In-process mongomock client. Newer pymongo passes a sort argument to bulk updates that mongomock
+    does not accept yet, so it is dropped here.
+    """
+    import mongomock
+    from mongomock.collection import BulkOperationBuilder
+
+    if not getattr(BulkOperationBuilder.add_update, "_accepts_sort", False):
+        add_update = BulkOperationBuilder.add_update
+
+        def add_update_without_sort(self, *args, sort=None, **kwargs):
+            return add_update(self, *args, **kwargs)
+
+        add_update_without_sort._accepts_sort = True
+        BulkOperationBuilder.add_update = add_update_without_sort
+    return mongomock.MongoClient()
+
+
+async def fetch_offline(urls, concurrency=None):
+    """
+    Local replacement for fetch_article_contents: a deterministic abstract per URL.
+    """
+    return {url: f"Offline abstract of {url} describing drug-drug interactions." for url in urls}
+
+
+def load_evaluation_prompts(path=PROMPTS_PATH):
+    """
+    The quoted questions in evaluation_prompts.txt.
+    """
+    with open(path) as file:
+        return [line.strip().strip('"') for line in file if line.strip().startswith('"')]
+
+
+def vocabulary(prompts):
+    words = sorted({word for prompt in prompts for word in re.findall(r"[a-z]{3,}", prompt.lower())})
+    return words + [f"term{i}" for i in range(2000)]
+
+
+def synthetic_text(rng, words, num_words):
+    return " ".join(rng.choice(words) for _ in range(num_words))
+
+
+def synthetic_chunks(size, words, seed=SEED):
+    """
+    size PDF-like chunks of about 150 words, spread over size // 50 source files.
+    """
+    rng = random.Random(seed)
+    return [
+        Document(
+            page_content=synthetic_text(rng, words, 150),
+            metadata={"source": f"synthetic/{i // 50}.pdf", "page": i % 50},
+        )
+        for i in range(size)
+    ]
+
+
+def synthetic_articles(path, size, words, seed=SEED):
+    """
+    Write a scraper-style CSV of size articles; every tenth one has no abstract and has to be fetched.
+    """
+    import pandas as pd
+
+    rng = random.Random(seed)
+    pd.DataFrame({
+        "title": [synthetic_text(rng, words, 12) for _ in range(size)],
+        "abstract": [synthetic_text(rng, words, 200) if i % 10 else "NO_ABSTRACT" for i in range(size)],
+        "url": [f"https://pubmed.ncbi.nlm.nih.gov/{10000000 + i}/" for i in range(size)],
+    }).to_csv(path)
+
+
+class PeakRSS:
+    """
+    Sample the resident set size in a background thread while a stage runs.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # ru_maxrss is the peak of the whole process, in KB on Linux and bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def summarize(items, seconds, latencies, peak_rss):
+    """
+    Metrics of one stage. Latencies are per item (query) in milliseconds.
+    """
+    metrics = {
+        "items": items,
+        "seconds": round(seconds, 4),
+        "throughput": round(items / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(peak_rss / 2 ** 20, 1),
+    }
+    if latencies:
+        p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+        metrics.update({"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3)})
+    return metrics
+
+
+def run_stage(name, function):
+    """
+    Run function(), which returns (items, per-item latencies), and measure it.
+    """
+    print(f"--- {name}")
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        items, latencies = function()
+        seconds = time.perf_counter() - start
+    metrics = summarize(items, seconds, latencies, rss.peak)
+    print(f"--- {name}: {json.dumps(metrics, sort_keys=True)}")
+    return metrics
+
+
+class Benchmark:
+    """
+    Runs the pipelines against the offline stand-ins, with a fresh database and work directory per corpus.
+    """
+
+    def __init__(self, prompts, work_path, dim=DEFAULT_DIM, repeat=DEFAULT_REPEAT, mongo_uri=None, workers=1):
+        self.prompts = prompts
+        self.work_path = work_path
+        self.dim = dim
+        self.repeat = repeat
+        self.mongo_uri = mongo_uri
+        self.workers = workers
+        self.words = vocabulary(prompts)
+
+        # Imported here rather than with the module, as the caches read their paths (set by main) on import
+        import Langchain_v2_create_database as create_database
+        import Langchain_v2_create_database_webscrape as create_database_webscrape
+        import Langchain_v2_query_data_chroma as chroma_query
+        import Langchain_v2_query_data_mongodb as mongodb_query
+        import context_packing
+
+        self.create_database = create_database
+        self.create_database_webscrape = create_database_webscrape
+        self.chroma_query = chroma_query
+        self.mongodb_query = mongodb_query
+
+        # Point the pipeline modules at the stand-ins. The MongoDB collection is passed to every pipeline call,
+        # and the chat model is only ever a FakeChat, so no real client is created.
+        for module in (create_database, create_database_webscrape, mongodb_query, chroma_query):
+            module.get_embeddings = lambda *args, **kwargs: FakeEmbeddings(dim)
+        context_packing.get_encoding = FakeEncoding
+        create_database.DATA_PATH = PDF_PATH
+        create_database_webscrape.fetch_article_contents = fetch_offline
+
+    def setup(self, corpus):
+        """
+        Start a corpus with a clean database and directory.
+        """
+        work_path = os.path.join(self.work_path, corpus)
+        os.makedirs(work_path, exist_ok=True)
+        os.chdir(work_path)
+
+        if self.mongo_uri:
+            from pymongo import MongoClient
+            client = MongoClient(self.mongo_uri)
+            client.drop_database(self.mongodb_query.DB_NAME)
+        else:
+            client = mongo_substitute()
+        self.collection = client[self.mongodb_query.DB_NAME][self.mongodb_query.COLLECTION_NAME]
+
+    def query_workload(self):
+        return [prompt for _ in range(self.repeat) for prompt in self.prompts]
+
+    def query_mongodb(self):
+        embeddings = FakeEmbeddings(self.dim)
+        model = FakeChat()
+        latencies = []
+        for query_text in self.query_workload():
+            start = time.perf_counter()
+            results = self.mongodb_query.query_mongodb(embeddings.embed_query(query_text), top_k=5, collection=self.collection)
+            model.invoke(self.mongodb_query.build_prompt(query_text, results))
+            latencies.append(time.perf_counter() - start)
+        return len(latencies), latencies
+
+    def query_chroma(self, db):
+        model = FakeChat()
+        latencies = []
+        for query_text in self.query_workload():
+            start = time.perf_counter()
+            results = db.similarity_search_with_relevance_scores(query_text, k=5)
+            model.predict(self.chroma_query.build_prompt(query_text, results))
+            latencies.append(time.perf_counter() - start)
+        return len(latencies), latencies
+
+    def chroma_stages(self, chunks):
+        try:
+            import chromadb  # noqa: F401
+        except ImportError:
+            print("--- chromadb is not installed, skipping the Chroma stages.")
+            return {"chroma": {"skipped": "chromadb not installed"}}
+
+        from langchain_community.vectorstores import Chroma
+        stages = {}
+        db = None
+
+        def ingest():
+            nonlocal db
+            db = Chroma.from_documents(chunks, FakeEmbeddings(self.dim), persist_directory=os.path.join(os.getcwd(), "chroma"))
+            return len(chunks), []
+
+        stages["ingest_chroma"] = run_stage("ingest_chroma", ingest)
+        stages["query_chroma"] = run_stage("query_chroma", lambda: self.query_chroma(db))
+        return stages
+
+    def synthetic(self, size):
+        chunks = synthetic_chunks(size, self.words)
+        stages = {}
+
+        self.setup(f"synthetic-{size}")
+        # Source files only need to exist so that their hashes can be recorded
+        os.makedirs("synthetic", exist_ok=True)
+        for source in {chunk.metadata["source"] for chunk in chunks}:
+            with open(source, "w") as file:
+                file.write(source)
+
+        def ingest_chunks():
+            self.create_database.save_to_mongodb(chunks, collection=self.collection)
+            return self.collection.count_documents({}), []
+
+        stages["ingest_mongodb"] = run_stage("ingest_mongodb", ingest_chunks)
+        stages["query_mongodb"] = run_stage("query_mongodb", self.query_mongodb)
+        stages.update(self.chroma_stages(chunks))
+
+        self.setup(f"synthetic-{size}-articles")
+        csv_file = os.path.join(os.getcwd(), "articles.csv")
+        synthetic_articles(csv_file, size, self.words)
+
+        def ingest_articles():
+            self.create_database_webscrape.process_csv_and_store_embeddings(csv_file, collection=self.collection)
+            return self.collection.count_documents({}), []
+
+        stages["ingest_webscrape"] = run_stage("ingest_webscrape", ingest_articles)
+        return stages
+
+    def pdf(self):
+        self.setup("pdf")
+
+        def ingest():
+            self.create_database.generate_data_store(workers=self.workers, collection=self.collection)
+            return self.collection.count_documents({}), []
+
+        return {
+            "ingest_pdf": run_stage("ingest_pdf", ingest),
+            "query_mongodb": run_stage("query_mongodb", self.query_mongodb),
+        }
+
+    def pubmed(self):
+        self.setup("pubmed")
+
+        def ingest():
+            self.create_database_webscrape.process_csv_and_store_embeddings(ARTICLES_PATH, collection=self.collection)
+            return self.collection.count_documents({}), []
+
+        return {
+            "ingest_webscrape": run_stage("ingest_webscrape", ingest),
+            "query_mongodb": run_stage("query_mongodb", self.query_mongodb),
+        }
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+# Metrics compared with the baseline, and whether higher values are better
+COMPARED_METRICS = {"throughput": True, "p50_ms": False, "p95_ms": False, "p99_ms": False, "peak_rss_mb": False}
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print the relative change of every metric against the baseline run.
+    :return: int: number of metrics that got worse by more than tolerance.
+    """
+    regressions = 0
+    for corpus, stages in sorted(results["corpora"].items()):
+        for stage, metrics in sorted(stages.items()):
+            old_metrics = baseline.get("corpora", {}).get(corpus, {}).get(stage)
+            if not old_metrics:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                old, new = old_metrics.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = -change if higher_is_better else change
+                flag = ""
+                if worse > tolerance:
+                    flag = "  REGRESSION"
+                    regressions += 1
+                elif -worse > tolerance:
+                    flag = "  improved"
+                print(f"{corpus}/{stage} {metric}: {old} -> {new} ({change:+.1%}){flag}")
+    print(f"{regressions} regressions beyond {tolerance:.0%}.")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the ingestion and query pipelines.")
+    parser.add_argument("--sizes", type=str, default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated synthetic corpus sizes, in chunks.")
+    parser.add_argument("--no-real", action="store_true", help="Skip the real PDF and PubMed corpora.")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Dimension of the fake embeddings.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Number of passes over the evaluation prompts per query stage.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes parsing the PDFs of the real corpus.")
+    parser.add_argument("--mongo-uri", type=str, default=None, help="Benchmark against this MongoDB server instead of mongomock (its DrugWise database is dropped).")
+    parser.add_argument("--output", type=str, default="bench_results.json", help="File the JSON results are written to.")
+    parser.add_argument("--baseline", type=str, default=None, help="Results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative change counted as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if any metric regressed.")
+    args = parser.parse_args()
+
+    # Keep every file the pipelines write (caches, vector index, Chroma DB) out of the working tree
+    work_path = tempfile.mkdtemp(prefix="drugwise-bench-")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(work_path, "embedding_cache.sqlite3")
+    os.environ["ANSWER_CACHE_PATH"] = os.path.join(work_path, "answer_cache.sqlite3")
+    os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+
+    prompts = load_evaluation_prompts()
+    benchmark = Benchmark(prompts, work_path, dim=args.dim, repeat=args.repeat, mongo_uri=args.mongo_uri, workers=args.workers)
+
+    corpora = {}
+    try:
+        for size in [int(size) for size in args.sizes.split(",") if size]:
+            corpora[f"synthetic-{size}"] = benchmark.synthetic(size)
+        if not args.no_real:
+            corpora["pdf"] = benchmark.pdf()
+            corpora["pubmed"] = benchmark.pubmed()
+    finally:
+        os.chdir(REPO_PATH)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    results = {
+        "config": {"sizes": args.sizes, "dim": args.dim, "repeat": args.repeat, "queries": len(prompts) * args.repeat,
+                   "seed": SEED, "mongo": "server" if args.mongo_uri else "mongomock"},
+        "environment": environment(),
+        "corpora": corpora,
+        # Per-stage timers and counters of the whole run, to see where each pipeline spends its time
+        "instrumentation": snapshot(),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print(f"Wrote benchmark results to {args.output}.")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Import-time regression check for the query command lines.
+
+Each module is imported in a fresh interpreter with `python -X importtime`. The check fails if its cumulative
+import time is over budget, or if it pulls in one of the heavy dependencies (langchain, pymongo, numpy, ...)
+that the query scripts only import on the code paths that need them. Run it after changing imports:
+
+    python check_import_time.py
+    python check_import_time.py --repeat 5 --show 15
+
+Exits with status 1 when a module fails, so it can run in CI.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Cumulative import time budgets in milliseconds (about 70ms each when measured, langchain alone takes seconds)
+BUDGETS_MS = {
+    "Langchain_v2_query_data_mongodb": 300,
+    "Langchain_v2_query_data_chroma": 300,
+    "batch_query": 250,
+    "query_client": 150,
+}
+
+# Top-level packages that must not be imported before the arguments are parsed
+HEAVY_MODULES = {
+    "langchain", "langchain_core", "langchain_community", "langchain_openai", "openai",
+    "pymongo", "chromadb", "numpy", "pandas", "torch", "sentence_transformers",
+}
+
+
+def measure(module):
+    """
+    Import module in a fresh interpreter.
+    :return: tuple: (cumulative import time in ms, {imported module: cumulative ms}).
+    """
+    env = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "check-import-time")}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    # The report is a post-order tree, so the imports of module are the lines since the previous top-level import
+    # (interpreter startup such as site comes first)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        imports[name.strip()] = int(cumulative_us) / 1000
+        if name.strip() == module:
+            break
+        if not name[1:].startswith(" "):
+            imports = {}
+    return imports.get(module, 0.0), imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS_MS), help="Modules to check (default: the query command lines).")
+    parser.add_argument("--repeat", type=int, default=3, help="Keep the best of this many imports of each module.")
+    parser.add_argument("--show", type=int, default=5, help="Number of slowest imports to list per module.")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        budget = BUDGETS_MS.get(module, min(BUDGETS_MS.values()))
+        total, imports = min((measure(module) for _ in range(args.repeat)), key=lambda measured: measured[0])
+        heavy = sorted({name.split(".")[0] for name in imports} & HEAVY_MODULES)
+        ok = total <= budget and not heavy
+        failed |= not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {module}: {total:.0f}ms (budget {budget}ms)")
+        if heavy:
+            print(f"     imports heavy modules: {', '.join(heavy)}")
+        slowest = sorted((ms, name) for name, ms in imports.items() if name != module)[max(0, len(imports) - 1 - args.show):]
+        for ms, name in reversed(slowest):
+            print(f"     {ms:8.1f}ms  {name}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
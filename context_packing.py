@@ -0,0 +1,128 @@
+"""
+Token-budgeted assembly of the retrieved passages into the RAG prompt context.
+
+The PDFs are split with a 500 character overlap, so the top results of a query often include neighbouring
+chunks of the same page that repeat each other's text. Before the prompt is built, pack_context:
+    1. merges the passages of the same source and page that overlap (or contain one another) into one span
+    2. drops passages whose text is already contained in a better-scored passage of another source
+    3. takes the spans best score first until the token budget is full, truncating the last one that fits
+       only partly
+Tokens are counted with tiktoken, so the budget matches what the chat model is billed for, and the packed
+and saved tokens are recorded as the context_tokens and context_tokens_saved counters (see instrumentation.py).
+
+Environment variables:
+    CONTEXT_TOKEN_BUDGET:   maximum number of tokens of retrieved context per prompt, 0 for no limit (default 0).
+                            A budget drops or cuts the lowest-scored passages, which changes the answers, so it is
+                            opt-in; five PDF chunks or PubMed abstracts often take more than 1000 tokens.
+    CONTEXT_TOKEN_ENCODING: tiktoken encoding of the chat model (default cl100k_base, used by gpt-3.5-turbo and gpt-4)
+"""
+import functools
+import os
+
+from dedup import normalize_text
+from instrumentation import count
+
+DEFAULT_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0))
+TOKEN_ENCODING = os.environ.get("CONTEXT_TOKEN_ENCODING", "cl100k_base")
+
+# Shorter common prefixes and suffixes are treated as coincidence rather than chunk overlap
+MIN_OVERLAP = 50
+
+# A passage is only truncated to fit the budget if at least this many tokens of it fit
+MIN_TRUNCATED_TOKENS = 64
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    """
+    The tiktoken encoding used to count tokens, loaded on first use.
+    """
+    import tiktoken
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+
+def count_tokens(text):
+    """
+    Number of tokens of text.
+    """
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def merge_overlapping(first, second, min_overlap=MIN_OVERLAP):
+    """
+    One span covering both texts if one contains the other, or the end of one is the start of the other
+    (by at least min_overlap characters), else None.
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    for left, right in ((first, second), (second, first)):
+        for size in range(min(len(left), len(right)) - 1, min_overlap - 1, -1):
+            if left.endswith(right[:size]):
+                return left + right[size:]
+    return None
+
+
+def merge_group(passages):
+    """
+    Merge the overlapping passages of one source and page.
+    :param passages: list: (text, score) pairs.
+    :return: list: (text, score) pairs, a merged span scoring as its best passage.
+    """
+    spans = list(passages)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(spans)):
+            for j in range(i + 1, len(spans)):
+                text = merge_overlapping(spans[i][0], spans[j][0])
+                if text is not None:
+                    spans[i] = (text, max(spans[i][1], spans[j][1]))
+                    del spans[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return spans
+
+
+def pack_context(passages, budget=DEFAULT_BUDGET):
+    """
+    Select and merge the retrieved passages to put in the prompt.
+    :param passages: list: (text, group, score) triples, where group (e.g. (url, page)) identifies the page the text
+                     comes from; only passages of the same group are merged.
+    :param budget: int: maximum number of tokens of the returned texts, 0 for no limit.
+    :return: list: (text, group) pairs, best score first.
+    """
+    encoding = get_encoding()
+    groups = {}
+    for text, group, score in passages:
+        groups.setdefault(group, []).append((text, score))
+    spans = sorted(
+        ((text, group, score) for group, members in groups.items() for text, score in merge_group(members)),
+        key=lambda span: span[2], reverse=True,
+    )
+
+    packed = []
+    kept_text = []
+    used = 0
+    for text, group, _score in spans:
+        normalized = normalize_text(text)
+        if any(normalized in other for other in kept_text):
+            continue
+        tokens = encoding.encode(text, disallowed_special=())
+        remaining = budget - used if budget else len(tokens)
+        if len(tokens) > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            tokens = tokens[:remaining]
+            text = encoding.decode(tokens)
+        packed.append((text, group))
+        kept_text.append(normalized)
+        used += len(tokens)
+
+    original = sum(len(encoding.encode(text, disallowed_special=())) for text, _group, _score in passages)
+    count("context_tokens", used)
+    count("context_tokens_saved", original - used)
+    return packed
@@ -0,0 +1,237 @@
+"""
+Structured drug-pair interaction index over the DDInter CSVs in corpus/csv.
+
+Every drug gets an interned integer id. Interacting pairs are stored twice:
+    pair_keys/pair_levels:           sorted int64 keys (low_id * num_drugs + high_id) for O(log n) pair lookups
+    adj_indptr/adj_indices/adj_levels: CSR adjacency, listing every interaction of a drug
+Severity levels are stored as int8 codes indexing LEVELS. Names and DDInter ids (plus optional synonyms)
+resolve case-insensitively to drug ids.
+
+The index is saved as an uncompressed .npz, which loads in a few milliseconds.
+
+Usage:
+    python ddinter_index.py                          # build ddinter_index.npz from corpus/csv
+    python ddinter_index.py --synonyms synonyms.csv  # also map the synonyms in a (synonym, drug) CSV
+"""
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+DDINTER_CSV_PATH = "corpus/csv"
+DDINTER_INDEX_PATH = "ddinter_index.npz"
+
+# Severity codes, ordered from least to most severe
+LEVELS = ["Unknown", "Minor", "Moderate", "Major"]
+
+
+def normalize_name(name):
+    """
+    Lowercase a drug name and reduce it to its words, so "Insulin, Regular" matches "insulin regular".
+    """
+    return " ".join(re.findall(r"[\w\-]+", str(name).lower()))
+
+
+def build_ddinter_index(csv_path=DDINTER_CSV_PATH, index_path=DDINTER_INDEX_PATH, synonyms=None):
+    """
+    Build the interaction index from every ddinter_downloads_code_*.csv in csv_path.
+    :param synonyms: dict: optional synonym -> drug name (or DDInter id) mapping.
+    """
+    import pandas as pd
+
+    frames = [pd.read_csv(file_path) for file_path in sorted(glob.glob(os.path.join(csv_path, "ddinter_downloads_code_*.csv")))]
+    df = pd.concat(frames, ignore_index=True)
+
+    # Intern DDInter ids in numeric order so that rebuilding gives the same ids
+    drugs = pd.concat([
+        df[["DDInterID_A", "Drug_A"]].set_axis(["ddinter_id", "name"], axis=1),
+        df[["DDInterID_B", "Drug_B"]].set_axis(["ddinter_id", "name"], axis=1),
+    ]).drop_duplicates("ddinter_id")
+    drugs = drugs.assign(number=drugs["ddinter_id"].str.extract(r"(\d+)$", expand=False).astype(int)).sort_values("number")
+    ddinter_ids = drugs["ddinter_id"].to_numpy(dtype=str)
+    names = drugs["name"].to_numpy(dtype=str)
+    id_of = {ddinter_id: i for i, ddinter_id in enumerate(ddinter_ids)}
+
+    a = df["DDInterID_A"].map(id_of).to_numpy(dtype=np.int64)
+    b = df["DDInterID_B"].map(id_of).to_numpy(dtype=np.int64)
+    levels = df["Level"].map({level: code for code, level in enumerate(LEVELS)}).fillna(0).to_numpy(dtype=np.int8)
+
+    # The same pair appears in several ATC code files; keep one entry per pair with its most severe level
+    num_drugs = len(ddinter_ids)
+    keys = np.minimum(a, b) * num_drugs + np.maximum(a, b)
+    order = np.lexsort((-levels, keys))
+    keys, levels = keys[order], levels[order]
+    first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    pair_keys, pair_levels = keys[first], levels[first]
+
+    # CSR adjacency with both directions of every pair
+    low, high = pair_keys // num_drugs, pair_keys % num_drugs
+    rows = np.concatenate((low, high))
+    cols = np.concatenate((high, low))
+    adj_levels = np.concatenate((pair_levels, pair_levels))
+    order = np.lexsort((cols, rows))
+    rows, adj_indices, adj_levels = rows[order], cols[order].astype(np.int32), adj_levels[order]
+    adj_indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_drugs)))).astype(np.int64)
+
+    synonym_names = []
+    synonym_ids = []
+    lookup = {normalize_name(name): i for i, name in enumerate(names)}
+    lookup.update({normalize_name(ddinter_id): i for i, ddinter_id in enumerate(ddinter_ids)})
+    for synonym, drug in (synonyms or {}).items():
+        drug_id = lookup.get(normalize_name(drug))
+        if drug_id is None:
+            print(f"Skipping synonym {synonym!r}: unknown drug {drug!r}")
+            continue
+        synonym_names.append(str(synonym).strip())
+        synonym_ids.append(drug_id)
+
+    np.savez(
+        index_path,
+        ddinter_ids=ddinter_ids,
+        names=names,
+        pair_keys=pair_keys,
+        pair_levels=pair_levels,
+        adj_indptr=adj_indptr,
+        adj_indices=adj_indices,
+        adj_levels=adj_levels,
+        synonym_names=np.array(synonym_names, dtype=str),
+        synonym_ids=np.array(synonym_ids, dtype=np.int32),
+    )
+    print(f"Indexed {len(pair_keys)} interactions between {num_drugs} drugs from {len(df)} rows at {index_path}.")
+
+
+class DDInterIndex:
+    """
+    Exact drug-pair interaction lookups over a prebuilt DDInter index.
+    """
+
+    def __init__(self, arrays):
+        self.ddinter_ids = arrays["ddinter_ids"]
+        self.names = arrays["names"]
+        self.pair_keys = arrays["pair_keys"]
+        self.pair_levels = arrays["pair_levels"]
+        self.adj_indptr = arrays["adj_indptr"]
+        self.adj_indices = arrays["adj_indices"]
+        self.adj_levels = arrays["adj_levels"]
+
+        self.lookup = {normalize_name(name): i for i, name in enumerate(self.names.tolist())}
+        self.lookup.update({normalize_name(ddinter_id): i for i, ddinter_id in enumerate(self.ddinter_ids.tolist())})
+        self.lookup.update(
+            (normalize_name(synonym), int(drug_id))
+            for synonym, drug_id in zip(arrays["synonym_names"].tolist(), arrays["synonym_ids"].tolist())
+        )
+        self.max_name_words = max(len(name.split()) for name in self.lookup)
+
+    def __len__(self):
+        return len(self.names)
+
+    def resolve(self, name):
+        """
+        Drug id for a name, DDInter id or synonym (case-insensitive), or None if it is unknown.
+        """
+        return self.lookup.get(normalize_name(name))
+
+    def level(self, drug_a, drug_b):
+        """
+        Severity level name of the interaction between two drug ids, or None if none is recorded.
+        """
+        key = min(drug_a, drug_b) * len(self) + max(drug_a, drug_b)
+        position = np.searchsorted(self.pair_keys, key)
+        if position < len(self.pair_keys) and self.pair_keys[position] == key:
+            return LEVELS[self.pair_levels[position]]
+        return None
+
+    def interaction(self, name_a, name_b):
+        """
+        Look up whether two drugs interact.
+        :return: string: severity level, or None if either drug is unknown or no interaction is recorded.
+        """
+        drug_a, drug_b = self.resolve(name_a), self.resolve(name_b)
+        if drug_a is None or drug_b is None:
+            return None
+        return self.level(drug_a, drug_b)
+
+    def interactions_of(self, drug_id):
+        """
+        (drug ids, level codes) of every drug interacting with drug_id.
+        """
+        start, stop = self.adj_indptr[drug_id], self.adj_indptr[drug_id + 1]
+        return self.adj_indices[start:stop], self.adj_levels[start:stop]
+
+    def pairwise_interactions(self, drug_ids):
+        """
+        Every recorded interaction among a list of drug ids, found with a single vectorized join.
+        :return: (drug_a ids, drug_b ids, level codes) arrays, one entry per interacting pair.
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        first, second = np.triu_indices(len(drug_ids), k=1)
+        drug_a, drug_b = drug_ids[first], drug_ids[second]
+        keys = np.minimum(drug_a, drug_b) * len(self) + np.maximum(drug_a, drug_b)
+        if len(keys) == 0 or len(self.pair_keys) == 0:
+            return drug_a[:0], drug_b[:0], self.pair_levels[:0]
+        positions = np.minimum(np.searchsorted(self.pair_keys, keys), len(self.pair_keys) - 1)
+        found = self.pair_keys[positions] == keys
+        return drug_a[found], drug_b[found], self.pair_levels[positions[found]]
+
+    def find_drugs(self, text):
+        """
+        Ids of the known drugs mentioned in free text, in order of first mention.
+        """
+        words = normalize_name(text).split()
+        found = []
+        i = 0
+        while i < len(words):
+            # Prefer the longest name starting at this word, e.g. "acetylsalicylic acid" over "acetylsalicylic"
+            for length in range(min(self.max_name_words, len(words) - i), 0, -1):
+                drug_id = self.lookup.get(" ".join(words[i:i + length]))
+                if drug_id is not None:
+                    if drug_id not in found:
+                        found.append(drug_id)
+                    i += length
+                    break
+            else:
+                i += 1
+        return found
+
+    def describe_pairs(self, text):
+        """
+        One line per pair of drugs mentioned in text, stating the recorded DDInter interaction level.
+        """
+        drug_ids = self.find_drugs(text)
+        lines = []
+        for i, drug_a in enumerate(drug_ids):
+            for drug_b in drug_ids[i + 1:]:
+                level = self.level(drug_a, drug_b)
+                if level is None:
+                    lines.append(f"No interaction between {self.names[drug_a]} and {self.names[drug_b]} is recorded in DDInter.")
+                else:
+                    lines.append(f"{self.names[drug_a]} and {self.names[drug_b]} have a {level} interaction according to DDInter.")
+        return lines
+
+
+def load_ddinter_index(index_path=DDINTER_INDEX_PATH):
+    """
+    Load the DDInter index, or return None if it has not been built yet.
+    """
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path, allow_pickle=False) as arrays:
+        return DDInterIndex(arrays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the DDInter drug-pair interaction index.")
+    parser.add_argument("--csv-path", type=str, default=DDINTER_CSV_PATH, help="Directory containing the DDInter CSVs.")
+    parser.add_argument("--output", type=str, default=DDINTER_INDEX_PATH, help="Index file to write.")
+    parser.add_argument("--synonyms", type=str, default=None, help="Optional CSV of (synonym, drug) rows.")
+    args = parser.parse_args()
+
+    synonyms = None
+    if args.synonyms:
+        import pandas as pd
+        synonyms_df = pd.read_csv(args.synonyms)
+        synonyms = dict(zip(synonyms_df.iloc[:, 0], synonyms_df.iloc[:, 1]))
+
+    build_ddinter_index(args.csv_path, args.output, synonyms=synonyms)
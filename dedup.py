@@ -0,0 +1,268 @@
+"""
+Near-duplicate chunk elimination between splitting and embedding.
+
+The PDFs are split with chunk_size=1000, chunk_overlap=500, and the corpora repeat boilerplate (running
+headers, licence text, reference lists), so many chunks add nothing but embedding calls and index rows.
+A Deduplicator sees the chunks in ingestion order and drops those that repeat an earlier kept chunk.
+By default only exact repeats are dropped; the near and contained modes change which chunks are stored
+(e.g. 5 of the 748 PDF chunks), so they are opt-in (--dedup or INGEST_DEDUP):
+    off:       keep everything
+    exact:     drop chunks whose normalised text (lower case, collapsed whitespace) was already kept
+    near:      also drop chunks whose MinHash Jaccard similarity to a kept chunk is at least the threshold
+    contained: overlap-aware: also drop chunks whose word shingles are at least `threshold` contained in a
+               kept chunk, e.g. the tail chunk of a page that lies inside the previous chunk's overlap, or a
+               header repeated inside a longer chunk. The dropped text is still embedded as part of the
+               chunk containing it, so retrieval recall is kept (check with --evaluate).
+Near-duplicate candidates are found with MinHash signatures over word shingles and banded LSH, so each chunk
+is only compared with the few kept chunks sharing one of its bands.
+
+Full ingestions deduplicate across the whole corpus. Incremental ingestions only deduplicate within each
+source, so they never drop a chunk because of a source that may later be deleted. A chunk dropped by a full
+ingestion in favour of another source comes back at the next full ingestion after that source is removed.
+
+Environment variables:
+    INGEST_DEDUP:           default mode, off, exact, near or contained (default exact)
+    INGEST_DEDUP_THRESHOLD: minimum Jaccard similarity (near) or containment (contained) (default 0.9)
+
+The tokens saved are counted with the chat model's tiktoken encoding (see context_packing.py) when it can be
+loaded; it is downloaded on first use, so offline runs only report the characters saved.
+
+Usage:
+    python dedup.py                         # chunks and tokens saved by each mode on the PDF corpus
+    python dedup.py --evaluate --top-k 5    # ... and recall@k of evaluation_prompts.txt against no deduplication
+"""
+import argparse
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+from instrumentation import count
+
+DEDUP_MODES = ["off", "exact", "near", "contained"]
+DEFAULT_DEDUP = os.environ.get("INGEST_DEDUP", "exact")
+DEFAULT_THRESHOLD = float(os.environ.get("INGEST_DEDUP_THRESHOLD", 0.9))
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+
+_PRIME = (1 << 31) - 1
+
+
+def normalize_text(text):
+    """
+    Lower case text with every run of whitespace collapsed to one space.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def lsh_bands(num_perm, threshold):
+    """
+    (bands, rows) splitting num_perm signature values so that pairs above about threshold Jaccard
+    similarity share a band, whose approximate threshold (1 / bands) ** (1 / rows) is closest to threshold.
+    """
+    splits = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+
+class Deduplicator:
+    """
+    Drops chunks that repeat an earlier kept chunk. Not thread-safe: run it in a single pipeline worker.
+    """
+
+    def __init__(self, mode=None, threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.mode = mode or DEFAULT_DEDUP
+        if self.mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown deduplication mode {self.mode!r}, expected one of {DEDUP_MODES}")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        # A chunk contained in one twice its length has a Jaccard similarity of at most 0.5 with it, so contained
+        # mode shortlists candidates far below the threshold and checks their containment exactly
+        self.bands, self.rows = lsh_bands(num_perm, threshold if self.mode == "near" else threshold / 4)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.stats = {"chunks": 0, "kept": 0, "exact": 0, "near": 0, "characters_saved": 0, "tokens_saved": 0}
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the kept chunks (but not the statistics), to start deduplicating a new scope.
+        """
+        self._kept = 0
+        self._exact = {}
+        self._buckets = {}
+        self._signatures = []
+        self._shingles = []
+
+    def shingles(self, text):
+        """
+        Sorted unique 32-bit hashes of the word shingles of text.
+        """
+        words = normalize_text(text).split(" ")
+        size = min(self.shingle_size, len(words))
+        grams = (" ".join(words[i:i + size]) for i in range(len(words) - size + 1))
+        return np.unique(np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64))
+
+    def signature(self, shingles):
+        """
+        MinHash signature of a shingle set: its minimum under each random permutation (a * x + b) mod p.
+        """
+        return ((self._a * shingles[None, :] + self._b) % _PRIME).min(axis=1)
+
+    def duplicate_of(self, text):
+        """
+        Position (among the chunks kept since the last reset) of the kept chunk that text repeats, or None if
+        text is kept, in which case it is remembered for the following chunks.
+        """
+        self.stats["chunks"] += 1
+        original, kind = self._match(text)
+        if original is None:
+            self.stats["kept"] += 1
+            return None
+        self.stats[kind] += 1
+        self.stats["characters_saved"] += len(text)
+        if self.stats["tokens_saved"] is not None:
+            tokens = self._count_tokens(text)
+            self.stats["tokens_saved"] = None if tokens is None else self.stats["tokens_saved"] + tokens
+        count("chunks_deduplicated", kind=kind)
+        return original
+
+    def _count_tokens(self, text):
+        # Imported here, as context_packing itself imports this module
+        from context_packing import count_tokens
+
+        try:
+            return count_tokens(text)
+        except Exception as e:
+            # Only reported, so a missing tokenizer (e.g. offline) must not stop the ingestion
+            print(f"Not counting the tokens saved by deduplication: {e}")
+            return None
+
+    def keep(self, text):
+        """
+        True if text is not a duplicate of a kept chunk (and is now kept itself).
+        """
+        return self.duplicate_of(text) is None
+
+    def _match(self, text):
+        if self.mode == "off":
+            return None, None
+        digest = hashlib.sha1(normalize_text(text).encode("utf-8")).digest()
+        if digest in self._exact:
+            return self._exact[digest], "exact"
+
+        if self.mode != "exact":
+            shingles = self.shingles(text)
+            signature = self.signature(shingles)
+            keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+            candidates = sorted({candidate for key in keys for candidate in self._buckets.get(key, ())})
+            for candidate in candidates:
+                if self._similar(shingles, signature, candidate):
+                    self._exact[digest] = candidate
+                    return candidate, "near"
+
+        position = self._kept
+        self._kept += 1
+        self._exact[digest] = position
+        if self.mode != "exact":
+            for key in keys:
+                self._buckets.setdefault(key, []).append(position)
+            if self.mode == "near":
+                self._signatures.append(signature)
+            else:
+                self._shingles.append(shingles)
+        return None, None
+
+    def _similar(self, shingles, signature, candidate):
+        if self.mode == "near":
+            return np.mean(signature == self._signatures[candidate]) >= self.threshold
+        shared = np.intersect1d(shingles, self._shingles[candidate], assume_unique=True).size
+        return shared >= self.threshold * shingles.size
+
+    def summary(self):
+        """
+        One line with the number of chunks dropped and the characters and (if they could be counted) tokens saved.
+        """
+        stats = self.stats
+        dropped = stats["exact"] + stats["near"]
+        tokens = f" ({stats['tokens_saved']} tokens)" if stats["tokens_saved"] is not None else ""
+        return (
+            f"Deduplication ({self.mode}): dropped {dropped} of {stats['chunks']} chunks "
+            f"({stats['exact']} exact, {stats['near']} near duplicates), saving {stats['characters_saved']} characters{tokens}."
+        )
+
+
+def deduplicate(chunks, mode=None, text=lambda chunk: chunk.page_content):
+    """
+    The chunks (langchain Documents by default) that are not duplicates of earlier ones, in order.
+    """
+    deduplicator = Deduplicator(mode)
+    kept = [chunk for chunk in chunks if deduplicator.keep(text(chunk))]
+    print(deduplicator.summary())
+    return kept
+
+
+def evaluate(chunks, embeddings, prompts, top_k=5, threshold=DEFAULT_THRESHOLD):
+    """
+    recall@top_k of each mode on prompts: the fraction of the chunks retrieved without deduplication that are
+    still retrieved after it, counting a dropped chunk as retrieved when the chunk it duplicates is.
+    """
+    texts = [chunk.page_content for chunk in chunks]
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    queries = np.asarray(embeddings.embed_documents(prompts), dtype=np.float32)
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    scores = queries @ matrix.T
+    k = min(top_k, len(texts))
+    baseline = np.argsort(-scores, axis=1)[:, :k]
+
+    results = {}
+    for mode in DEDUP_MODES[1:]:
+        deduplicator = Deduplicator(mode, threshold=threshold)
+        kept, owner = [], []
+        for row, text in enumerate(texts):
+            original = deduplicator.duplicate_of(text)
+            if original is None:
+                owner.append(row)
+                kept.append(row)
+            else:
+                owner.append(kept[original])
+        kept = np.array(kept)
+        found = kept[np.argsort(-scores[:, kept], axis=1)[:, :k]]
+        hits = [len({owner[row] for row in expected} & set(retrieved)) / len({owner[row] for row in expected})
+                for expected, retrieved in zip(baseline, found)]
+        results[mode] = (deduplicator, float(np.mean(hits)) if hits else 1.0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Minimum Jaccard similarity (near) or containment (contained).")
+    parser.add_argument("--evaluate", action="store_true", help="Also measure recall@k on evaluation_prompts.txt (embeds the corpus).")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of results per query for --evaluate.")
+    parser.add_argument("--embedder", type=str, default=None, help="Embedding backend for --evaluate (see embedders.py).")
+    args = parser.parse_args()
+
+    from Langchain_v2_create_database import load_and_split
+    chunks = load_and_split(workers=os.cpu_count())
+
+    if args.evaluate:
+        from batch_query import read_questions
+        from embedders import get_embeddings
+        from embedding_cache import cached
+        for mode, (deduplicator, recall) in evaluate(chunks, cached(get_embeddings(args.embedder)), read_questions("evaluation_prompts.txt"),
+                                                     args.top_k, args.threshold).items():
+            print(f"{deduplicator.summary()} recall@{args.top_k}: {recall:.3f}")
+        return
+
+    for mode in DEDUP_MODES[1:]:
+        deduplicator = Deduplicator(mode, threshold=args.threshold)
+        for chunk in chunks:
+            deduplicator.keep(chunk.page_content)
+        print(deduplicator.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Embedding backends selectable by the ingestion and query scripts.
+
+    openai: OpenAIEmbeddings (text-embedding-ada-002), one network round trip per batch
+    local:  a sentence-transformers model run on the CPU with batched multi-threaded inference, optionally
+            with ONNX/OpenVINO or int8-quantized weights (see local_embeddings.py)
+
+Every stored embedding records the model that produced it (model_key(), e.g. "text-embedding-ada-002" or
+"sentence-transformers/all-MiniLM-L6-v2@onnx"), and so do the vector index and the Chroma collection, so
+queries embedded with a different model are rejected instead of silently returning unrelated neighbours.
+Switching models therefore takes a full (not incremental) ingestion.
+
+The backends are only imported by get_embeddings(), so the scripts can build their command line from
+EMBEDDERS without loading langchain.
+
+Environment variables:
+    EMBEDDER: default backend, openai or local (default openai)
+"""
+import os
+
+EMBEDDERS = ["openai", "local"]
+DEFAULT_EMBEDDER = os.environ.get("EMBEDDER", "openai")
+
+
+def get_embeddings(name=None):
+    """
+    Uncached Embeddings instance of the named backend (default: EMBEDDER).
+    """
+    name = name or DEFAULT_EMBEDDER
+    if name == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings()
+    if name == "local":
+        from local_embeddings import LocalEmbeddings
+        return LocalEmbeddings()
+    raise ValueError(f"Unknown embedder {name!r}, expected one of {EMBEDDERS}")
+
+
+def check_embedder(expected, embeddings, what="vector index"):
+    """
+    Raise ValueError if embeddings is not the model that produced the stored vectors.
+    :param expected: string: model_key() recorded with the stored vectors, or None if unknown (legacy data).
+    """
+    from embedding_cache import model_key
+
+    actual = model_key(embeddings)
+    if expected and expected != actual:
+        raise ValueError(
+            f"The {what} holds {expected} embeddings but {actual} was selected. "
+            f"Select the same embedder (--embedder / EMBEDDER), or run a full ingestion to switch models."
+        )
@@ -0,0 +1,149 @@
+"""
+Persistent embedding cache shared by the ingestion and query scripts.
+
+CachedEmbeddings wraps any langchain Embeddings (e.g. OpenAIEmbeddings) and stores every vector it
+computes in a SQLite file, keyed by the hash of (model name, text). The database runs in WAL mode so
+a query process and an ingestion process can read and write the same cache at once. When the cache
+grows past max_entries the least recently used vectors are evicted.
+
+Environment variables:
+    EMBEDDING_CACHE_PATH:        location of the SQLite file (default .embedding_cache.sqlite3)
+    EMBEDDING_CACHE_MAX_ENTRIES: maximum number of cached vectors (default 100000)
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from instrumentation import count, stage
+
+CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 100000))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves repeated texts from a disk-backed LRU cache.
+    """
+
+    def __init__(self, embeddings, path=CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, model_name=None):
+        self.embeddings = embeddings
+        self.model_name = model_name or model_key(embeddings)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                block = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(block))})", block
+                ).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+            if found:
+                now = time.time()
+                self._connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._connection.commit()
+        return found
+
+    def _store(self, vectors):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in vectors.items()],
+            )
+            (entries,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if entries > self.max_entries:
+                # Evict down to 90% of the limit so that eviction does not run on every insert
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (entries - int(self.max_entries * 0.9),),
+                )
+            self._connection.commit()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        count("embedding_cache_hits", len(keys) - len(missing))
+        count("embedding_cache_misses", len(missing))
+
+        if missing:
+            with stage("embed_api"):
+                vectors = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            count("embedded_characters", sum(len(text) for text in missing.values()))
+            self._store(vectors)
+            cached.update(vectors)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        cached = self._lookup([key])
+        if key in cached:
+            self.hits += 1
+            count("embedding_cache_hits")
+            return cached[key]
+
+        self.misses += 1
+        count("embedding_cache_misses")
+        with stage("embed_api"):
+            vector = self.embeddings.embed_query(text)
+        count("embedded_characters", len(text))
+        self._store({key: vector})
+        return vector
+
+    def stats(self):
+        """
+        Hit/miss counters of this process.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def model_key(embeddings):
+    """
+    Name of the model behind an Embeddings instance (plus how it is run, if that changes the vectors),
+    e.g. text-embedding-ada-002. Vectors from different keys must never be compared.
+    """
+    if isinstance(embeddings, CachedEmbeddings):
+        return embeddings.model_name
+    name = getattr(embeddings, "model", None) or type(embeddings).__name__
+    variant = getattr(embeddings, "variant", None)
+    return f"{name}@{variant}" if variant else name
+
+
+def cached(embeddings, path=CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Wrap an Embeddings instance with the shared on-disk cache.
+    """
+    return CachedEmbeddings(embeddings, path=path, max_entries=max_entries)
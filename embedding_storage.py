@@ -0,0 +1,203 @@
+"""
+Compact storage of embeddings in the MongoDB `document_embeddings` collection.
+
+Embeddings used to be stored as BSON arrays of doubles (~12 KB per 1536-d vector), and decoding them into
+Python lists dominated query and index build time. They are now stored as packed binary, decoded with
+np.frombuffer without copying:
+    array:   BSON array of doubles (the original layout, still readable)
+    float32: packed float32, 4 bytes per dimension
+    float16: packed float16, 2 bytes per dimension
+    int8:    int8 scalar quantization with a per-vector scale (embedding_scale), 1 byte per dimension
+The format of every document is recorded in its embedding_format field, so collections with mixed formats
+(e.g. halfway through a migration) stay readable.
+
+Environment variables:
+    EMBEDDING_FORMAT: format used when storing new embeddings (default float32)
+
+Usage:
+    python embedding_storage.py recall --format int8      # recall@k of a format against the stored vectors
+    python embedding_storage.py migrate --format float16  # re-encode every stored embedding, then rebuild the index
+"""
+import argparse
+import os
+
+import numpy as np
+from bson import Binary
+from pymongo import MongoClient, UpdateOne
+
+FORMATS = ["array", "float32", "float16", "int8"]
+DEFAULT_FORMAT = os.environ.get("EMBEDDING_FORMAT", "float32")
+
+# Fields needed to decode an embedding, for use in projections
+EMBEDDING_FIELDS = {"embedding": 1, "embedding_format": 1, "embedding_scale": 1}
+
+# Bytes per dimension of each format
+ITEM_SIZES = {"array": 8, "float32": 4, "float16": 2, "int8": 1}
+
+_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def encode_embedding(vector, embedding_format=DEFAULT_FORMAT):
+    """
+    Fields storing vector in the given format, to be set on the document.
+    """
+    if embedding_format == "array":
+        return {"embedding": [float(value) for value in vector], "embedding_format": "array"}
+    vector = np.asarray(vector, dtype=np.float32)
+    if embedding_format == "int8":
+        peak = float(np.abs(vector).max()) if len(vector) else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return {"embedding": Binary(quantized.tobytes()), "embedding_format": "int8", "embedding_scale": scale}
+    if embedding_format not in _DTYPES:
+        raise ValueError(f"Unknown embedding format {embedding_format!r}, expected one of {FORMATS}")
+    return {"embedding": Binary(vector.astype(_DTYPES[embedding_format]).tobytes()), "embedding_format": embedding_format}
+
+
+def decode_raw(doc):
+    """
+    Stored values of a document's embedding without conversion (a zero-copy view for binary formats),
+    plus the scale to multiply them by (1.0 except for int8).
+    """
+    embedding_format = doc.get("embedding_format", "array")
+    if embedding_format == "array":
+        return np.asarray(doc["embedding"], dtype=np.float32), 1.0
+    return np.frombuffer(doc["embedding"], dtype=_DTYPES[embedding_format]), doc.get("embedding_scale", 1.0)
+
+
+def decode_embedding(doc):
+    """
+    A document's embedding as a float32 vector, whatever format it is stored in.
+    """
+    values, scale = decode_raw(doc)
+    if values.dtype == np.float32 and scale == 1.0:
+        return values
+    vector = values.astype(np.float32)
+    if scale != 1.0:
+        vector *= scale
+    return vector
+
+
+def round_trip(matrix, embedding_format):
+    """
+    The rows of matrix as they read back after being stored in embedding_format.
+    """
+    return np.stack([decode_embedding(encode_embedding(row, embedding_format)) for row in matrix]) if len(matrix) else matrix
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+def recall_at_k(reference, candidate, num_queries=100, k=5, seed=0):
+    """
+    Mean recall@k of cosine search over candidate against search over reference, using num_queries of the
+    reference rows as queries (each query's own row is excluded from its results).
+    """
+    reference = normalize_rows(reference.astype(np.float32))
+    candidate = normalize_rows(candidate.astype(np.float32))
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(reference), size=min(num_queries, len(reference)), replace=False)
+    k = min(k, len(reference) - 1)
+    if k <= 0:
+        return 1.0
+
+    recalls = []
+    for query in queries:
+        exact_scores = reference @ reference[query]
+        approximate_scores = candidate @ reference[query]
+        exact_scores[query] = approximate_scores[query] = -np.inf
+        exact = set(np.argpartition(exact_scores, -k)[-k:].tolist())
+        approximate = set(np.argpartition(approximate_scores, -k)[-k:].tolist())
+        recalls.append(len(exact & approximate) / k)
+    return float(np.mean(recalls))
+
+
+def load_matrix(collection, limit=None):
+    """
+    Every stored embedding of the collection (up to limit) as a float32 matrix, plus the formats found.
+    """
+    cursor = collection.find({}, EMBEDDING_FIELDS).batch_size(1000)
+    if limit:
+        cursor = cursor.limit(limit)
+    rows = []
+    formats = set()
+    for doc in cursor:
+        rows.append(decode_embedding(doc))
+        formats.add(doc.get("embedding_format", "array"))
+    return (np.stack(rows) if rows else np.empty((0, 0), dtype=np.float32)), formats
+
+
+def report_recall(collection, embedding_formats=FORMATS, num_queries=100, k=5, limit=None):
+    """
+    Print the recall@k and size of each format relative to the embeddings currently stored.
+    """
+    matrix, stored_formats = load_matrix(collection, limit=limit)
+    if len(matrix) < 2:
+        print("Not enough stored embeddings to measure recall.")
+        return {}
+    if stored_formats - {"array", "float32"}:
+        print(f"Note: the stored embeddings are already lossy ({', '.join(sorted(stored_formats))}); recall is relative to them.")
+
+    dim = matrix.shape[1]
+    results = {}
+    for embedding_format in embedding_formats:
+        recall = recall_at_k(matrix, round_trip(matrix, embedding_format), num_queries=num_queries, k=k)
+        results[embedding_format] = recall
+        print(f"{embedding_format:>8}: {ITEM_SIZES[embedding_format] * dim:>6} bytes/vector, recall@{k} = {recall:.4f}")
+    return results
+
+
+def migrate(collection, embedding_format, batch_size=1000):
+    """
+    Re-encode every stored embedding in embedding_format.
+    :return: int: number of documents rewritten.
+    """
+    query = {"embedding_format": {"$ne": embedding_format}}
+    total = collection.count_documents(query)
+    print(f"Migrating {total} embeddings to {embedding_format}...")
+
+    migrated = 0
+    updates = []
+    for doc in collection.find(query, EMBEDDING_FIELDS).batch_size(batch_size):
+        fields = encode_embedding(decode_embedding(doc), embedding_format)
+        update = {"$set": fields}
+        if "embedding_scale" not in fields:
+            update["$unset"] = {"embedding_scale": ""}
+        updates.append(UpdateOne({"_id": doc["_id"]}, update))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+            updates = []
+            print(f"Migrated {migrated}/{total} embeddings.")
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        migrated += len(updates)
+    print(f"Migrated {migrated} embeddings to {embedding_format}.")
+    return migrated
+
+
+if __name__ == "__main__":
+    from vector_index import COLLECTION_NAME, DB_NAME, MONGO_URI, build_index
+
+    parser = argparse.ArgumentParser(description="Measure and migrate the storage format of stored embeddings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    recall_parser = subparsers.add_parser("recall", help="Report recall@k of each format against the stored embeddings.")
+    recall_parser.add_argument("--format", type=str, default=None, choices=FORMATS, help="Only report this format.")
+    recall_parser.add_argument("--k", type=int, default=5, help="Number of neighbours compared.")
+    recall_parser.add_argument("--queries", type=int, default=100, help="Number of stored embeddings used as queries.")
+    recall_parser.add_argument("--limit", type=int, default=None, help="Only load this many embeddings.")
+    migrate_parser = subparsers.add_parser("migrate", help="Re-encode every stored embedding.")
+    migrate_parser.add_argument("--format", type=str, default=DEFAULT_FORMAT, choices=FORMATS, help="Target format.")
+    migrate_parser.add_argument("--batch-size", type=int, default=1000, help="Documents updated per bulk write.")
+    args = parser.parse_args()
+
+    collection = MongoClient(MONGO_URI)[DB_NAME][COLLECTION_NAME]
+    if args.command == "recall":
+        report_recall(collection, [args.format] if args.format else FORMATS, num_queries=args.queries, k=args.k, limit=args.limit)
+    else:
+        if args.format in ("float16", "int8"):
+            report_recall(collection, [args.format])
+        if migrate(collection, args.format, batch_size=args.batch_size):
+            build_index(collection)
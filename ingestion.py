@@ -0,0 +1,371 @@
+"""
+Batched embedding and bulk MongoDB writes shared by the ingestion scripts.
+
+Ingestion runs as a streaming pipeline of stages (e.g. load -> split -> embed -> write), each in its own
+thread(s) and connected by bounded queues. Embedding overlaps with loading and parsing, and peak memory
+depends on the batch and queue sizes rather than on the size of the corpus. Chunks are embedded with a
+single embed_documents call per batch and written with a single unordered insert_many, and up to
+max_in_flight batches are embedded concurrently.
+
+Every stored chunk carries a source_id and a chunk_hash, and the ingested_sources collection keeps one
+content hash per source (PDF file or article URL). incremental_ingest uses them to re-embed only the
+chunks of sources that changed and to delete the chunks of sources that disappeared. Chunks also record the
+embedder (model_key) that produced their vector, and incremental_ingest refuses to mix models.
+
+Before batching, a dedup stage drops chunks that repeat an earlier one (see dedup.py), so they cost neither
+embedding calls nor index rows.
+"""
+import contextvars
+import hashlib
+import json
+import queue
+import threading
+import time
+from itertools import islice
+
+from pymongo import UpdateOne
+
+from dedup import Deduplicator
+from embedders import check_embedder
+from embedding_cache import model_key
+from embedding_storage import DEFAULT_FORMAT, encode_embedding
+from instrumentation import count, stage
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_QUEUE_SIZE = 8
+PROGRESS_INTERVAL = 5.0
+
+SOURCES_COLLECTION_NAME = "ingested_sources"
+
+_DONE = object()
+
+
+class PipelineAborted(Exception):
+    """
+    Raised inside a stage when another stage has failed.
+    """
+
+
+def batched(iterable, batch_size):
+    """
+    Yield lists of up to batch_size items from iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def run_pipeline(stages, queue_size=DEFAULT_QUEUE_SIZE, progress_interval=PROGRESS_INTERVAL):
+    """
+    Run stages connected by bounded queues and print per-stage progress while they run.
+    :param stages: List[(name, transform, workers)]: transform takes an iterator over the previous stage's
+                   outputs (None for the first stage) and yields its own outputs. A stage with several
+                   workers runs transform once per worker thread, all reading from the same queue.
+    :param queue_size: int: maximum number of items waiting between two stages.
+    :return: Dict: number of items produced by each stage. Lists (batches) count as their length.
+    """
+    failed = threading.Event()
+    errors = []
+    counts = {name: 0 for name, _transform, _workers in stages}
+    counts_lock = threading.Lock()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+
+    def put(q, item):
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if failed.is_set():
+                    raise PipelineAborted()
+
+    def drain(q):
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if failed.is_set():
+                    raise PipelineAborted()
+                continue
+            if item is _DONE:
+                # Leave the marker for the other workers of this stage
+                put(q, _DONE)
+                return
+            yield item
+
+    threads = []
+    for position, (name, transform, workers) in enumerate(stages):
+        inbox = queues[position - 1] if position > 0 else None
+        outbox = queues[position] if position < len(queues) else None
+        remaining = [workers]
+
+        def work(name=name, transform=transform, inbox=inbox, outbox=outbox, remaining=remaining):
+            try:
+                for item in transform(drain(inbox) if inbox is not None else None):
+                    produced = len(item) if isinstance(item, list) else 1
+                    count("pipeline_items", produced, stage=name)
+                    with counts_lock:
+                        counts[name] += produced
+                    if outbox is not None:
+                        put(outbox, item)
+            except PipelineAborted:
+                return
+            except BaseException as error:
+                errors.append(error)
+                failed.set()
+                return
+            with counts_lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                try:
+                    put(outbox, _DONE)
+                except PipelineAborted:
+                    pass
+
+        for _ in range(workers):
+            # Run each worker in a copy of the caller's context, so its timed stages nest under the caller's
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(work,), name=f"ingest-{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    start = time.time()
+    last_stage = stages[-1][0]
+    while any(thread.is_alive() for thread in threads):
+        threads[-1].join(progress_interval)
+        if any(thread.is_alive() for thread in threads):
+            print_progress(counts, last_stage, time.time() - start)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    print_progress(counts, last_stage, time.time() - start)
+    return counts
+
+
+def print_progress(counts, rate_stage, elapsed):
+    """
+    Print one line with the number of items produced by every stage.
+    """
+    stages = " | ".join(f"{name}: {count}" for name, count in counts.items())
+    rate = counts[rate_stage] / elapsed if elapsed > 0 else 0.0
+    print(f"[{elapsed:.0f}s] {stages} ({rate:.1f} chunks/sec)")
+
+
+def embed_stage(embeddings, embedding_format=DEFAULT_FORMAT):
+    """
+    Pipeline transform embedding the "content" of every document in each batch.
+    The vectors are stored in embedding_format (see embedding_storage.py), tagged with the embedder's model.
+    """
+    embedder = model_key(embeddings)
+
+    def transform(batches):
+        for batch in batches:
+            with stage("embed_batch"):
+                vectors = embeddings.embed_documents([document["content"] for document in batch])
+            for document, vector in zip(batch, vectors):
+                document.update(encode_embedding(vector, embedding_format))
+                document["embedder"] = embedder
+            yield batch
+    return transform
+
+
+def dedup_stage(deduplicator):
+    """
+    Pipeline transform dropping the documents whose "content" repeats an earlier document's.
+    """
+    def transform(documents):
+        for document in documents:
+            with stage("dedup"):
+                keep = deduplicator.keep(document["content"])
+            if keep:
+                yield document
+    return transform
+
+
+def write_stage(collection):
+    """
+    Pipeline transform inserting each batch with one unordered insert_many.
+    """
+    def transform(batches):
+        for batch in batches:
+            with stage("insert_many"):
+                collection.insert_many(batch, ordered=False)
+            yield batch
+    return transform
+
+
+def ingest(stages, collection, embeddings, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, queue_size=DEFAULT_QUEUE_SIZE,
+           dedup=None):
+    """
+    Run the given upstream stages, which must yield documents (dicts with a "content" key),
+    followed by deduplication, batching, embedding and writing stages.
+    :param dedup: string: deduplication mode (see dedup.py, default INGEST_DEDUP).
+    :return: int: number of documents stored.
+    """
+    deduplicator = Deduplicator(dedup)
+    if deduplicator.mode != "off":
+        stages = stages + [("dedup", dedup_stage(deduplicator), 1)]
+    *upstream, (name, transform, workers) = stages
+
+    def batch_transform(items, transform=transform):
+        return batched(transform(items), batch_size)
+
+    start = time.time()
+    with stage("ingest"):
+        counts = run_pipeline(
+            upstream + [
+                (name, batch_transform, workers),
+                ("embed", embed_stage(embeddings), max_in_flight),
+                ("write", write_stage(collection), 1),
+            ],
+            queue_size=queue_size,
+        )
+
+    stored = counts["write"]
+    elapsed = time.time() - start
+    rate = stored / elapsed if elapsed > 0 else 0.0
+    print(f"Embedded and inserted {stored} chunks in {elapsed:.1f}s ({rate:.1f} chunks/sec).")
+    if deduplicator.mode != "off":
+        print(deduplicator.summary())
+    return stored
+
+
+def embed_and_insert(documents, collection, embeddings, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, name="load",
+                     dedup=None):
+    """
+    Embed and store an iterable of documents (dicts with a "content" key) in batches.
+    The iterable is consumed lazily, so only a bounded number of batches is held in memory.
+    :return: int: number of documents stored.
+    """
+    return ingest([(name, lambda _inputs: documents, 1)], collection, embeddings, batch_size=batch_size, max_in_flight=max_in_flight,
+                  dedup=dedup)
+
+
+def hash_file(path):
+    """
+    SHA-256 of a file's bytes.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_text(*parts):
+    """
+    SHA-256 of the given values, serialised as JSON.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def chunk_hash(document):
+    """
+    Content hash of a document to embed: its text plus the metadata stored alongside it.
+    """
+    return hash_text(document["content"], document.get("metadata"), document.get("url"))
+
+
+def register_sources(collection, corpus, sources):
+    """
+    Record the content hash of each source (dict of source_id -> hash) belonging to corpus.
+    """
+    if not sources:
+        return
+    registry = collection.database[SOURCES_COLLECTION_NAME]
+    registry.bulk_write([
+        UpdateOne({"_id": source_id}, {"$set": {"corpus": corpus, "hash": source_hash}}, upsert=True)
+        for source_id, source_hash in sources.items()
+    ], ordered=False)
+
+
+def clear_sources(collection):
+    """
+    Forget every registered source, used when the collection is rebuilt from scratch.
+    """
+    collection.database[SOURCES_COLLECTION_NAME].delete_many({})
+
+
+def incremental_ingest(sources, corpus, collection, embeddings, load_source, legacy_filter=None, prepare=None,
+                       batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, dedup=None):
+    """
+    Bring the chunks of one corpus in the collection up to date without re-embedding unchanged content.
+    :param sources: dict: source_id -> content hash for every source currently in the corpus.
+    :param corpus: string: name of the corpus, so sources of other corpora sharing the collection are left alone.
+    :param load_source: callable: source_id -> list of documents to embed, or None if the source could not be loaded.
+    :param legacy_filter: dict: matches this corpus's chunks stored before hashing was introduced; they are replaced.
+    :param prepare: callable: called with the list of new or changed source ids before any of them is loaded,
+                    e.g. to fetch them concurrently.
+    :param dedup: string: deduplication mode (see dedup.py), applied within each source.
+    :return: int: number of chunks embedded.
+    """
+    # Unchanged chunks keep their vectors, so they must come from the same model as the new ones
+    other = collection.find_one({"embedder": {"$exists": True, "$ne": model_key(embeddings)}}, {"embedder": 1})
+    if other is not None:
+        check_embedder(other["embedder"], embeddings, what="collection")
+
+    collection.create_index([("source_id", 1), ("chunk_hash", 1)])
+    registry = collection.database[SOURCES_COLLECTION_NAME]
+    known = {entry["_id"]: entry["hash"] for entry in registry.find({"corpus": corpus})}
+
+    if not known and legacy_filter is not None:
+        deleted = collection.delete_many({"source_id": {"$exists": False}, **legacy_filter}).deleted_count
+        if deleted:
+            print(f"Removed {deleted} chunks stored without content hashes.")
+
+    changed = [source_id for source_id, source_hash in sources.items() if known.get(source_id) != source_hash]
+    removed = [source_id for source_id in known if source_id not in sources]
+    print(f"{len(sources) - len(changed)} sources unchanged, {len(changed)} new or changed, {len(removed)} removed.")
+
+    # Delete the chunks of sources that disappeared
+    if removed:
+        deleted = collection.delete_many({"source_id": {"$in": removed}}).deleted_count
+        registry.delete_many({"_id": {"$in": removed}})
+        print(f"Deleted {deleted} chunks from removed sources.")
+
+    if changed and prepare is not None:
+        prepare(changed)
+
+    loaded = {}
+    deduplicator = Deduplicator(dedup)
+
+    def new_documents():
+        for source_id in changed:
+            documents = load_source(source_id)
+            if documents is None:
+                continue
+            loaded[source_id] = sources[source_id]
+
+            existing = set(collection.distinct("chunk_hash", {"source_id": source_id}))
+            current = set()
+            deduplicator.reset()
+            for document in documents:
+                document["source_id"] = source_id
+                document["chunk_hash"] = chunk_hash(document)
+                if document["chunk_hash"] in current or not deduplicator.keep(document["content"]):
+                    continue
+                current.add(document["chunk_hash"])
+                if document["chunk_hash"] not in existing:
+                    yield document
+
+            stale = list(existing - current)
+            if stale:
+                collection.delete_many({"source_id": source_id, "chunk_hash": {"$in": stale}})
+
+    embedded = 0
+    if changed:
+        # Already deduplicated per source
+        embedded = embed_and_insert(new_documents(), collection, embeddings, batch_size=batch_size, max_in_flight=max_in_flight, dedup="off")
+        if deduplicator.mode != "off":
+            print(deduplicator.summary())
+
+    # Only mark sources as ingested once all of their chunks are stored
+    register_sources(collection, corpus, loaded)
+    print(f"Incremental ingestion embedded {embedded} chunks.")
+    return embedded
@@ -0,0 +1,251 @@
+"""
+Timers, counters and traces for the ingestion scripts, the query scripts and the scraper.
+
+Wrap a stage with `with stage("embed_query"):` (or decorate a function with @timed("name")) and count events
+with count("chunks", n). Stages nest: every finished stage is recorded as a span with its parent, so a slow
+query can be broken down into embedding, Mongo fetch, similarity search, prompt formatting and the LLM call.
+Stage context is kept in contextvars, so it follows asyncio tasks as well as threads.
+
+Export:
+    - prometheus_text(): Prometheus text format, served at /metrics by query_service.py and by serve_metrics()
+    - snapshot():        the same data as a dict, e.g. for JSON output
+    - report():          one printed line per stage, at the end of a script
+
+Environment variables:
+    DRUGWISE_TRACE_LOG:    append every finished span to this file as a JSON line
+    DRUGWISE_METRICS_FILE: write the metrics here when the process exits (JSON if it ends in .json,
+                           otherwise Prometheus text, e.g. for the node_exporter textfile collector)
+    DRUGWISE_PROFILE:      profile the code run under profile() with cProfile and dump the stats here
+                           (for py-spy, stage names match the functions and thread names of the hot path)
+"""
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_LOG = os.environ.get("DRUGWISE_TRACE_LOG")
+METRICS_FILE = os.environ.get("DRUGWISE_METRICS_FILE")
+PROFILE_PATH = os.environ.get("DRUGWISE_PROFILE")
+
+METRIC_PREFIX = "drugwise"
+
+_lock = threading.Lock()
+_timers = {}    # (stage, labels) -> [calls, total seconds, max seconds]
+_counters = {}  # (name, labels) -> value
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Time the enclosed block as one call of stage `name`.
+    """
+    parent = _current_span.get()
+    span = {
+        "id": next(_span_ids),
+        "trace": parent["trace"] if parent else None,
+        "parent": parent["id"] if parent else None,
+        "stage": name,
+    }
+    if span["trace"] is None:
+        span["trace"] = span["id"]
+    token = _current_span.set(span)
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        key = (name, _labels(labels))
+        with _lock:
+            timer = _timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += duration
+            timer[2] = max(timer[2], duration)
+        if TRACE_LOG:
+            record = dict(span, start=started, duration_ms=round(duration * 1000, 3), **labels)
+            if error:
+                record["error"] = error
+            with _lock, open(TRACE_LOG, "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+def timed(name=None, **labels):
+    """
+    Decorator timing every call of a function as a stage (named after the function by default).
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1, **labels):
+    """
+    Add value to counter `name`, e.g. chunks embedded, bytes fetched or cache hits.
+    """
+    if not value:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def count_llm_usage(message):
+    """
+    Count the prompt and completion tokens reported on a chat model response.
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    count("llm_input_tokens", usage.get("input_tokens", 0))
+    count("llm_output_tokens", usage.get("output_tokens", 0))
+
+
+def snapshot():
+    """
+    Current timers and counters as a JSON-serialisable dict.
+    """
+    with _lock:
+        timers = [
+            dict(labels, stage=name, calls=calls, seconds=round(total, 6), max_seconds=round(longest, 6))
+            for (name, labels), (calls, total, longest) in sorted(_timers.items())
+        ]
+        counters = [dict(labels, name=name, value=value) for (name, labels), value in sorted(_counters.items())]
+    return {"stages": timers, "counters": counters}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def prometheus_text():
+    """
+    Current timers and counters in the Prometheus text exposition format.
+    """
+    with _lock:
+        timers = sorted(_timers.items())
+        counters = sorted(_counters.items())
+
+    lines = [
+        f"# HELP {METRIC_PREFIX}_stage_calls_total Number of times each stage ran.",
+        f"# TYPE {METRIC_PREFIX}_stage_calls_total counter",
+    ]
+    lines += [f"{METRIC_PREFIX}_stage_calls_total{_format_labels((('stage', name),) + labels)} {calls}"
+              for (name, labels), (calls, _total, _longest) in timers]
+    lines += [
+        f"# HELP {METRIC_PREFIX}_stage_seconds_total Time spent in each stage.",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds_total counter",
+    ]
+    lines += [f"{METRIC_PREFIX}_stage_seconds_total{_format_labels((('stage', name),) + labels)} {total:.6f}"
+              for (name, labels), (_calls, total, _longest) in timers]
+    lines += [
+        f"# HELP {METRIC_PREFIX}_stage_seconds_max Longest single run of each stage.",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds_max gauge",
+    ]
+    lines += [f"{METRIC_PREFIX}_stage_seconds_max{_format_labels((('stage', name),) + labels)} {longest:.6f}"
+              for (name, labels), (_calls, _total, longest) in timers]
+
+    for name in sorted({name for (name, _labels_), _value in counters}):
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+        lines += [f"{METRIC_PREFIX}_{name}_total{_format_labels(labels)} {value}"
+                  for (counter, labels), value in counters if counter == name]
+    return "\n".join(lines) + "\n"
+
+
+def report():
+    """
+    Print one line per stage and counter.
+    """
+    data = snapshot()
+    for timer in data["stages"]:
+        labels = {key: value for key, value in timer.items() if key not in ("stage", "calls", "seconds", "max_seconds")}
+        name = timer["stage"] + (f" {labels}" if labels else "")
+        print(f"[timing] {name}: {timer['calls']} calls, {timer['seconds']:.3f}s total, {timer['max_seconds'] * 1000:.1f} ms max")
+    for counter in data["counters"]:
+        labels = {key: value for key, value in counter.items() if key not in ("name", "value")}
+        print(f"[count] {counter['name']}{f' {labels}' if labels else ''}: {counter['value']}")
+
+
+def write_metrics(path=None):
+    """
+    Write the metrics to path (or DRUGWISE_METRICS_FILE): JSON for .json files, Prometheus text otherwise.
+    """
+    path = path or METRICS_FILE
+    if not path:
+        return
+    with open(path + ".tmp", "w") as file:
+        if path.endswith(".json"):
+            json.dump(snapshot(), file, indent=2)
+        else:
+            file.write(prometheus_text())
+    os.replace(path + ".tmp", path)
+
+
+atexit.register(write_metrics)
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    Serve prometheus_text() at http://host:port/metrics from a background thread.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
+
+
+@contextmanager
+def profile(path=None):
+    """
+    Profile the enclosed block with cProfile if path (or DRUGWISE_PROFILE) is set; otherwise do nothing.
+    """
+    path = path or PROFILE_PATH
+    if not path:
+        yield
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Wrote profile to {path} (inspect with `python -m pstats {path}` or snakeviz).")
@@ -0,0 +1,95 @@
+"""
+Local CPU embedding backend (the "local" embedder of embedders.py).
+
+LocalEmbeddings runs a sentence-transformers model in-process: texts are encoded in batches of
+LOCAL_EMBEDDING_BATCH with LOCAL_EMBEDDING_THREADS torch threads, optionally from ONNX/OpenVINO weights or
+with the torch model's linear layers quantized to int8. The model is only loaded on the first embedding call.
+
+Environment variables:
+    LOCAL_EMBEDDING_MODEL:    sentence-transformers model name or path (default sentence-transformers/all-MiniLM-L6-v2)
+    LOCAL_EMBEDDING_BACKEND:  torch, onnx or openvino (default torch)
+    LOCAL_EMBEDDING_FILE:     weights file for the onnx/openvino backends, e.g. onnx/model_qint8_avx512.onnx
+    LOCAL_EMBEDDING_QUANTIZE: 1 to apply dynamic int8 quantization to the torch model's linear layers
+    LOCAL_EMBEDDING_BATCH:    texts per forward pass (default 64)
+    LOCAL_EMBEDDING_THREADS:  CPU threads used for inference (default: all cores)
+"""
+import os
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+from embedding_cache import model_key
+from instrumentation import count, stage
+
+LOCAL_MODEL = os.environ.get("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_BACKENDS = ["torch", "onnx", "openvino"]
+LOCAL_BACKEND = os.environ.get("LOCAL_EMBEDDING_BACKEND", "torch")
+LOCAL_MODEL_FILE = os.environ.get("LOCAL_EMBEDDING_FILE")
+LOCAL_QUANTIZE = os.environ.get("LOCAL_EMBEDDING_QUANTIZE", "0").lower() in ("1", "true", "yes")
+LOCAL_BATCH_SIZE = int(os.environ.get("LOCAL_EMBEDDING_BATCH", 64))
+LOCAL_THREADS = int(os.environ.get("LOCAL_EMBEDDING_THREADS", os.cpu_count() or 1))
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    sentence-transformers model run in-process on the CPU, loaded on the first embedding call.
+    """
+
+    def __init__(self, model=LOCAL_MODEL, backend=LOCAL_BACKEND, model_file=LOCAL_MODEL_FILE, quantize=LOCAL_QUANTIZE,
+                 batch_size=LOCAL_BATCH_SIZE, threads=LOCAL_THREADS):
+        if backend not in LOCAL_BACKENDS:
+            raise ValueError(f"Unknown local embedding backend {backend!r}, expected one of {LOCAL_BACKENDS}")
+        self.model = model
+        self.backend = backend
+        self.model_file = model_file
+        self.quantize = quantize
+        self.batch_size = batch_size
+        self.threads = threads
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    @property
+    def variant(self):
+        """
+        How the weights are run, when it changes the vectors (part of model_key()).
+        """
+        parts = []
+        if self.backend != "torch":
+            parts.append(self.backend)
+        if self.model_file:
+            parts.append(os.path.basename(self.model_file))
+        if self.quantize and self.backend == "torch":
+            parts.append("qint8")
+        return "/".join(parts) or None
+
+    def _load(self):
+        with self._lock:
+            if self._encoder is not None:
+                return self._encoder
+            with stage("load_embedding_model"):
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                torch.set_num_threads(self.threads)
+                model_kwargs = {"file_name": self.model_file} if self.model_file else None
+                encoder = SentenceTransformer(self.model, device="cpu", backend=self.backend, model_kwargs=model_kwargs)
+                if self.quantize and self.backend == "torch":
+                    encoder = torch.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+            print(f"Loaded local embedding model {model_key(self)} ({self.threads} threads).")
+            self._encoder = encoder
+            return encoder
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        encoder = self._load()
+        with stage("local_embed"):
+            vectors = encoder.encode(
+                list(texts), batch_size=self.batch_size, convert_to_numpy=True,
+                normalize_embeddings=True, show_progress_bar=False,
+            )
+        count("local_embedded_texts", len(texts))
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,147 @@
+"""
+Exact top-k search streamed from the MongoDB `document_embeddings` collection, for when no vector index has
+been built yet (e.g. right after ingestion).
+
+Only _id and the embedding fields are fetched, batch_size documents per cursor round trip. Each batch is
+decoded into one float32 block, scored against every query with a single matrix product, and only the best
+top_k of each query are kept, in bounded heaps. Memory is therefore O(batch_size + top_k) whatever the size of
+the collection. Large collections are split into _id ranges of about the same number of documents, scanned in
+parallel by worker processes with their own MongoClient, and the partial top-k lists are merged at the end.
+
+Environment variables:
+    MONGO_SCAN_BATCH_SIZE:    documents per cursor batch and scoring block (default 1000)
+    MONGO_SCAN_WORKERS:       maximum number of worker processes (default: number of CPUs)
+    MONGO_SCAN_MIN_PARTITION: minimum documents per worker process; smaller collections are scanned in-process,
+                              as starting a worker costs more than scanning them (default 20000)
+"""
+import heapq
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pymongo import MongoClient
+
+from embedding_storage import EMBEDDING_FIELDS, decode_embedding, normalize_rows
+from instrumentation import count, stage
+
+SCAN_BATCH_SIZE = int(os.environ.get("MONGO_SCAN_BATCH_SIZE", 1000))
+SCAN_WORKERS = int(os.environ.get("MONGO_SCAN_WORKERS", os.cpu_count() or 1))
+MIN_PARTITION = int(os.environ.get("MONGO_SCAN_MIN_PARTITION", 20000))
+
+
+def scan_range(collection, queries, top_k, batch_size=SCAN_BATCH_SIZE, lower=None, upper=None):
+    """
+    Exact top_k of each query over the documents with lower <= _id < upper (None for no bound).
+    :param queries: ndarray: L2-normalised query embeddings, one per row.
+    :return: tuple: (list of (score, _id) heaps of at most top_k entries, one per query; number of documents
+             scanned; set of the embedders recorded on them).
+    """
+    id_range = {}
+    if lower is not None:
+        id_range["$gte"] = lower
+    if upper is not None:
+        id_range["$lt"] = upper
+    cursor = collection.find({"_id": id_range} if id_range else {}, {**EMBEDDING_FIELDS, "embedder": 1}).batch_size(batch_size)
+
+    heaps = [[] for _ in range(len(queries))]
+    scanned = 0
+    embedders = set()
+    ids = []
+    vectors = []
+
+    def score_block():
+        scores = queries @ normalize_rows(np.stack(vectors)).T
+        k = min(top_k, len(ids))
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for heap, row_scores, rows in zip(heaps, scores, best):
+            for row in rows:
+                entry = (float(row_scores[row]), ids[row])
+                if len(heap) < top_k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        ids.clear()
+        vectors.clear()
+
+    for doc in cursor:
+        ids.append(doc["_id"])
+        vectors.append(decode_embedding(doc))
+        embedders.add(doc.get("embedder"))
+        scanned += 1
+        if len(ids) >= batch_size:
+            score_block()
+    if ids:
+        score_block()
+    return heaps, scanned, embedders
+
+
+def scan_partition(mongo_uri, namespace, queries, top_k, batch_size, lower, upper):
+    """
+    scan_range in a worker process, over a connection of its own.
+    :param namespace: string: "<database>.<collection>" to scan.
+    """
+    db_name, collection_name = namespace.split(".", 1)
+    client = MongoClient(mongo_uri)
+    try:
+        return scan_range(client[db_name][collection_name], queries, top_k, batch_size, lower, upper)
+    finally:
+        client.close()
+
+
+def partition_bounds(collection, partitions):
+    """
+    (lower, upper) _id ranges splitting the collection into about equal parts, None meaning unbounded.
+    """
+    total = collection.estimated_document_count()
+    bounds = []
+    for part in range(1, partitions):
+        doc = collection.find_one({}, {"_id": 1}, sort=[("_id", 1)], skip=part * total // partitions)
+        if doc is not None and (not bounds or doc["_id"] > bounds[-1]):
+            bounds.append(doc["_id"])
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def merge_top_k(partials, top_k):
+    """
+    Merge the per-query heaps of several scan_range results.
+    :return: list: the best top_k (_id, score) pairs of each query, best first.
+    """
+    merged = []
+    for heaps in zip(*partials):
+        best = heapq.nlargest(top_k, (entry for heap in heaps for entry in heap))
+        merged.append([(_id, score) for score, _id in best])
+    return merged
+
+
+def scan_top_k(collection, query_embeddings, top_k=5, mongo_uri=None, namespace=None, workers=SCAN_WORKERS,
+               batch_size=SCAN_BATCH_SIZE):
+    """
+    Exact cosine top_k of each query embedding over the whole collection.
+    :param mongo_uri: string: URI the collection was opened with, needed to scan with worker processes; without it
+                      the collection is scanned in-process.
+    :param namespace: string: "<database>.<collection>" the workers scan (default: collection.full_name).
+    :return: tuple: (list of the best top_k (_id, score) pairs of each query, best first; set of the embedders
+             recorded on the scanned documents).
+    """
+    queries = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+    namespace = namespace or collection.full_name
+    partitions = min(workers, collection.estimated_document_count() // MIN_PARTITION) if mongo_uri else 1
+
+    with stage("similarity_scan", workers=max(partitions, 1)):
+        if partitions <= 1:
+            results = [scan_range(collection, queries, top_k, batch_size)]
+        else:
+            ranges = partition_bounds(collection, partitions)
+            # Spawn rather than fork: a MongoClient must not be shared with a forked child
+            with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [
+                    executor.submit(scan_partition, mongo_uri, namespace, queries, top_k, batch_size, lower, upper)
+                    for lower, upper in ranges
+                ]
+                results = [future.result() for future in futures]
+
+    count("documents_scanned", sum(scanned for _heaps, scanned, _embedders in results))
+    embedders = set().union(*(embedders for _heaps, _scanned, embedders in results))
+    return merge_top_k([heaps for heaps, _scanned, _embedders in results], top_k), embedders
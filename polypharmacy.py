@@ -0,0 +1,127 @@
+"""
+Polypharmacy mode: check a patient's whole medication list for drug-drug interactions at once.
+
+The medications are resolved against the DDInter drug vocabulary and every pair is looked up in a single
+vectorized join over the DDInter index (see ddinter_index.py), ranked from most to least severe.
+Retrieval and the LLM then run only once, to summarise the high-severity pairs.
+
+Usage:
+    python polypharmacy.py warfarin amiodarone simvastatin clarithromycin
+    python polypharmacy.py --file medications.txt --summarize Moderate
+    python polypharmacy.py warfarin aspirin --no-summary
+"""
+import argparse
+
+from ddinter_index import LEVELS, load_ddinter_index
+
+
+def check_medications(medications, ddinter=None):
+    """
+    Find every interacting pair in a medication list.
+    :param medications: List[string]: drug names, DDInter ids or synonyms.
+    :return: Dict: resolved drug names, unresolved inputs and the interactions ranked by severity.
+    """
+    if ddinter is None:
+        ddinter = load_ddinter_index()
+        if ddinter is None:
+            raise FileNotFoundError("DDInter index not found. Run `python ddinter_index.py` to build it.")
+
+    drug_ids = []
+    unresolved = []
+    for medication in medications:
+        drug_id = ddinter.resolve(medication)
+        if drug_id is None:
+            unresolved.append(medication)
+        elif drug_id not in drug_ids:
+            drug_ids.append(drug_id)
+
+    drug_a, drug_b, levels = ddinter.pairwise_interactions(drug_ids)
+    interactions = [
+        {"drug_a": str(ddinter.names[a]), "drug_b": str(ddinter.names[b]), "level": LEVELS[level]}
+        for a, b, level in zip(drug_a.tolist(), drug_b.tolist(), levels.tolist())
+    ]
+    interactions.sort(key=lambda interaction: (-LEVELS.index(interaction["level"]), interaction["drug_a"], interaction["drug_b"]))
+
+    return {
+        "drugs": [str(ddinter.names[drug_id]) for drug_id in drug_ids],
+        "unresolved": unresolved,
+        "interactions": interactions,
+    }
+
+
+def summarize_interactions(report, min_level="Major"):
+    """
+    Run retrieval and the LLM once to explain every interaction at or above min_level.
+    :return: string: the model's summary, or None if no interaction reaches min_level.
+    """
+    threshold = LEVELS.index(min_level)
+    severe = [interaction for interaction in report["interactions"] if LEVELS.index(interaction["level"]) >= threshold]
+    if not severe:
+        return None
+
+    # Imported here so that the interaction check works without OpenAI credentials
+    import asyncio
+    from langchain_openai import ChatOpenAI
+    from embedders import get_embeddings
+    from embedding_cache import cached
+    from answer_cache import AnswerCache, context_key
+    from streaming import cached_or_streamed
+    from Langchain_v2_query_data_mongodb import build_prompt, query_mongodb
+
+    pairs = "; ".join(f"{interaction['drug_a']} and {interaction['drug_b']}" for interaction in severe)
+    query_text = (
+        f"A patient is taking {', '.join(report['drugs'])}. "
+        f"What are the risks of, and how should a clinician manage, the interactions between {pairs}?"
+    )
+    known_interactions = [
+        f"{interaction['drug_a']} and {interaction['drug_b']} have a {interaction['level']} interaction according to DDInter."
+        for interaction in severe
+    ]
+
+    embedding_function = cached(get_embeddings())
+    query_embedding = embedding_function.embed_query(query_text)
+    results = query_mongodb(query_embedding, top_k=5, embedding_function=embedding_function)
+    prompt = build_prompt(query_text, results, known_interactions)
+
+    model = ChatOpenAI(stream_usage=True)
+    context = context_key("mongodb", [str(doc["_id"]) for doc, _score in results], known_interactions)
+    response, _cached, _first_token = asyncio.run(
+        cached_or_streamed(AnswerCache(), model, prompt, query_text, query_embedding, context)
+    )
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a medication list for drug-drug interactions.")
+    parser.add_argument("medications", type=str, nargs="*", help="Medication names.")
+    parser.add_argument("--file", type=str, default=None, help="File with one medication per line.")
+    parser.add_argument("--summarize", type=str, default="Major", choices=LEVELS, help="Minimum level of the interactions summarised by the LLM.")
+    parser.add_argument("--no-summary", action="store_true", help="Only list the interactions, without calling the LLM.")
+    args = parser.parse_args()
+
+    medications = list(args.medications)
+    if args.file:
+        with open(args.file) as file:
+            medications.extend(line.strip() for line in file if line.strip())
+    if len(medications) < 2:
+        parser.error("Provide at least two medications.")
+
+    report = check_medications(medications)
+    if report["unresolved"]:
+        print(f"Not found in DDInter: {', '.join(report['unresolved'])}")
+
+    num_drugs = len(report["drugs"])
+    print(f"Checked {num_drugs * (num_drugs - 1) // 2} pairs of {num_drugs} drugs, found {len(report['interactions'])} interactions:")
+    for interaction in report["interactions"]:
+        print(f"{interaction['level']:>9}: {interaction['drug_a']} + {interaction['drug_b']}")
+
+    if not args.no_summary:
+        summary = summarize_interactions(report, min_level=args.summarize)
+        if summary is None:
+            print(f"\nNo interactions at level {args.summarize} or above to summarise.")
+        else:
+            print(f"\nResponse: {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Thin command-line client for the local query service (query_service.py).
+
+Only the standard library is imported, so a query costs a process start plus one HTTP round trip;
+the embeddings, vector index, database connections and LLM client stay warm in the service.
+
+Usage:
+    python query_client.py "Can I take ibuprofen with warfarin?"
+    python query_client.py "warfarin and aspirin" --ddinter-only
+    python query_client.py "..." --backend chroma --socket /tmp/drugwise.sock
+"""
+import argparse
+import http.client
+import json
+import socket
+import sys
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8750
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection over a Unix domain socket.
+    """
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(method, path, payload=None, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, timeout=300):
+    """
+    Send one request to the query service and return the decoded JSON reply.
+    """
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        reply = json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(reply.get("error", f"HTTP {response.status}"))
+    return reply
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the running DrugWise query service.")
+    parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("--backend", type=str, default="mongodb", choices=["mongodb", "chroma"], help="Vector store to search.")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of documents to retrieve.")
+    parser.add_argument("--ddinter-only", action="store_true", help="Only report the DDInter interactions between drugs named in the query.")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Host of the query service.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port of the query service.")
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket of the query service, instead of host/port.")
+    parser.add_argument("--timings", action="store_true", help="Print how long each step took in the service.")
+    args = parser.parse_args()
+
+    payload = {
+        "query": args.query_text,
+        "backend": args.backend,
+        "top_k": args.top_k,
+        "ddinter_only": args.ddinter_only,
+    }
+    try:
+        reply = request("POST", "/query", payload, host=args.host, port=args.port, socket_path=args.socket)
+    except (OSError, RuntimeError) as e:
+        print(f"Query service error: {e}. Is `python query_service.py` running?", file=sys.stderr)
+        sys.exit(1)
+
+    for line in reply["known_interactions"]:
+        print(line)
+    if args.ddinter_only:
+        if not reply["known_interactions"]:
+            print("No pair of DDInter drugs found in the query.")
+    elif reply["response"] is None:
+        print(f"\n\nUnable to find matching results.")
+    else:
+        for i, source in enumerate(reply["sources"]):
+            print(f"{i+1}. Document ID: {source['url']}, Similarity Score: {source['score']:.4f}")
+        print(f"Response: {reply['response']}")
+        if reply["cached"]:
+            print("(Answer served from the answer cache.)")
+
+    if args.timings:
+        print("Timings: " + ", ".join(f"{step} {ms:.0f} ms" for step, ms in reply["timings"].items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Long-running local query service for the MongoDB and Chroma RAG pipelines.
+
+Every run of Langchain_v2_query_data_mongodb.py / Langchain_v2_query_data_chroma.py pays for the langchain
+imports, load_dotenv, a new MongoClient, new OpenAI clients and (for Chroma) reopening the persisted DB
+before it retrieves anything. The service does all of that once and keeps it warm:
+    - one pooled MongoClient and the memory-mapped vector index (reloaded only when it is rebuilt)
+    - the cached embeddings (OpenAI or a local model, see embedders.py) and the semantic answer cache
+    - the DDInter index and, on first use, the Chroma DB
+Requests are handled concurrently by an asyncio (aiohttp) server. Blocking embedding and retrieval calls run
+in a thread pool and the LLM is awaited natively, so a warm query costs only embedding + retrieval + LLM time.
+
+Endpoints:
+    POST /query   {"query": ..., "backend": "mongodb"|"chroma", "top_k": 5, "ddinter_only": false}
+    GET  /health  index sizes and embedding/answer cache statistics
+    GET  /metrics per-stage timers and counters in Prometheus text format (see instrumentation.py)
+
+Usage:
+    python query_service.py                            # serve on http://127.0.0.1:8750
+    python query_service.py --socket /tmp/drugwise.sock
+    python query_client.py "Can I take ibuprofen with warfarin?"
+"""
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from pymongo import MongoClient
+
+import Langchain_v2_query_data_chroma as chroma_query
+import Langchain_v2_query_data_mongodb as mongodb_query
+from ddinter_index import load_ddinter_index
+from embedders import DEFAULT_EMBEDDER, EMBEDDERS, get_embeddings
+from embedding_cache import cached, model_key
+from answer_cache import AnswerCache
+from instrumentation import prometheus_text, stage
+from query_client import DEFAULT_HOST, DEFAULT_PORT
+from vector_index import load_index
+
+DEFAULT_WORKERS = 16
+
+# Largest top_k a request may ask for
+MAX_TOP_K = 50
+
+# Query pipeline of each backend; the minimum similarity of a match is each script's MIN_SCORE
+BACKENDS = {"mongodb": mongodb_query, "chroma": chroma_query}
+
+
+class QueryService:
+    """
+    Warm state shared by every request.
+    """
+
+    def __init__(self, embedder=None):
+        self.client = MongoClient(mongodb_query.MONGO_URI)
+        self.collection = self.client[mongodb_query.DB_NAME][mongodb_query.COLLECTION_NAME]
+        self.embedding_function = cached(get_embeddings(embedder))
+        self.answers = AnswerCache()
+        self.ddinter = load_ddinter_index()
+        self._chroma = None
+        self._chroma_lock = threading.Lock()
+
+        index = load_index()
+        print(f"Vector index: {len(index) if index is not None else 'not built'} embeddings, querying with {model_key(self.embedding_function)}.")
+        print(f"DDInter index: {len(self.ddinter) if self.ddinter is not None else 'not built'} drugs.")
+
+    def chroma(self):
+        """
+        The persisted Chroma DB, opened on first use.
+        """
+        with self._chroma_lock:
+            if self._chroma is None:
+                self._chroma = chroma_query.open_chroma(self.embedding_function)
+            return self._chroma
+
+    async def answer(self, query_text, backend="mongodb", top_k=5, ddinter_only=False):
+        """
+        Run the query pipeline of the given backend (answer_query_async of its query script) with the warm state.
+        :return: Dict: known DDInter interactions, retrieved sources, the LLM response (None if nothing matched),
+                 whether it came from the answer cache and the time to the first token and in total in milliseconds.
+        """
+        start = time.perf_counter()
+        shared = {"embedding_function": self.embedding_function, "answers": self.answers, "ddinter": self.ddinter, "top_k": top_k}
+        with stage("query", backend=backend):
+            if backend == "mongodb":
+                reply = await mongodb_query.answer_query_async(query_text, ddinter_only, collection=self.collection,
+                                                               mongo_uri=mongodb_query.MONGO_URI, **shared)
+            else:
+                db = None if ddinter_only else await asyncio.to_thread(self.chroma)
+                reply = await chroma_query.answer_query_async(query_text, ddinter_only, db=db, **shared)
+
+        reply["timings"] = {"total": (time.perf_counter() - start) * 1000}
+        if reply["time_to_first_token"] is not None:
+            reply["timings"]["first_token"] = reply["time_to_first_token"] * 1000
+        return reply
+
+
+def make_app(service):
+    """
+    aiohttp application exposing the service.
+    """
+
+    async def handle_query(request):
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Request body must be JSON."}, status=400)
+        query_text = payload.get("query")
+        backend = payload.get("backend", "mongodb")
+        if not isinstance(query_text, str) or not query_text.strip():
+            return web.json_response({"error": "Missing query."}, status=400)
+        if backend not in BACKENDS:
+            return web.json_response({"error": f"Unknown backend {backend!r}."}, status=400)
+        top_k = payload.get("top_k", 5)
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= MAX_TOP_K:
+            return web.json_response({"error": f"top_k must be an integer from 1 to {MAX_TOP_K}."}, status=400)
+
+        try:
+            reply = await service.answer(
+                query_text, backend=backend, top_k=top_k, ddinter_only=bool(payload.get("ddinter_only", False))
+            )
+        except Exception as e:
+            print(f"Error answering {query_text!r}: {e}")
+            return web.json_response({"error": str(e)}, status=500)
+        return web.json_response(reply)
+
+    async def handle_health(request):
+        index = load_index()
+        return web.json_response({
+            "vector_index": len(index) if index is not None else None,
+            "ddinter_drugs": len(service.ddinter) if service.ddinter is not None else None,
+            "embedding_cache": service.embedding_function.stats(),
+            "answer_cache": service.answers.stats(),
+        })
+
+    async def handle_metrics(request):
+        return web.Response(text=prometheus_text(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_post("/query", handle_query)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, workers=DEFAULT_WORKERS, embedder=None):
+    """
+    Warm up the service and serve requests until interrupted.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query"))
+    service = QueryService(embedder)
+
+    runner = web.AppRunner(make_app(service))
+    await runner.setup()
+    if socket_path:
+        site = web.UnixSite(runner, socket_path)
+    else:
+        site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"Query service listening on {socket_path or f'http://{host}:{port}'}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        service.client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve DrugWise queries from a warm, long-running process.")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on.")
+    parser.add_argument("--socket", type=str, default=None, help="Listen on this Unix socket instead of host/port.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Threads running embedding and retrieval calls.")
+    parser.add_argument("--embedder", type=str, default=DEFAULT_EMBEDDER, choices=EMBEDDERS, help="Embedding backend; must match the one used for ingestion.")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.socket, args.workers, args.embedder))
+    except KeyboardInterrupt:
+        pass
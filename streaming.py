@@ -0,0 +1,66 @@
+"""
+Streaming chat model calls for the query scripts.
+
+The response is passed on piece by piece as the model generates it, so the CLI can print it right away
+instead of after the whole generation. The wait for the first piece is timed as the llm_first_token stage
+(time to first token), nested in the llm stage that times the whole call (see instrumentation.py).
+"""
+import asyncio
+import sys
+import time
+
+from instrumentation import count_llm_usage, stage
+
+
+async def stream_generate(model, prompt, on_token=None):
+    """
+    Stream the chat model's response to prompt.
+    :param on_token: callable: called with each piece of the response text as it arrives.
+    :return: tuple: (response text, seconds until the first piece arrived, or None if the response was empty).
+    """
+    start = time.perf_counter()
+    message = None
+    first_token = None
+    with stage("llm"):
+        stream = model.astream(prompt).__aiter__()
+        with stage("llm_first_token"):
+            chunk = await anext(stream, None)
+        while chunk is not None:
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            message = chunk if message is None else message + chunk
+            if on_token is not None and chunk.content:
+                on_token(chunk.content)
+            chunk = await anext(stream, None)
+    if message is None:
+        return "", None
+    # The usage is only reported on the last chunk (with ChatOpenAI(stream_usage=True))
+    count_llm_usage(message)
+    return message.content, first_token
+
+
+async def cached_or_streamed(answers, model, prompt, query_text, query_embedding, context, on_token=None):
+    """
+    The answer cache's response for a similar query with the same context (passed to on_token in one piece),
+    or else the model's streamed response to prompt, which is then cached unless it is empty (e.g. an aborted
+    stream), so that an empty response is not served to every similar query.
+    :return: tuple: (response text, whether it came from the cache, seconds to the first token or None).
+    """
+    response = await asyncio.to_thread(answers.lookup, query_embedding, context)
+    if response is not None:
+        if on_token is not None:
+            on_token(response)
+        return response, True, None
+    start = time.perf_counter()
+    response, first_token = await stream_generate(model, prompt, on_token)
+    if response:
+        await asyncio.to_thread(answers.store, query_text, query_embedding, context, response, time.perf_counter() - start)
+    return response, False, first_token
+
+
+def print_token(text):
+    """
+    on_token callback printing the response to the terminal as it streams.
+    """
+    sys.stdout.write(text)
+    sys.stdout.flush()
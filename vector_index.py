@@ -0,0 +1,509 @@
+"""
+Persistent vector index over the MongoDB `document_embeddings` collection.
+
+The index is a directory holding:
+    embeddings.f32: row-major float32 matrix of L2-normalised embeddings, opened with np.memmap
+    metadata.json:  sidecar mapping each row to its MongoDB _id plus the url/source/page of the chunk,
+                    the rows of deleted documents, the ANN settings and the embedder that produced the vectors
+    ann.faiss:      optional faiss approximate nearest neighbour index over the same rows
+
+With the default "exact" backend a query is a single matrix-vector product followed by an argpartition
+top-k. The "hnsw" (faiss IndexHNSWFlat) and "ivfpq" (faiss IndexIVFPQ) backends only shortlist
+rerank * top_k candidates, which are then re-scored exactly against the matrix, so the returned scores are
+true cosine similarities whatever the backend. Either way only the k winning documents have to be fetched
+back from MongoDB.
+
+update_index() brings an existing index up to date after incremental ingestion: new documents are appended
+to the matrix and added to the ANN index, and deleted ones are masked out until they make up more than
+REBUILD_FRACTION of the rows, at which point the index is rebuilt.
+
+Build settings (persisted in the sidecar):
+    VECTOR_INDEX_BACKEND:         exact, hnsw or ivfpq (default exact)
+    VECTOR_INDEX_HNSW_M:          HNSW graph degree (default 32)
+    VECTOR_INDEX_EF_CONSTRUCTION: HNSW build beam width (default 200)
+    VECTOR_INDEX_NLIST:           IVF lists (default 4 * sqrt(rows))
+    VECTOR_INDEX_PQ_M:            PQ sub-quantizers, must divide the dimension (default about dim / 16)
+Search settings (read when the index is loaded, so they can be tuned without rebuilding):
+    VECTOR_INDEX_EF_SEARCH:       HNSW search beam width (default 128)
+    VECTOR_INDEX_NPROBE:          IVF lists visited per query (default 16)
+    VECTOR_INDEX_RERANK:          candidates re-scored exactly per requested result (default 10; IVF-PQ codes are
+                                  coarse, so it usually needs a larger value than HNSW for the same recall)
+
+Usage:
+    python vector_index.py                        # (re)build the index from MongoDB
+    python vector_index.py --backend hnsw         # build an HNSW index
+    python vector_index.py --update               # apply inserts and deletes since the last build
+    python vector_index.py --evaluate             # recall@k and latency of the index against exact search
+    python vector_index.py --evaluate --rerank 20 --nprobe 32   # ... with other search settings
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from bson import ObjectId
+from pymongo import MongoClient
+
+from embedding_storage import EMBEDDING_FIELDS, decode_embedding
+from instrumentation import stage
+
+# MongoDB connection details
+MONGO_URI = "mongodb://localhost:27017"
+DB_NAME = "DrugWise"
+COLLECTION_NAME = "document_embeddings"
+
+INDEX_PATH = "vector_index"
+EMBEDDINGS_FILE = "embeddings.f32"
+METADATA_FILE = "metadata.json"
+ANN_FILE = "ann.faiss"
+
+BACKENDS = ["exact", "hnsw", "ivfpq"]
+DEFAULT_BACKEND = os.environ.get("VECTOR_INDEX_BACKEND", "exact")
+HNSW_M = int(os.environ.get("VECTOR_INDEX_HNSW_M", 32))
+EF_CONSTRUCTION = int(os.environ.get("VECTOR_INDEX_EF_CONSTRUCTION", 200))
+NLIST = int(os.environ.get("VECTOR_INDEX_NLIST", 0))
+PQ_M = int(os.environ.get("VECTOR_INDEX_PQ_M", 0))
+EF_SEARCH = int(os.environ.get("VECTOR_INDEX_EF_SEARCH", 128))
+NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE", 16))
+RERANK = int(os.environ.get("VECTOR_INDEX_RERANK", 10))
+
+# IVF-PQ needs enough rows to train its codebooks (faiss wants 39 per centroid); smaller corpora use exact search
+IVFPQ_MIN_ROWS = 10000
+# Rebuild instead of updating once this fraction of the rows belongs to deleted documents
+REBUILD_FRACTION = 0.2
+# Largest (queries x rows) block of scores computed at once by search_batch (64 MB of float32)
+SCORE_BLOCK = 2 ** 24
+
+
+class VectorIndex:
+    """
+    Pre-normalised embedding matrix plus the MongoDB ids of its rows, optionally with an ANN index over them.
+    """
+
+    def __init__(self, embeddings, ids, metadata, ann=None, deleted=(), rerank=RERANK, embedder=None):
+        self.embeddings = embeddings
+        self.ids = ids
+        self.metadata = metadata
+        self.ann = ann
+        self.rerank = rerank
+        self.deleted = np.asarray(sorted(deleted), dtype=np.int64)
+        self.embedder = embedder
+
+    def __len__(self):
+        return len(self.ids) - len(self.deleted)
+
+    def search(self, query_embedding, top_k=5):
+        """
+        Return the top_k (ObjectId, cosine similarity) pairs for the query embedding, best first.
+        """
+        if len(self) == 0:
+            return []
+        with stage("index_search"):
+            return self._search(query_embedding, top_k)
+
+    def search_batch(self, query_embeddings, top_k=5):
+        """
+        search() for several queries at once: the exact backend scores whole blocks of queries with one
+        matrix-matrix product, and the ANN backends shortlist every query with one batched faiss search.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if len(self) == 0:
+            return [[] for _query in queries]
+        with stage("index_search_batch"):
+            return self._search_batch(queries, top_k)
+
+    def _search(self, query_embedding, top_k):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        if self.ann is not None:
+            _scores, candidates = self.ann.search(query.reshape(1, -1), self._num_candidates(top_k))
+            return self._rerank(query, candidates[0], top_k)
+
+        scores = self.embeddings @ query
+        if len(self.deleted):
+            scores[self.deleted] = -np.inf
+        return self._top(scores, None, top_k)
+
+    def _search_batch(self, queries, top_k):
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1)
+
+        if self.ann is not None:
+            _scores, candidates = self.ann.search(np.ascontiguousarray(queries), self._num_candidates(top_k))
+            return [self._rerank(query, row_candidates, top_k) for query, row_candidates in zip(queries, candidates)]
+
+        # Bound the (queries x rows) score matrix to SCORE_BLOCK floats
+        block_size = max(1, SCORE_BLOCK // len(self.ids))
+        results = []
+        for start in range(0, len(queries), block_size):
+            scores = queries[start:start + block_size] @ self.embeddings.T
+            if len(self.deleted):
+                scores[:, self.deleted] = -np.inf
+            results.extend(self._top(row_scores, None, top_k) for row_scores in scores)
+        return results
+
+    def _num_candidates(self, top_k):
+        return min(len(self.ids), top_k * max(1, self.rerank) + len(self.deleted))
+
+    def _rerank(self, query, candidates, top_k):
+        """
+        Score the ANN candidates of a query exactly, skipping padding and deleted rows.
+        """
+        candidates = candidates[candidates >= 0]
+        if len(self.deleted):
+            candidates = candidates[~np.isin(candidates, self.deleted)]
+        rows = np.sort(candidates)
+        return self._top(self.embeddings[rows] @ query, rows, top_k)
+
+    def _top(self, scores, rows, top_k):
+        """
+        The top_k (ObjectId, score) pairs of scores, best first; rows maps positions in scores to index rows.
+        """
+        top_k = min(top_k, len(self), len(scores))
+        if top_k <= 0:
+            return []
+        top = np.argpartition(scores, -top_k)[-top_k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        winners = rows[top] if rows is not None else top
+        return [(self.ids[i], float(score)) for i, score in zip(winners, scores[top])]
+
+
+def default_pq_m(dim):
+    """
+    Number of PQ sub-quantizers: about one per 16 dimensions, rounded down to a divisor of dim.
+    """
+    for m in range(max(1, dim // 16), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def create_ann(matrix, backend, settings):
+    """
+    Build a faiss index of the given backend over the rows of matrix (inner product of unit vectors).
+    :param settings: dict: build settings, completed in place with the values actually used.
+    :return: faiss index, or None for exact search.
+    """
+    if backend == "exact":
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown vector index backend {backend!r}, expected one of {BACKENDS}")
+    import faiss
+
+    rows, dim = matrix.shape
+    if backend == "hnsw":
+        settings.setdefault("hnsw_m", HNSW_M)
+        settings.setdefault("ef_construction", EF_CONSTRUCTION)
+        ann = faiss.IndexHNSWFlat(dim, settings["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+        ann.hnsw.efConstruction = settings["ef_construction"]
+    else:
+        if rows < IVFPQ_MIN_ROWS:
+            print(f"Only {rows} embeddings, too few to train IVF-PQ; using exact search.")
+            settings.update(backend="exact", requested="ivfpq")
+            return None
+        settings.setdefault("nlist", min(NLIST or int(4 * np.sqrt(rows)), rows // 39))
+        settings.setdefault("pq_m", PQ_M or default_pq_m(dim))
+        quantizer = faiss.IndexFlatIP(dim)
+        ann = faiss.IndexIVFPQ(quantizer, dim, settings["nlist"], settings["pq_m"], 8, faiss.METRIC_INNER_PRODUCT)
+        sample_size = min(rows, max(settings["nlist"] * 64, 20000))
+        sample = np.sort(np.random.default_rng(0).choice(rows, size=sample_size, replace=False))
+        ann.train(np.ascontiguousarray(matrix[sample]))
+
+    # Add in blocks so that a memory-mapped matrix is never loaded all at once
+    for start in range(0, rows, 10000):
+        ann.add(np.ascontiguousarray(matrix[start:start + 10000]))
+    return ann
+
+
+def configure_ann(ann):
+    """
+    Apply the search-time settings to a loaded faiss index.
+    """
+    if hasattr(ann, "hnsw"):
+        ann.hnsw.efSearch = EF_SEARCH
+    if hasattr(ann, "nprobe"):
+        ann.nprobe = NPROBE
+    return ann
+
+
+def chunk_metadata(doc):
+    doc_metadata = doc.get("metadata") or {}
+    return {
+        "url": doc.get("url"),
+        "source": doc_metadata.get("source"),
+        "page": doc_metadata.get("page"),
+    }
+
+
+def normalized_embedding(doc):
+    vector = decode_embedding(doc)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def document_embedder(doc, embedder):
+    """
+    Check that doc was embedded with the same model as the documents before it.
+    :param embedder: string: model_key() of the previous documents, or None if none had one (legacy data).
+    :return: string: the embedder of the documents so far.
+    """
+    if doc.get("embedder") and embedder and doc["embedder"] != embedder:
+        raise ValueError(f"The collection mixes {embedder} and {doc['embedder']} embeddings; run a full ingestion with one embedder.")
+    return embedder or doc.get("embedder")
+
+
+def write_sidecar(metadata_path, sidecar):
+    with open(metadata_path + ".tmp", "w") as file:
+        json.dump(sidecar, file)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def index_settings(index_path=INDEX_PATH):
+    """
+    ANN settings recorded in the index at index_path, or {} if it has not been built yet.
+    """
+    metadata_path = os.path.join(index_path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return {}
+    with open(metadata_path) as file:
+        return json.load(file).get("ann", {"backend": "exact"})
+
+
+def build_index(collection, index_path=INDEX_PATH, backend=None):
+    """
+    Stream every embedding out of the collection into a new index at index_path.
+    The files are written next to the old ones and swapped in at the end, so readers never see a partial index.
+    :param backend: string: exact, hnsw or ivfpq; defaults to the backend of the existing index, else VECTOR_INDEX_BACKEND.
+    """
+    if backend is None:
+        settings = index_settings(index_path)
+        backend = settings.get("requested", settings.get("backend", DEFAULT_BACKEND))
+    with stage("build_index", backend=backend):
+        _build_index(collection, index_path, backend)
+
+
+def _build_index(collection, index_path, backend):
+    os.makedirs(index_path, exist_ok=True)
+    embeddings_path = os.path.join(index_path, EMBEDDINGS_FILE)
+    metadata_path = os.path.join(index_path, METADATA_FILE)
+    ann_path = os.path.join(index_path, ANN_FILE)
+
+    count = collection.count_documents({})
+    first = collection.find_one({}, EMBEDDING_FIELDS)
+    dim = len(decode_embedding(first)) if first else 0
+
+    ids = []
+    metadata = []
+    embedder = None
+    matrix = None
+    if count and dim:
+        matrix = np.memmap(embeddings_path + ".tmp", dtype=np.float32, mode="w+", shape=(count, dim))
+        cursor = collection.find({}, {**EMBEDDING_FIELDS, "url": 1, "metadata": 1, "embedder": 1}).batch_size(1000)
+        for row, doc in enumerate(cursor):
+            # Documents inserted while we are streaming are left for the next build
+            if row >= count:
+                break
+            embedder = document_embedder(doc, embedder)
+            matrix[row] = normalized_embedding(doc)
+            ids.append(str(doc["_id"]))
+            metadata.append(chunk_metadata(doc))
+        matrix.flush()
+        del matrix
+
+    settings = {"backend": backend}
+    ann = None
+    if ids:
+        # Drop the rows of documents that were deleted while we were streaming
+        if len(ids) < count:
+            with open(embeddings_path + ".tmp", "r+b") as file:
+                file.truncate(len(ids) * dim * np.dtype(np.float32).itemsize)
+        matrix = np.memmap(embeddings_path + ".tmp", dtype=np.float32, mode="r", shape=(len(ids), dim))
+        with stage("build_ann", backend=backend):
+            ann = create_ann(matrix, backend, settings)
+        del matrix
+    if ann is not None:
+        import faiss
+        faiss.write_index(ann, ann_path + ".tmp")
+
+    if ids:
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+    else:
+        if os.path.exists(embeddings_path + ".tmp"):
+            os.remove(embeddings_path + ".tmp")
+        if os.path.exists(embeddings_path):
+            os.remove(embeddings_path)
+    if ann is not None:
+        os.replace(ann_path + ".tmp", ann_path)
+    elif os.path.exists(ann_path):
+        os.remove(ann_path)
+    write_sidecar(metadata_path, {"dim": dim, "count": len(ids), "ids": ids, "metadata": metadata, "deleted": [], "ann": settings, "embedder": embedder})
+
+    print(f"Built {settings['backend']} vector index with {len(ids)} embeddings at {index_path}.")
+
+
+def update_index(collection, index_path=INDEX_PATH):
+    """
+    Apply the documents inserted into and deleted from the collection since the index was last written:
+    new rows are appended (and added to the ANN index) and deleted rows are masked, instead of rebuilding.
+    Falls back to build_index when there is no index yet, the dimension changed or too many rows were deleted.
+    """
+    metadata_path = os.path.join(index_path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        build_index(collection, index_path)
+        return
+    with open(metadata_path) as file:
+        sidecar = json.load(file)
+    settings = sidecar.get("ann", {"backend": "exact"})
+
+    with stage("update_index", backend=settings["backend"]):
+        rows = {_id: row for row, _id in enumerate(sidecar["ids"])}
+        current = {str(doc["_id"]) for doc in collection.find({}, {"_id": 1}).batch_size(10000)}
+        previously_deleted = set(sidecar.get("deleted", []))
+        deleted = sorted(previously_deleted | {row for _id, row in rows.items() if _id not in current})
+        new_ids = sorted(ObjectId(_id) for _id in current if _id not in rows)
+
+        if not new_ids and len(deleted) == len(previously_deleted):
+            print("Vector index is up to date.")
+            return
+        rows_after = len(sidecar["ids"]) + len(new_ids)
+        # Also rebuild an IVF-PQ index that fell back to exact search once there is enough data to train it
+        grown = settings.get("requested") == "ivfpq" and rows_after - len(deleted) >= IVFPQ_MIN_ROWS
+        if not sidecar["ids"] or grown or len(deleted) > REBUILD_FRACTION * rows_after:
+            build_index(collection, index_path)
+            return
+
+        ann = None
+        ann_path = os.path.join(index_path, ANN_FILE)
+        if settings["backend"] != "exact":
+            import faiss
+            ann = faiss.read_index(ann_path)
+
+        added = []
+        for start in range(0, len(new_ids), 1000):
+            block = new_ids[start:start + 1000]
+            cursor = collection.find({"_id": {"$in": block}}, {**EMBEDDING_FIELDS, "url": 1, "metadata": 1, "embedder": 1})
+            for doc in cursor:
+                sidecar["embedder"] = document_embedder(doc, sidecar.get("embedder"))
+                vector = normalized_embedding(doc)
+                if len(vector) != sidecar["dim"]:
+                    print("Embedding dimension changed, rebuilding the vector index.")
+                    build_index(collection, index_path)
+                    return
+                added.append(vector)
+                sidecar["ids"].append(str(doc["_id"]))
+                sidecar["metadata"].append(chunk_metadata(doc))
+
+        if added:
+            matrix = np.stack(added).astype(np.float32)
+            # Rows past the old count are invisible to readers until the sidecar is replaced below
+            with open(os.path.join(index_path, EMBEDDINGS_FILE), "ab") as file:
+                file.write(matrix.tobytes())
+            if ann is not None:
+                ann.add(matrix)
+                faiss.write_index(ann, ann_path + ".tmp")
+                os.replace(ann_path + ".tmp", ann_path)
+        sidecar["count"] = len(sidecar["ids"])
+        sidecar["deleted"] = deleted
+        write_sidecar(metadata_path, sidecar)
+
+    print(f"Updated the vector index: {len(added)} embeddings added, {len(deleted)} deleted rows masked.")
+
+
+_loaded = {}
+
+
+def load_index(index_path=INDEX_PATH):
+    """
+    Open the index at index_path, or return None if it has not been built yet.
+    Loaded indexes are kept per process, one per directory (whatever the working directory or path spelling),
+    and reopened only when the files on disk change.
+    """
+    index_path = os.path.abspath(index_path)
+    metadata_path = os.path.join(index_path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return None
+
+    mtime = os.stat(metadata_path).st_mtime_ns
+    cached = _loaded.get(index_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(metadata_path) as file:
+        sidecar = json.load(file)
+    ids = [ObjectId(_id) for _id in sidecar["ids"]]
+    if ids:
+        embeddings = np.memmap(
+            os.path.join(index_path, EMBEDDINGS_FILE),
+            dtype=np.float32, mode="r", shape=(len(ids), sidecar["dim"]),
+        )
+    else:
+        embeddings = np.empty((0, sidecar["dim"]), dtype=np.float32)
+
+    ann = None
+    if ids and sidecar.get("ann", {}).get("backend", "exact") != "exact":
+        import faiss
+        ann = configure_ann(faiss.read_index(os.path.join(index_path, ANN_FILE)))
+
+    index = VectorIndex(embeddings, ids, sidecar["metadata"], ann=ann, deleted=sidecar.get("deleted", []), embedder=sidecar.get("embedder"))
+    _loaded[index_path] = (mtime, index)
+    return index
+
+
+def evaluate(index, num_queries=200, top_k=5, seed=0):
+    """
+    Print the recall@top_k of the index against exact search and its query latency,
+    using stored embeddings as queries.
+    :return: float: mean recall@top_k.
+    """
+    exact = VectorIndex(index.embeddings, index.ids, index.metadata, deleted=index.deleted, embedder=index.embedder)
+    live = np.setdiff1d(np.arange(len(index.ids)), index.deleted)
+    queries = np.random.default_rng(seed).choice(live, size=min(num_queries, len(live)), replace=False)
+
+    recalls = []
+    latencies = []
+    for row in queries:
+        query = np.array(index.embeddings[row])
+        expected = {_id for _id, _score in exact.search(query, top_k)}
+        start = time.perf_counter()
+        found = {_id for _id, _score in index.search(query, top_k)}
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(expected & found) / len(expected))
+
+    p50, p95 = np.percentile(np.asarray(latencies) * 1000, [50, 95])
+    recall = float(np.mean(recalls))
+    print(f"recall@{top_k} = {recall:.4f}, p50 {p50:.3f} ms, p95 {p95:.3f} ms over {len(queries)} queries")
+    return recall
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build, update or evaluate the vector index.")
+    parser.add_argument("--backend", type=str, default=None, choices=BACKENDS, help="Index backend (default: keep the current one).")
+    parser.add_argument("--update", action="store_true", help="Apply inserts and deletes since the last build instead of rebuilding.")
+    parser.add_argument("--evaluate", action="store_true", help="Report recall@k and latency against exact search.")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of results compared by --evaluate.")
+    parser.add_argument("--rerank", type=int, default=None, help="Override VECTOR_INDEX_RERANK for --evaluate.")
+    parser.add_argument("--ef-search", type=int, default=None, help="Override VECTOR_INDEX_EF_SEARCH for --evaluate.")
+    parser.add_argument("--nprobe", type=int, default=None, help="Override VECTOR_INDEX_NPROBE for --evaluate.")
+    args = parser.parse_args()
+
+    if args.evaluate:
+        index = load_index()
+        if index is None:
+            parser.error("No vector index found, build it first.")
+        if args.rerank:
+            index.rerank = args.rerank
+        if args.ef_search and hasattr(index.ann, "hnsw"):
+            index.ann.hnsw.efSearch = args.ef_search
+        if args.nprobe and hasattr(index.ann, "nprobe"):
+            index.ann.nprobe = args.nprobe
+        evaluate(index, top_k=args.top_k)
+    else:
+        collection = MongoClient(MONGO_URI)[DB_NAME][COLLECTION_NAME]
+        if args.update:
+            update_index(collection)
+        else:
+            build_index(collection, backend=args.backend)
@@ -8,33 +8,48 @@ This script is capable of scraping a list of keywords asynchronously
 
 Contains the following functions:
     make_header:        Makes an HTTP request header using a random user agent
-    get_num_pages:      Finds number of pubmed results pages returned by a keyword search
-    extract_by_article: Extracts data from a single pubmed article to a DataFrame
-    get_pmids:          Gets PMIDs of all article URLs from a single page and builds URLs to pubmed articles specified by those PMIDs
-    build_article_urls: Async wrapper for get_pmids, creates asyncio tasks for each page of results, page by page,
-                        and stores article urls in urls: List[string]
-    get_article_data:   Async wrapper for extract_by_article, creates asyncio tasks to scrape data from each article specified by urls[]
+    AdaptiveRateLimiter: Token bucket shared by all requests, backs off on 429/5xx responses and slowly recovers
+    parse_article:      Extracts data from the HTML of a single pubmed article (runs in a process pool)
+    ScrapeCheckpoint:   Append-only JSONL store of scraped articles keyed by PMID, used to dedup and --resume runs
+    PubMedScraper:      Holds the shared session, rate limiter, parser pool and scrape state, with the methods
+        fetch:              GETs a URL through the shared pooled session, retrying throttled or failed requests with jittered backoff
+        get_num_pages:      Finds number of pubmed results pages returned by a keyword search
+        extract_by_article: Fetches a single pubmed article and parses it off the event loop
+        get_pmids:          Gets PMIDs of all article URLs from a single page and builds URLs to pubmed articles specified by those PMIDs
+        build_article_urls: Async wrapper for get_pmids, creates asyncio tasks for each page of results, page by page,
+                            and stores article urls in urls: List[string]
+        get_article_data:   Async wrapper for extract_by_article, creates asyncio tasks to scrape data from each article specified by urls[]
+        scrape:             Opens the shared session and parser pool, then builds article URLs and scrapes them
+
+All requests, including the search pages, go through a single long-lived aiohttp ClientSession, so connections
+are pooled and kept alive (at most --per-host connections to PubMed), and through one AdaptiveRateLimiter
+instead of a fixed semaphore.
+Use --base-url to point the scraper at a local stand-in server, and --metrics-port to watch the request,
+byte and parse counters (see instrumentation.py) in Prometheus format while a long scrape runs.
 
 requires:
     BeautifulSoup4 (bs4)
     PANDAS
-    requests
     asyncio
     aiohttp
     nest_asyncio (OPTIONAL: Solves nested async calls in jupyter notebooks)
 """
 
 import argparse
+import csv
+import json
 import time
 from bs4 import BeautifulSoup
 import pandas as pd
 import random
-import requests
 import ssl
 import certifi
 import asyncio
 import aiohttp
+import os
 import socket
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import count, profile, report, serve_metrics, stage
 import warnings; warnings.filterwarnings('ignore') # aiohttp produces deprecation warnings that don't concern us
 #import nest_asyncio; nest_asyncio.apply() # necessary to run nested async loops in jupyter notebooks
 
@@ -68,6 +83,11 @@ user_agents = [
 # Create an SSL context using certifi
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
+# Retry policy for throttled (429), failed (5xx) or dropped requests
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0  # seconds, doubled on every retry
+MAX_BACKOFF = 60.0
+
 def make_header():
     """
     Chooses a random agent from user_agents with which to construct headers.
@@ -78,133 +98,328 @@ def make_header():
     }
     return headers
 
-async def extract_by_article(url):
+class AdaptiveRateLimiter:
     """
-    Extracts all data from a single article.
-    :param url: string: URL to a single article (i.e. root PubMed URL + PMID).
-    :return article_data: Dict: Contains all data from a single article.
+    Token bucket limiting the request rate. The rate is halved whenever the server throttles us (429/5xx)
+    and grows back additively after every successful request (AIMD), up to max_rate.
     """
-    conn = aiohttp.TCPConnector(family=socket.AF_INET, ssl=ssl_context)  # Use SSL context here
-    headers = make_header()
-    global articles_data
-    async with aiohttp.ClientSession(headers=headers, connector=conn) as session:
-        async with semaphore, session.get(url) as response:
-            data = await response.text()
-            soup = BeautifulSoup(data, "lxml")
-            # Extract article data
-            try:
-                abstract_raw = soup.find('div', {'class': 'abstract-content selected'}).find_all('p')
-                abstract = ' '.join([paragraph.text.strip() for paragraph in abstract_raw])
-            except:
-                abstract = 'NO_ABSTRACT'
-            try:
-                affiliations = [affiliation.get_text().strip() for affiliation in soup.find('ul', {'class': 'item-list'}).find_all('li')]
-            except:
-                affiliations = 'NO_AFFILIATIONS'
-            try:
-                keywords = soup.find('div', {'class': 'abstract'}).find_all('p')[-1].get_text().replace('Keywords:', '').strip()
-            except:
-                keywords = 'NO_KEYWORDS'
-            try:
-                title = soup.find('meta', {'name': 'citation_title'})['content'].strip('[]')
-            except:
-                title = 'NO_TITLE'
-            try:
-                authors = ', '.join([author.text for author in soup.find('div', {'class': 'authors-list'}).find_all('a', {'class': 'full-name'})])
-            except:
-                authors = 'NO_AUTHOR'
-            try:
-                journal = soup.find('meta', {'name': 'citation_journal_title'})['content']
-            except:
-                journal = 'NO_JOURNAL'
-            try:
-                date = soup.find('time', {'class': 'citation-year'}).text
-            except:
-                date = 'NO_DATE'
-
-            article_data = {
-                'url': url,
-                'title': title,
-                'authors': authors,
-                'abstract': abstract,
-                'affiliations': affiliations,
-                'journal': journal,
-                'keywords': keywords,
-                'date': date
-            }
-            articles_data.append(article_data)
-
-async def get_pmids(page, keyword):
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, max_rate=None):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.tokens = burst
+        self.updated = None
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.updated is not None:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def on_throttle(self, retry_after=None):
+        """
+        Back off after a 429/5xx response, pausing all requests for retry_after seconds if the server asked for it.
+        """
+        self.throttled += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        if retry_after:
+            self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + retry_after)
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_article(url, data):
     """
-    Extracts PMIDs of all articles from a PubMed search result, page by page,
-    builds a URL to each article, and stores all article URLs in urls: List[string].
-    :param page: int: Value of current page of a search result for keyword.
-    :param keyword: string: Current search keyword.
-    :return: None
+    Parses the HTML of a single article. CPU-bound, so it runs in a worker process instead of on the event loop.
+    :param url: string: URL of the article.
+    :param data: string: HTML of the article page.
+    :return article_data: Dict: Contains all data from a single article.
     """
-    page_url = f'{pubmed_url}+{keyword}+&page={page}'
-    headers = make_header()
-    conn = aiohttp.TCPConnector(family=socket.AF_INET, ssl=ssl_context)  # Use SSL context here
-    async with aiohttp.ClientSession(headers=headers, connector=conn) as session:
-        async with session.get(page_url) as response:
-            data = await response.text()
-            soup = BeautifulSoup(data, "lxml")
-            pmids = soup.find('meta', {'name': 'log_displayeduids'})['content']
-            for pmid in pmids.split(','):
-                url = root_pubmed_url + '/' + pmid
-                urls.append(url)
-
-def get_num_pages(keyword):
-    '''
-    Gets total number of pages returned by search results for keyword
-    :param keyword: string: search word used to search for results
-    :return: num_pages: int: number of pages returned by search results for keyword
-    '''
-    # Return user specified number of pages if option was supplied
-    if args.pages != None: 
-        return args.pages
-
-    # Get search result page and wait a second for it to load
-    # URL to the first page of results for a keyword search
-    headers = make_header()
-    search_url = f'{pubmed_url}+{keyword}'
-    with requests.get(search_url, headers=headers) as response:
-        data = response.text
-        soup = BeautifulSoup(data, "lxml")
-        num_pages = int((soup.find('span', {'class': 'total-pages'}).get_text()).replace(',', ''))
-        return num_pages  # Can hardcode this value (e.g. 10 pages) to limit # of articles scraped per keyword
-    
+    soup = BeautifulSoup(data, "lxml")
+    # Extract article data
+    try:
+        abstract_raw = soup.find('div', {'class': 'abstract-content selected'}).find_all('p')
+        abstract = ' '.join([paragraph.text.strip() for paragraph in abstract_raw])
+    except:
+        abstract = 'NO_ABSTRACT'
+    try:
+        affiliations = [affiliation.get_text().strip() for affiliation in soup.find('ul', {'class': 'item-list'}).find_all('li')]
+    except:
+        affiliations = 'NO_AFFILIATIONS'
+    try:
+        keywords = soup.find('div', {'class': 'abstract'}).find_all('p')[-1].get_text().replace('Keywords:', '').strip()
+    except:
+        keywords = 'NO_KEYWORDS'
+    try:
+        title = soup.find('meta', {'name': 'citation_title'})['content'].strip('[]')
+    except:
+        title = 'NO_TITLE'
+    try:
+        authors = ', '.join([author.text for author in soup.find('div', {'class': 'authors-list'}).find_all('a', {'class': 'full-name'})])
+    except:
+        authors = 'NO_AUTHOR'
+    try:
+        journal = soup.find('meta', {'name': 'citation_journal_title'})['content']
+    except:
+        journal = 'NO_JOURNAL'
+    try:
+        date = soup.find('time', {'class': 'citation-year'}).text
+    except:
+        date = 'NO_DATE'
+
+    article_data = {
+        'url': url,
+        'title': title,
+        'authors': authors,
+        'abstract': abstract,
+        'affiliations': affiliations,
+        'journal': journal,
+        'keywords': keywords,
+        'date': date
+    }
+    return article_data
+
 
-async def build_article_urls(keywords):
+class ScrapeCheckpoint:
     """
-    Async wrapper for get_pmids, page by page of results, for a single search keyword.
-    Creates an asyncio task for each page of search result for each keyword.
-    :param keywords: List[string]: List of search keywords.
-    :return: None
+    Append-only JSONL store of scraped articles keyed by PMID. Every article is written and flushed as soon as it
+    is parsed, so a crash loses nothing, and only the set of finished PMIDs is kept in memory for O(1) dedup.
     """
-    tasks = []
-    for keyword in keywords:
-        num_pages = get_num_pages(keyword)
-        for page in range(1, num_pages + 1):
-            task = asyncio.create_task(get_pmids(page, keyword))
-            tasks.append(task)
 
-    await asyncio.gather(*tasks)
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.pmids = set()
+        if resume and os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        self.pmids.add(pmid_of(json.loads(line)['url']))
+                    except (ValueError, KeyError):
+                        # A line cut short by a crash; that article is scraped again
+                        continue
+        self.file = open(path, 'a' if resume else 'w')
 
-async def get_article_data(urls):
+    def __contains__(self, pmid):
+        return pmid in self.pmids
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def add(self, article_data):
+        self.file.write(json.dumps(article_data) + '\n')
+        self.file.flush()
+        self.pmids.add(pmid_of(article_data['url']))
+
+    def close(self):
+        self.file.close()
+
+    def write_csv(self, filename, columns):
+        """
+        Streams every checkpointed article into a CSV laid out like pandas' DataFrame.to_csv output.
+        """
+        with open(self.path) as source, open(filename, 'w', newline='') as target:
+            writer = csv.writer(target)
+            writer.writerow([''] + columns)
+            index = 0
+            for line in source:
+                try:
+                    article_data = json.loads(line)
+                except ValueError:
+                    continue
+                writer.writerow([index] + [article_data.get(column) for column in columns])
+                index += 1
+        return index
+
+def pmid_of(url):
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+class PubMedScraper:
     """
-    Async wrapper for extract_by_article to scrape data from each article (url).
-    :param urls: List[string]: List of all PubMed URLs returned by the search keyword.
-    :return: None
+    Finds and scrapes the PubMed articles of keyword searches within a publication year range.
+    Holds the shared pooled session, the rate limiter, the parser pool and the scrape state, so it can be
+    imported and pointed at a local stand-in server (base_url). scrape() opens the session and parser pool;
+    to call fetch() on its own, set session to an open aiohttp.ClientSession first.
     """
-    tasks = []
-    for url in urls:
-        if url not in scraped_urls:
-            task = asyncio.create_task(extract_by_article(url))
-            tasks.append(task)
-            scraped_urls.append(url)
 
-    await asyncio.gather(*tasks)
+    def __init__(self, checkpoint, base_url='https://pubmed.ncbi.nlm.nih.gov', start=2020, stop=2025, pages=None,
+                 rate=10.0, connections=100, per_host=10, parsers=None, rate_limiter=None):
+        self.checkpoint = checkpoint
+        self.root_url = base_url.rstrip('/')
+        self.search_url = f'{self.root_url}/?term={start}%3A{stop}%5Bdp%5D'
+        self.start = start
+        self.stop = stop
+        self.pages = pages
+        self.connections = connections
+        self.per_host = per_host
+        self.parsers = parsers or os.cpu_count()
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(rate=rate, burst=max(1, int(rate)))
+        self.session = None
+        self.parser_pool = None
+        self.urls = []
+        self.found_pmids = set()
+        self.scraped_pmids = set()
+        self.failed_urls = []
+
+    async def fetch(self, url):
+        """
+        GET a URL through the shared session and rate limiter, retrying 429/5xx responses and connection errors
+        with exponential backoff and jitter.
+        :param url: string: URL to fetch.
+        :return: string: response body, or None if every attempt failed.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            with stage('rate_limit_wait'):
+                await self.rate_limiter.acquire()
+            try:
+                with stage('fetch'):
+                    async with self.session.get(url, headers=make_header()) as response:
+                        count('http_requests', status=response.status)
+                        if response.status == 429 or response.status >= 500:
+                            self.rate_limiter.on_throttle(parse_retry_after(response.headers.get('Retry-After')))
+                        else:
+                            body = await response.read()
+                            count('http_bytes', len(body))
+                            data = body.decode(response.get_encoding(), errors='replace')
+                            self.rate_limiter.on_success()
+                            return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                count('http_errors', error=type(e).__name__)
+                self.rate_limiter.on_throttle()
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.5))
+        count('http_gave_up')
+        print(f'Giving up on {url} after {MAX_RETRIES + 1} attempts')
+        return None
+
+    async def extract_by_article(self, url):
+        """
+        Fetches a single article and hands its HTML to the parser pool, so the event loop keeps fetching while pages are parsed.
+        :param url: string: URL to a single article (i.e. root PubMed URL + PMID).
+        :return: None
+        """
+        data = await self.fetch(url)
+        if data is None:
+            self.failed_urls.append(url)
+            return
+        with stage('parse_article'):
+            article_data = await asyncio.get_running_loop().run_in_executor(self.parser_pool, parse_article, url, data)
+        self.checkpoint.add(article_data)
+        count('articles_scraped')
+
+    async def get_pmids(self, page, keyword):
+        """
+        Extracts PMIDs of all articles from a PubMed search result, page by page,
+        builds a URL to each article, and stores all article URLs in self.urls: List[string].
+        :param page: int: Value of current page of a search result for keyword.
+        :param keyword: string: Current search keyword.
+        :return: None
+        """
+        page_url = f'{self.search_url}+{keyword}+&page={page}'
+        data = await self.fetch(page_url)
+        if data is None:
+            return
+        soup = BeautifulSoup(data, "lxml")
+        pmids = soup.find('meta', {'name': 'log_displayeduids'})['content']
+        for pmid in pmids.split(','):
+            if pmid in self.found_pmids:
+                continue
+            self.found_pmids.add(pmid)
+            self.urls.append(self.root_url + '/' + pmid)
+
+    async def get_num_pages(self, keyword):
+        '''
+        Gets total number of pages returned by search results for keyword
+        :param keyword: string: search word used to search for results
+        :return: num_pages: int: number of pages returned by search results for keyword, 0 if the search page could not be fetched
+        '''
+        # Return user specified number of pages if option was supplied
+        if self.pages is not None:
+            return self.pages
+
+        # URL to the first page of results for a keyword search
+        data = await self.fetch(f'{self.search_url}+{keyword}')
+        if data is None:
+            return 0
+        soup = BeautifulSoup(data, "lxml")
+        return int((soup.find('span', {'class': 'total-pages'}).get_text()).replace(',', ''))
+
+    async def build_article_urls(self, keywords):
+        """
+        Async wrapper for get_pmids, page by page of results, for a single search keyword.
+        Creates an asyncio task for each page of search result for each keyword.
+        :param keywords: List[string]: List of search keywords.
+        :return: None
+        """
+        tasks = []
+        for keyword in keywords:
+            num_pages = await self.get_num_pages(keyword)
+            for page in range(1, num_pages + 1):
+                tasks.append(asyncio.create_task(self.get_pmids(page, keyword)))
+
+        await asyncio.gather(*tasks)
+
+    async def get_article_data(self, urls):
+        """
+        Async wrapper for extract_by_article to scrape data from each article (url).
+        :param urls: List[string]: List of all PubMed URLs returned by the search keyword.
+        :return: None
+        """
+        tasks = []
+        for url in urls:
+            pmid = pmid_of(url)
+            if pmid not in self.checkpoint and pmid not in self.scraped_pmids:
+                tasks.append(asyncio.create_task(self.extract_by_article(url)))
+                self.scraped_pmids.add(pmid)
+
+        await asyncio.gather(*tasks)
+
+    async def scrape(self, keywords):
+        """
+        Opens the shared pooled session and the parser pool, then finds and scrapes every article for keywords.
+        :param keywords: List[string]: List of search keywords.
+        :return: None
+        """
+        conn = aiohttp.TCPConnector(family=socket.AF_INET, ssl=ssl_context, limit=self.connections,
+                                    limit_per_host=self.per_host, keepalive_timeout=30)  # Use SSL context here
+        with ProcessPoolExecutor(max_workers=self.parsers) as self.parser_pool:
+            async with aiohttp.ClientSession(connector=conn, timeout=aiohttp.ClientTimeout(total=60)) as self.session:
+                # One keyword at a time, so only the current keyword's URLs are held in memory
+                for keyword in keywords:
+                    self.urls.clear()
+                    await self.build_article_urls([keyword])
+                    print(f'Scraping initiated for {len(self.urls)} article URLs found for {keyword} from {self.start} to {self.stop}\n')
+                    await self.get_article_data(self.urls)
+        self.session = None
+        self.parser_pool = None
+        print(f'{self.rate_limiter.throttled} requests were throttled or failed and retried; final rate {self.rate_limiter.rate:.1f} requests/sec')
 
 if __name__ == "__main__":
     print("Starting...")
@@ -213,31 +428,41 @@ if __name__ == "__main__":
     parser.add_argument('--start', type=int, default=2020, help='Specify start year for publication date range to scrape.')
     parser.add_argument('--stop', type=int, default=2025, help='Specify stop year for publication date range to scrape.')
     parser.add_argument('--output', type=str, default='articles.csv', help='Choose output file name.')
+    parser.add_argument('--rate', type=float, default=10.0, help='Maximum number of requests per second.')
+    parser.add_argument('--connections', type=int, default=100, help='Size of the shared connection pool.')
+    parser.add_argument('--per-host', type=int, default=10, help='Maximum number of open connections per host.')
+    parser.add_argument('--parsers', type=int, default=os.cpu_count(), help='Number of processes parsing article HTML.')
+    parser.add_argument('--resume', action='store_true', help='Skip articles already saved in the checkpoint of a previous run.')
+    parser.add_argument('--base-url', type=str, default='https://pubmed.ncbi.nlm.nih.gov', help='PubMed root URL, e.g. a local stand-in server.')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this port while scraping.')
     args = parser.parse_args()
     if args.output[-4:] != '.csv': args.output += '.csv'
 
     start = time.time()
-    pubmed_url = f'https://pubmed.ncbi.nlm.nih.gov/?term={args.start}%3A{args.stop}%5Bdp%5D'
-    root_pubmed_url = 'https://pubmed.ncbi.nlm.nih.gov'
     search_keywords = []
     with open('keywords.txt') as file:
         keywords = file.readlines()
         [search_keywords.append(keyword.strip()) for keyword in keywords]
 
-    articles_data = []
-    urls = []
-    scraped_urls = []
-    semaphore = asyncio.BoundedSemaphore(100)
+    filename = args.output
+    checkpoint = ScrapeCheckpoint(filename[:-4] + '.jsonl', resume=args.resume)
+    if args.resume:
+        print(f'Resuming: {len(checkpoint)} articles already scraped')
+    scraper = PubMedScraper(checkpoint, base_url=args.base_url, start=args.start, stop=args.stop, pages=args.pages,
+                            rate=args.rate, connections=args.connections, per_host=args.per_host, parsers=args.parsers)
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(build_article_urls(search_keywords))
-    print(f'Scraping initiated for {len(urls)} article URLs found from {args.start} to {args.stop}\n')
-    loop.run_until_complete(get_article_data(urls))
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    try:
+        with profile():
+            asyncio.run(scraper.scrape(search_keywords))
+    finally:
+        checkpoint.close()
+    if scraper.failed_urls:
+        print(f'{len(scraper.failed_urls)} articles could not be fetched; run again with --resume to retry them')
 
-    articles_df = pd.DataFrame(articles_data, columns=['title', 'abstract', 'affiliations', 'authors', 'journal', 'date', 'keywords', 'url'])
+    num_articles = checkpoint.write_csv(filename, ['title', 'abstract', 'affiliations', 'authors', 'journal', 'date', 'keywords', 'url'])
     print('Preview of scraped article data:\n')
-    print(articles_df.head(5))
-    filename = args.output
-    articles_df.to_csv(filename)
-    print(f'It took {time.time() - start} seconds to find {len(urls)} articles; {len(scraped_urls)} unique articles were saved to {filename}')
-
+    print(pd.read_csv(filename, index_col=0, nrows=5))
+    print(f'It took {time.time() - start} seconds to find {len(scraper.found_pmids)} articles; {num_articles} unique articles were saved to {filename}')
+    report()